@@ -0,0 +1,119 @@
+# Builds a synthetic ledger: N currencies, M accounts and Y years of seeded
+# random transactions, with a balance entry for every account every
+# --balance-every days. Every transfer also adds its TRANSFER_IN counterpart.
+# The same options and seed always give the same database.
+#
+#     python benchmarks/generate.py ledger.db --accounts 50 --years 5 --transactions 1000000
+import os
+import random
+import time
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+import click
+
+from finctrl import ledger
+from finctrl.ledger import TransactionType
+
+COMMENTS = ('groceries', 'rent', 'salary', 'coffee', 'fuel', 'transfer', 'utilities', 'restaurant', 'books', 'travel')
+CURRENCIES = (('Ruble', 'RUB', 'R'), ('Dollar', 'USD', '$'), ('Euro', 'EUR', 'E'), ('Pound', 'GBP', 'L'), ('Yen', 'JPY', 'Y'))
+
+Span = namedtuple('Span', ['date_start', 'date_end'])
+
+
+def span_of(years, start_year=2015):
+    # Transactions are generated on [date_start, date_end).
+    return Span(date(start_year, 1, 1), date(start_year + years, 1, 1))
+
+
+def currency_rows(count):
+    for number in range(count):
+        name, code, sign = CURRENCIES[number % len(CURRENCIES)]
+        if number >= len(CURRENCIES):
+            suffix = str(number // len(CURRENCIES))
+            name, code, sign = name + suffix, code + suffix, sign + suffix
+        yield name, code, sign
+
+
+def generate(path, currencies=2, accounts=10, years=1, transactions=10000, seed=1, balance_every=1, start_year=2015):
+    if os.path.exists(path):
+        os.unlink(path)
+    ledger.use_database(path)
+    # Nothing here needs to survive a crash: the file is rebuilt from scratch.
+    ledger.db.pragma('synchronous', 'OFF')
+    ledger.db.pragma('journal_mode', 'MEMORY')
+
+    rng = random.Random(seed)
+    currency_codes = [code for _, code, _ in currency_rows(currencies)]
+    for name, code, sign in currency_rows(currencies):
+        ledger.create_currency(name, code, sign)
+    account_ids = [
+        ledger.create_account('Account {0}'.format(number), currency_codes[number % currencies])
+        for number in range(accounts)
+    ]
+    balances = dict((account_id, rng.randrange(0, 10 ** 7)) for account_id in account_ids)
+
+    span = span_of(years, start_year)
+    num_days = (span.date_end - span.date_start).days
+    per_day = float(transactions) / num_days
+    transaction_table = ledger.AccountTransaction._meta.db_table
+    balance_table = ledger.AccountBalance._meta.db_table
+    transaction_sql = 'INSERT INTO {0} (account_id, timestamp, type, amount, comment) VALUES (?, ?, ?, ?, ?)'.format(transaction_table)
+    balance_sql = 'INSERT INTO {0} (account_id, date, balance) VALUES (?, ?, ?)'.format(balance_table)
+
+    generated = 0
+    with ledger.db.atomic():
+        cursor = ledger.db.get_cursor()
+        for day_number in range(num_days):
+            day = span.date_start + timedelta(days=day_number)
+            if day_number % balance_every == 0:
+                cursor.executemany(balance_sql, [
+                    (account_id, str(day), balances[account_id]) for account_id in account_ids
+                ])
+
+            # Spread the remaining transactions evenly over the remaining days.
+            count = int(per_day * (day_number + 1)) - generated
+            seconds = sorted(rng.randrange(86400) for _ in range(count))
+            rows = []
+            for second in seconds:
+                timestamp = str(datetime(day.year, day.month, day.day) + timedelta(seconds=second))
+                account_id = rng.choice(account_ids)
+                amount = int(rng.lognormvariate(7, 1.5)) + 1
+                roll = rng.random()
+                if roll < 0.7:
+                    type = TransactionType.DEBIT
+                elif roll < 0.9 or len(account_ids) == 1:
+                    # Fewer but larger credits keep balances around zero.
+                    type = TransactionType.CREDIT
+                    amount *= 3
+                else:
+                    type = TransactionType.TRANSFER_OUT
+                    target_id = rng.choice(account_ids)
+                    rows.append((target_id, timestamp, TransactionType.TRANSFER_IN.value, amount, 'transfer'))
+                    balances[target_id] = ledger.apply_transaction(balances[target_id], TransactionType.TRANSFER_IN, amount)
+                rows.append((account_id, timestamp, type.value, amount, rng.choice(COMMENTS)))
+                balances[account_id] = ledger.apply_transaction(balances[account_id], type, amount)
+            cursor.executemany(transaction_sql, rows)
+            generated += count
+        ledger.rebuild_monthly_aggregates()
+    ledger.identity_map.clear()
+    return span
+
+
+@click.command()
+@click.argument('path', default='finance.db')
+@click.option('--currencies', type=click.INT, default=2)
+@click.option('--accounts', type=click.INT, default=10)
+@click.option('--years', type=click.INT, default=1)
+@click.option('--transactions', type=click.INT, default=10000)
+@click.option('--seed', type=click.INT, default=1)
+@click.option('--balance-every', type=click.INT, default=1)
+@click.option('--start-year', type=click.INT, default=2015)
+def main(path, currencies, accounts, years, transactions, seed, balance_every, start_year):
+    time_start = time.time()
+    span = generate(path, currencies, accounts, years, transactions, seed, balance_every, start_year)
+    click.echo('Generated {0} from {1} to {2} in {3:.1f}s'.format(path, span.date_start, span.date_end, time.time() - time_start))
+
+
+if __name__ == '__main__':
+    main()
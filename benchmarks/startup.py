@@ -0,0 +1,48 @@
+# Cold-start time of `finctrl list_accounts`: every run is a new interpreter
+# against a small ledger in a temporary directory.
+#
+#     python benchmarks/startup.py --runs 50
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+COMMAND = [sys.executable, '-c', 'from finctrl import cli; cli()']
+
+
+def run(args, cwd):
+    subprocess.check_call(COMMAND + args, cwd=cwd, stdout=subprocess.DEVNULL)
+
+
+@click.command()
+@click.option('--runs', type=click.INT, default=30)
+@click.option('--accounts', type=click.INT, default=10)
+def main(runs, accounts):
+    workdir = tempfile.mkdtemp()
+    try:
+        run(['create_currency', 'Ruble', 'RUB', 'R'], workdir)
+        for number in range(accounts):
+            run(['create_account', 'Account {0}'.format(number), 'RUB'], workdir)
+
+        timings = []
+        for _ in range(runs):
+            time_start = time.perf_counter()
+            run(['list_accounts'], workdir)
+            timings.append(time.perf_counter() - time_start)
+    finally:
+        shutil.rmtree(workdir)
+
+    timings.sort()
+    click.echo('list_accounts, {0} runs: min {1:.1f} ms, median {2:.1f} ms, max {3:.1f} ms'.format(
+        runs,
+        timings[0] * 1000,
+        timings[len(timings) // 2] * 1000,
+        timings[-1] * 1000
+    ))
+
+
+if __name__ == '__main__':
+    main()
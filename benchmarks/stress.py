@@ -0,0 +1,214 @@
+# Runs writers, importers, a balance roll-forward and readers against one
+# ledger at the same time, each in a process of its own and every operation
+# through the CLI, then checks that no command failed and no write was lost:
+# every transaction is there once, the monthly aggregates match the
+# transactions and consecutive balance entries differ by the transactions of
+# the day between them.
+#
+#     python benchmarks/stress.py stress.db --writers 4 --readers 4 --iterations 200
+import csv
+import io
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from collections import defaultdict
+from contextlib import redirect_stderr, redirect_stdout
+from datetime import timedelta
+
+import click
+
+from finctrl import cli, ledger
+from finctrl.ledger import AccountBalance, AccountTransaction, MonthlyAggregate, fn
+from generate import generate, span_of
+
+
+def invoke(database, pragmas, argv):
+    options = ['--database', database]
+    for pragma in pragmas:
+        options.extend(['--pragma', pragma])
+    with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+        cli.main(options + argv, standalone_mode=False)
+
+
+def run_worker(kind, number, database, pragmas, iterations, accounts, days):
+    # Returns (kind, operations, errors); every operation is a separate
+    # command run, as a cron job or a user would.
+    operations = 0
+    errors = []
+    for iteration in range(iterations):
+        day = days[(number * iterations + iteration) % len(days)]
+        day_args = [str(day.year), str(day.month), str(day.day)]
+        if kind == 'writer':
+            argv = [
+                'create_account_transaction',
+                str(1 + (number + iteration) % accounts),
+                'DEBIT' if iteration % 3 else 'CREDIT',
+                '{0}.{1:02d}'.format(1 + iteration % 50, iteration % 100),
+                'stress writer {0} {1}'.format(number, iteration)
+            ] + day_args + ['12', str(number % 60), str(iteration % 60)]
+        elif kind == 'importer':
+            argv = ['import_transactions', importer_file(database, number, iteration, accounts, day), '--batch-size', '10']
+        elif kind == 'roller':
+            argv = ['update_account_balance_entries'] + day_args
+        elif iteration % 3 == 0:
+            argv = ['list_account_balance_entries'] + day_args
+        elif iteration % 3 == 1:
+            argv = ['show_monthly_report', str(day.year), str(day.month)]
+        else:
+            argv = ['search_transactions', 'stress', '--limit', '5']
+        try:
+            invoke(database, pragmas, argv)
+        except Exception:
+            errors.append('{0} {1}: {2}'.format(kind, ' '.join(argv), traceback.format_exc().strip().splitlines()[-1]))
+        operations += 1
+    return kind, operations, errors
+
+
+def importer_file(database, number, iteration, accounts, day):
+    path = '{0}.import-{1}-{2}.csv'.format(database, number, iteration)
+    with io.open(path, 'w', encoding='utf-8', newline='') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(['timestamp', 'amount', 'account_id', 'comment', 'reference'])
+        for row in range(20):
+            writer.writerow([
+                '{0} 13:{1:02d}:{2:02d}'.format(day, number % 60, row),
+                '-{0}.50'.format(row + 1),
+                1 + (number + row) % accounts,
+                'stress import {0} {1} {2}'.format(number, iteration, row),
+                'stress-{0}-{1}-{2}'.format(number, iteration, row)
+            ])
+    return path
+
+
+def check_ledger(database, expected_writes, expected_imports, days):
+    ledger.use_database(database)
+    problems = []
+    writes = AccountTransaction.select().where(AccountTransaction.comment.startswith('stress writer')).count()
+    if writes != expected_writes:
+        problems.append('{0} of {1} written transactions stored'.format(writes, expected_writes))
+    imports = AccountTransaction.select().where(AccountTransaction.comment.startswith('stress import')).count()
+    if imports != expected_imports:
+        problems.append('{0} of {1} imported transactions stored'.format(imports, expected_imports))
+
+    totals = dict(
+        ((account_id, int(year), int(month), type), (total, count))
+        for account_id, year, month, type, total, count in AccountTransaction.select(
+            AccountTransaction.account,
+            fn.strftime('%Y', AccountTransaction.timestamp),
+            fn.strftime('%m', AccountTransaction.timestamp),
+            AccountTransaction.type,
+            fn.SUM(AccountTransaction.amount),
+            fn.COUNT(AccountTransaction.id)
+        ).group_by(
+            AccountTransaction.account,
+            fn.strftime('%Y', AccountTransaction.timestamp),
+            fn.strftime('%m', AccountTransaction.timestamp),
+            AccountTransaction.type
+        ).tuples()
+    )
+    aggregates = dict(
+        ((account_id, year, month, type), (total, count))
+        for account_id, year, month, type, total, count in MonthlyAggregate.select(
+            MonthlyAggregate.account,
+            MonthlyAggregate.year,
+            MonthlyAggregate.month,
+            MonthlyAggregate.type,
+            MonthlyAggregate.total,
+            MonthlyAggregate.count
+        ).where(MonthlyAggregate.count > 0).tuples()
+    )
+    if totals != aggregates:
+        problems.append('{0} monthly aggregates differ from the transactions'.format(
+            len(set(totals.items()) ^ set(aggregates.items()))
+        ))
+
+    ledger.refresh_balances()
+    entries = dict(
+        ((account_id, entry_date), balance)
+        for account_id, entry_date, balance in AccountBalance.select(
+            AccountBalance.account,
+            AccountBalance.date,
+            AccountBalance.balance
+        ).where(AccountBalance.date >= days[0] - timedelta(days=1)).tuples()
+    )
+    moved = defaultdict(int)
+    for account_id, timestamp, type, amount in AccountTransaction.select(
+        AccountTransaction.account,
+        AccountTransaction.timestamp,
+        AccountTransaction.type,
+        AccountTransaction.amount
+    ).where(AccountTransaction.timestamp >= days[0] - timedelta(days=1)).tuples():
+        key = (account_id, timestamp.date())
+        moved[key] = ledger.apply_transaction(moved[key], type, amount)
+    mismatches = 0
+    for (account_id, entry_date), balance in entries.items():
+        following = (account_id, entry_date + timedelta(days=1))
+        if following in entries and entries[following] != balance + moved[(account_id, entry_date)]:
+            mismatches += 1
+    if mismatches:
+        problems.append('{0} balance entries disagree with the day before'.format(mismatches))
+    return problems
+
+
+@click.command()
+@click.argument('path', default='stress.db')
+@click.option('--accounts', type=click.INT, default=5)
+@click.option('--transactions', type=click.INT, default=10000)
+@click.option('--writers', type=click.INT, default=4)
+@click.option('--importers', type=click.INT, default=1)
+@click.option('--readers', type=click.INT, default=4)
+@click.option('--iterations', type=click.INT, default=100)
+@click.option('--pragma', 'pragmas', multiple=True)
+def main(path, accounts, transactions, writers, importers, readers, iterations, pragmas):
+    generate(path, accounts=accounts, years=1, transactions=transactions)
+    ledger.db.close()
+    # Writes land in the last days of the generated span and the days after
+    # it, which the roll-forward keeps adding balance entries for.
+    span = span_of(1)
+    days = [span.date_end + timedelta(days=offset) for offset in range(-5, 15)]
+
+    workers = [('writer', number) for number in range(writers)]
+    workers += [('importer', number) for number in range(importers)]
+    workers += [('roller', 0)]
+    workers += [('reader', number) for number in range(readers)]
+    time_start = time.time()
+    pool = multiprocessing.get_context('spawn').Pool(len(workers))
+    try:
+        results = [
+            pool.apply_async(run_worker, (kind, number, path, pragmas, iterations, accounts, days))
+            for kind, number in workers
+        ]
+        results = [result.get() for result in results]
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - time_start
+    for name in os.listdir(os.path.dirname(os.path.abspath(path))):
+        if name.startswith(os.path.basename(path) + '.import-'):
+            os.unlink(os.path.join(os.path.dirname(os.path.abspath(path)), name))
+
+    operations = defaultdict(int)
+    errors = []
+    for kind, count, worker_errors in results:
+        operations[kind] += count
+        errors.extend(worker_errors)
+    click.echo('{0} commands in {1:.1f}s: {2}'.format(
+        sum(operations.values()),
+        elapsed,
+        ', '.join('{0} {1}'.format(count, kind) for kind, count in sorted(operations.items()))
+    ))
+    problems = check_ledger(path, writers * iterations, importers * iterations * 20, days)
+    for error in errors[:20]:
+        click.echo('error: {0}'.format(error), err=True)
+    for problem in problems:
+        click.echo('problem: {0}'.format(problem), err=True)
+    if errors or problems:
+        click.echo('FAILED: {0} failed commands, {1} problems'.format(len(errors), len(problems)), err=True)
+        sys.exit(1)
+    click.echo('OK: no failed commands and no lost writes')
+
+
+if __name__ == '__main__':
+    main()
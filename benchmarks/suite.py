@@ -0,0 +1,250 @@
+# Times CLI commands and ledger paths against generated ledgers of several
+# sizes. Every case runs in a fresh process so that its peak RSS is its own;
+# cases that write get a scratch copy of the ledger. Generated ledgers are
+# kept in --cache-dir and reused by later runs with the same parameters.
+#
+#     python benchmarks/suite.py run --sizes 10000,1000000,10000000 --output before.json
+#     python benchmarks/suite.py run --sizes 300000 --accounts 50 --years 10 --balance-every 30 --case timeseries
+#     python benchmarks/suite.py compare before.json after.json
+import io
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
+from collections import namedtuple
+from contextlib import redirect_stdout
+from datetime import timedelta
+
+import click
+
+from finctrl import cli, ledger, snapshot
+from generate import generate, span_of
+
+Case = namedtuple('Case', ['name', 'writes', 'prepare', 'run'])
+
+
+def middle(span):
+    return span.date_start + (span.date_end - span.date_start) // 2
+
+
+def last_day(span):
+    return span.date_end - timedelta(days=1)
+
+
+def day_args(day):
+    return [str(day.year), str(day.month), str(day.day)]
+
+
+def month_args(day):
+    return [str(day.year), str(day.month)]
+
+
+def invoke(database, argv):
+    with redirect_stdout(io.StringIO()):
+        cli.main(['--database', database] + argv, standalone_mode=False)
+
+
+def command_case(name, argv, writes=False, prepare=None):
+    return Case(name, writes, prepare, lambda database, span: invoke(database, argv(span)))
+
+
+def remove_balances(date_start, date_end):
+    ledger.AccountBalance.delete().where(
+        ledger.AccountBalance.date >= date_start,
+        ledger.AccountBalance.date <= date_end
+    ).execute()
+
+
+CASES = [
+    command_case('list_accounts', lambda span: ['list_accounts']),
+    command_case('balance_at', lambda span: ['balance_at', '1'] + day_args(middle(span))),
+    command_case('show_balance_report', lambda span: ['show_balance_report'] + day_args(middle(span))),
+    command_case('list_account_balance_entries', lambda span: ['list_account_balance_entries'] + day_args(middle(span))),
+    command_case('list_account_transactions', lambda span: ['list_account_transactions'] + day_args(middle(span))),
+    command_case('list_account_transactions_month', lambda span: ['list_account_transactions_month'] + month_args(middle(span))),
+    command_case('list_account_transactions_series', lambda span: ['list_account_transactions_series', '1'] + day_args(span.date_start) + day_args(span.date_end)),
+    command_case('show_monthly_report', lambda span: ['show_monthly_report'] + month_args(middle(span))),
+    command_case('show_average_overview', lambda span: ['show_average_overview'] + month_args(span.date_start) + month_args(last_day(span))),
+    command_case('make_account_report', lambda span: ['make_account_report', '1'] + day_args(span.date_start) + day_args(span.date_end)),
+    command_case('make_accounts_report', lambda span: ['make_accounts_report'] + day_args(span.date_start) + day_args(span.date_end)),
+    command_case('timeseries', lambda span: ['timeseries'] + day_args(span.date_start) + day_args(last_day(span)) + ['--output', os.devnull]),
+    command_case('search_transactions', lambda span: ['search_transactions', 'rent', '--page', '5']),
+    command_case('export_transactions', lambda span: ['export', 'transactions', '--output', os.devnull]),
+    command_case('create_account_transaction', lambda span: ['create_account_transaction', '1', 'DEBIT', '1.00', 'benchmark'] + day_args(middle(span)) + ['12', '0', '0'], writes=True),
+    command_case(
+        'update_account_balance_entries',
+        lambda span: ['update_account_balance_entries'] + day_args(middle(span)),
+        writes=True,
+        prepare=lambda span: remove_balances(middle(span), middle(span))
+    ),
+    command_case('snapshot', lambda span: ['snapshot', '--rebuild'], writes=True),
+    Case(
+        'snapshot_monthly_sums',
+        True,
+        lambda span: snapshot.update_snapshot(snapshot.snapshot_path(ledger.db.database)),
+        lambda database, span: snapshot.monthly_sums(snapshot.Snapshot(snapshot.snapshot_path(database)))
+    ),
+    Case(
+        'roll_forward_balances_90_days',
+        True,
+        lambda span: remove_balances(last_day(span) - timedelta(days=89), last_day(span)),
+        lambda database, span: ledger.roll_forward_balances(last_day(span) - timedelta(days=89), last_day(span))
+    ),
+]
+
+
+def peak_rss_kb():
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+class QueryCounter(object):
+    # A minimal ledger.db tracer: counts statements and runs them unchanged.
+    def __init__(self):
+        self.count = 0
+
+    def execute(self, execute_sql, sql, params, require_commit):
+        self.count += 1
+        return execute_sql(sql, params, require_commit)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command('case')
+@click.argument('database')
+@click.argument('name')
+@click.option('--years', type=click.INT, required=True)
+@click.option('--repeat', type=click.INT, default=3)
+def run_case(database, name, years, repeat):
+    # Runs one case in this process and prints its measurements as JSON.
+    case = dict((case.name, case) for case in CASES)[name]
+    span = span_of(years)
+    ledger.use_database(database)
+    counter = ledger.db.tracer = QueryCounter()
+    timings = []
+    for _ in range(repeat):
+        if case.prepare is not None:
+            with ledger.db.atomic():
+                case.prepare(span)
+        counter.count = 0
+        time_start = time.perf_counter()
+        case.run(database, span)
+        timings.append(time.perf_counter() - time_start)
+    timings.sort()
+    click.echo(json.dumps({
+        'min': timings[0],
+        'median': timings[len(timings) // 2],
+        'queries': counter.count,
+        'peak_rss_kb': peak_rss_kb()
+    }))
+
+
+@main.command('run')
+@click.option('--sizes', default='10000,100000')
+@click.option('--currencies', type=click.INT, default=2)
+@click.option('--accounts', type=click.INT, default=10)
+@click.option('--years', type=click.INT, default=2)
+@click.option('--seed', type=click.INT, default=1)
+@click.option('--balance-every', type=click.INT, default=1)
+@click.option('--repeat', type=click.INT, default=3)
+@click.option('--case', 'case_names', multiple=True)
+@click.option('--cache-dir', default='.benchmarks')
+@click.option('--output', default='benchmark.json')
+def run_suite(sizes, currencies, accounts, years, seed, balance_every, repeat, case_names, cache_dir, output):
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    cases = [case for case in CASES if not case_names or case.name in case_names]
+    scratch = os.path.join(cache_dir, 'scratch.db')
+    results = []
+    for size in [int(size) for size in sizes.split(',')]:
+        database = os.path.join(cache_dir, 'ledger-{0}-{1}-{2}-{3}-{4}-{5}.db'.format(size, currencies, accounts, years, seed, balance_every))
+        if not os.path.exists(database):
+            click.echo('Generating {0}'.format(database), err=True)
+            generate(database + '.tmp', currencies, accounts, years, size, seed, balance_every)
+            os.rename(database + '.tmp', database)
+        for case in cases:
+            path = database
+            if case.writes:
+                path = scratch
+                shutil.copyfile(database, path)
+            measurement = json.loads(subprocess.check_output([
+                sys.executable,
+                os.path.abspath(__file__),
+                'case',
+                path,
+                case.name,
+                '--years', str(years),
+                '--repeat', str(repeat)
+            ]).decode('utf-8'))
+            measurement.update(size=size, case=case.name)
+            results.append(measurement)
+            click.echo('{0:>10} {1:<36} {2:10.2f} ms {3:6} queries {4:8} kB'.format(
+                size, case.name, measurement['median'] * 1000, measurement['queries'], measurement['peak_rss_kb']
+            ))
+    if os.path.exists(scratch):
+        os.unlink(scratch)
+    if os.path.isdir(snapshot.snapshot_path(scratch)):
+        shutil.rmtree(snapshot.snapshot_path(scratch))
+
+    with io.open(output, 'w', encoding='utf-8') as fp:
+        json.dump({
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'parameters': {
+                'currencies': currencies,
+                'accounts': accounts,
+                'years': years,
+                'seed': seed,
+                'balance_every': balance_every,
+                'repeat': repeat
+            },
+            'results': results
+        }, fp, indent=2)
+
+
+@main.command()
+@click.argument('before', type=click.File('r'))
+@click.argument('after', type=click.File('r'))
+@click.option('--threshold', type=click.FLOAT, default=0.1)
+def compare(before, after, threshold):
+    before_results = dict(((result['size'], result['case']), result) for result in json.load(before)['results'])
+    for result in json.load(after)['results']:
+        previous = before_results.get((result['size'], result['case']))
+        if previous is None:
+            continue
+        ratio = result['median'] / previous['median'] if previous['median'] else 1
+        if ratio > 1 + threshold:
+            verdict = 'slower'
+        elif ratio < 1 - threshold:
+            verdict = 'faster'
+        else:
+            verdict = ''
+        click.echo('{0:>10} {1:<36} {2:10.2f} ms -> {3:10.2f} ms {4:6.2f}x {5}'.format(
+            result['size'], result['case'], previous['median'] * 1000, result['median'] * 1000, ratio, verdict
+        ))
+
+
+if __name__ == '__main__':
+    main()
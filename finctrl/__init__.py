@@ -1,140 +1,161 @@
-from peewee import (
-    SqliteDatabase,
-    Model,
-    CharField,
-    ForeignKeyField,
-    DateField,
-    DecimalField,
-    DateTimeField,
-    IntegerField,
-    TextField
-)
-
 import os
 import click
-from datetime import date, datetime, timedelta
-from decimal import Decimal, ROUND_DOWN
-from enum import IntEnum
-from calendar import monthrange
+from collections import defaultdict
+from datetime import date, datetime
+from decimal import ROUND_DOWN
+from functools import wraps
+
+from finctrl import ledger
+from finctrl.ledger import TransactionType
 
-db = SqliteDatabase(os.path.join(os.getcwd(), 'finance.db'))
 
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
 
-class Currency(Model):
-    name = CharField()
-    code = CharField()
-    sign = CharField()
 
-    class Meta:
-        database = db
+def parse_date_option(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return parse_date(value)
+    except ValueError:
+        raise click.BadParameter('expected YYYY-MM-DD, got "{0}"'.format(value))
 
 
-class Account(Model):
-    name = CharField()
-    currency = ForeignKeyField(Currency, related_name='accounts')
+def echo_transactions(transactions):
+    for transaction in transactions:
+        click.echo('#{0} "{1}" {2} {3} {4} {5} "{6}"'.format(transaction.id, transaction.account.name, transaction.timestamp, transaction.type.name, transaction.amount, transaction.account.currency.sign, transaction.comment))
 
-    class Meta:
-        database = db
 
+def echo_rolled_balances(entries):
+    for entry in entries:
+        if entry.entry_id is not None:
+            click.echo('#{0} "{1}" {2} {3} {4}'.format(entry.entry_id, entry.account.name, entry.date, entry.balance, entry.account.currency.sign))
+        elif entry.balance is None:
+            print('Not OK')
 
-class AccountBalance(Model):
-    account = ForeignKeyField(Account, related_name='balance_entries')
-    date = DateField()
-    balance = DecimalField(max_digits=10, decimal_places=2)
 
-    class Meta:
-        database = db
+def archive_errors(command):
+    # Writes to archived years are refused with an error message rather than
+    # a traceback.
+    @wraps(command)
+    def wrapper(*args, **kwargs):
+        try:
+            return command(*args, **kwargs)
+        except ledger.ArchiveError as error:
+            raise click.ClickException(str(error))
+    return wrapper
+
 
+def writes(command):
+    # Runs the command in a single write transaction, so that what it reads
+    # cannot change before it writes. The transaction begins IMMEDIATE, see
+    # ledger.LedgerDatabase.begin(), and a lock held by another process
+    # delays the command instead of failing it half-way.
+    @wraps(command)
+    def wrapper(*args, **kwargs):
+        with ledger.db.atomic():
+            return command(*args, **kwargs)
+    return wrapper
 
-class TransactionType(IntEnum):
-    DEBIT = 1
-    CREDIT = 2
-    TRANSFER_OUT = 3
-    TRANSFER_IN = 4
 
+def open_database(database, pragmas):
+    try:
+        ledger.use_database(database, pragmas)
+    except ledger.MigrationError as error:
+        raise click.ClickException(str(error))
 
-class AccountTransaction(Model):
-    account = ForeignKeyField(Account, related_name='transactions')
-    timestamp = DateTimeField()
-    type = IntegerField()
-    amount = DecimalField(max_digits=10, decimal_places=2)
-    comment = TextField()
 
-    class Meta:
-        database = db
+def parse_pragma(ctx, param, values):
+    pragmas = []
+    for value in values:
+        name, separator, setting = value.partition('=')
+        if not separator or not name.strip():
+            raise click.BadParameter('expected NAME=VALUE, got "{0}"'.format(value))
+        pragmas.append((name.strip(), setting.strip()))
+    return pragmas
 
 
-def init_db():
-    db.create_tables([Currency, Account, AccountBalance, AccountTransaction], safe=True)
+TRACE_ON = ('1', 'json')
+TRACE_OFF = ('', '0', 'false')
 
 
 @click.group()
-def cli():
-    pass
+@click.option('--database', envvar='FINCTRL_DATABASE', default='finance.db', type=click.Path(dir_okay=False))
+@click.option('--pragma', 'pragmas', envvar='FINCTRL_PRAGMAS', multiple=True, callback=parse_pragma)
+@click.option('--profile', is_flag=True)
+@click.option('--profile-format', type=click.Choice(['text', 'json']), default='text')
+@click.option('--profile-output', type=click.Path(dir_okay=False))
+@click.option('--cprofile', 'cprofile_path', type=click.Path(dir_okay=False))
+@click.pass_context
+def cli(ctx, database, pragmas, profile, profile_format, profile_output, cprofile_path):
+    # FINCTRL_TRACE=1 (or =json) turns profiling on without touching the
+    # command line of scripts; unset, empty, 0 or false leave it off.
+    trace = os.environ.get('FINCTRL_TRACE', '').strip().lower()
+    if trace not in TRACE_OFF + TRACE_ON:
+        raise click.UsageError('FINCTRL_TRACE must be one of {0}, got "{1}"'.format(', '.join(TRACE_ON + TRACE_OFF[1:]), trace))
+    if trace in TRACE_ON:
+        profile = True
+        if trace == 'json':
+            profile_format = 'json'
+    if not profile and not cprofile_path:
+        open_database(database, pragmas)
+        return
+
+    from finctrl.profiling import Profiler
+
+    profiler = Profiler(ledger.db, ctx.invoked_subcommand, cprofile_path)
+    profiler.start('open')
+    ctx.call_on_close(lambda: profiler.report(profile_format, profile_output))
+    open_database(database, pragmas)
+    profiler.mark('command')
 
 
 @cli.command()
 @click.argument('name')
 @click.argument('code')
 @click.argument('sign')
-def create_currency(name, code, sign):
-    init_db()
-    currency = Currency.create(
-        name=name,
-        code=code,
-        sign=sign
-    )
-    currency.save()
-    click.echo('Created Currency instance #{0}'.format(currency.id))
+@click.option('--exponent', type=click.INT, default=2)
+@writes
+def create_currency(name, code, sign, exponent):
+    currency_id = ledger.create_currency(name, code, sign, exponent)
+    click.echo('Created Currency instance #{0}'.format(currency_id))
 
 
 @cli.command()
 @click.argument('currency_id', type=click.INT)
 @click.argument('sign')
+@writes
 def edit_currency_sign(currency_id, sign):
-    init_db()
-    currency = Currency.get(Currency.id == currency_id)
-    currency.sign = sign
-    currency.save()
+    ledger.set_currency_sign(currency_id, sign)
 
 
 @cli.command()
 def list_currencies():
-    init_db()
-    currencies = Currency.select()
-    for currency in currencies:
+    for currency in ledger.currencies():
         click.echo('#{0} "{1}" {2} {3}'.format(currency.id, currency.name, currency.code, currency.sign))
 
 
 @cli.command()
 @click.argument('name')
 @click.argument('currency_code')
+@writes
 def create_account(name, currency_code):
-    init_db()
-    currency = Currency.get(Currency.code == currency_code)
-    account = Account.create(
-        name=name,
-        currency=currency
-    )
-    account.save()
-    click.echo('Created Account instance #{0}'.format(account.id))
+    account_id = ledger.create_account(name, currency_code)
+    click.echo('Created Account instance #{0}'.format(account_id))
 
 
 @cli.command()
 @click.argument('account_id', type=click.INT)
 @click.argument('name')
+@writes
 def rename_account(account_id, name):
-    init_db()
-    account = Account.get(Account.id == account_id)
-    account.name = name
-    account.save()
+    ledger.rename_account(account_id, name)
 
 
 @cli.command()
 def list_accounts():
-    init_db()
-    accounts = Account.select()
-    for account in accounts:
+    for account in ledger.accounts():
         click.echo('#{0} "{1}" {2}'.format(account.id, account.name, account.currency.code))
 
 
@@ -144,17 +165,13 @@ def list_accounts():
 @click.argument('month', type=click.INT, default=date.today().month)
 @click.argument('day', type=click.INT, default=date.today().day)
 @click.argument('balance')
+@archive_errors
+@writes
 def create_account_balance_entry(account_id, year, month, day, balance):
-    init_db()
-    account = Account.get(Account.id == account_id)
-    balance_date = date(year, month, day)
-    balance_decimal = Decimal(balance)
-    balance_entry = AccountBalance(
-        account=account,
-        date=balance_date,
-        balance=balance_decimal
-    )
-    balance_entry.save()
+    try:
+        ledger.add_balance_entry(account_id, date(year, month, day), balance)
+    except ValueError as error:
+        raise click.ClickException(str(error))
 
 
 @cli.command()
@@ -162,51 +179,34 @@ def create_account_balance_entry(account_id, year, month, day, balance):
 @click.argument('month', type=click.INT, default=date.today().month)
 @click.argument('day', type=click.INT, default=date.today().day)
 def list_account_balance_entries(year, month, day):
-    init_db()
-    balance_date = date(year, month, day)
-    account_balance_entries = AccountBalance.select().where(AccountBalance.date == balance_date)
-    for entry in account_balance_entries:
+    for entry in ledger.balance_entries_on(date(year, month, day)):
         click.echo('#{0} "{1}" {2} {3} {4}'.format(entry.id, entry.account.name, entry.date, entry.balance, entry.account.currency.sign))
 
 
+@cli.command('balance_at')
+@click.argument('account_id', type=click.INT)
+@click.argument('year', type=click.INT, default=date.today().year)
+@click.argument('month', type=click.INT, default=date.today().month)
+@click.argument('day', type=click.INT, default=date.today().day)
+def show_balance_at(account_id, year, month, day):
+    try:
+        account = ledger.account(account_id)
+    except KeyError:
+        raise click.ClickException('Unknown account #{0}'.format(account_id))
+    balance_date = date(year, month, day)
+    balance = ledger.balances_on(balance_date, [account_id])[account_id]
+    click.echo('#{0} "{1}" {2} {3} {4}'.format(account.id, account.name, balance_date, balance, account.currency.sign))
+
+
 @cli.command()
 @click.argument('year', type=click.INT, default=date.today().year)
 @click.argument('month', type=click.INT, default=date.today().month)
 @click.argument('day', type=click.INT, default=date.today().day)
+@archive_errors
+@writes
 def update_account_balance_entries(year, month, day):
-    init_db()
     date_cur = date(year, month, day)
-    date_day_before = date_cur - timedelta(days=1)
-    for account in Account.select():
-        try:
-            balance_cur = AccountBalance.select().where(AccountBalance.account == account).where(AccountBalance.date == date_cur).get()
-            click.echo('#{0} "{1}" {2} {3} {4}'.format(balance_cur.id, balance_cur.account.name, balance_cur.date, balance_cur.balance, balance_cur.account.currency.sign))
-        except AccountBalance.DoesNotExist:
-            try:
-                balance_day_before = AccountBalance.select().where(AccountBalance.account == account).where(AccountBalance.date == date_day_before).get()
-                transactions = AccountTransaction.select().where(
-                    AccountTransaction.account == account
-                ).where(
-                    AccountTransaction.timestamp.year == date_day_before.year
-                ).where(
-                    AccountTransaction.timestamp.month == date_day_before.month
-                ).where(
-                    AccountTransaction.timestamp.day == date_day_before.day
-                )
-                balance = balance_day_before.balance
-                for transaction in transactions:
-                    if transaction.type in (TransactionType.DEBIT, TransactionType.TRANSFER_OUT):
-                        balance = (balance - transaction.amount).quantize(Decimal('.01'))
-                    elif transaction.type in (TransactionType.CREDIT, TransactionType.TRANSFER_IN):
-                        balance = (balance + transaction.amount).quantize(Decimal('.01'))
-                balance_entry = AccountBalance(
-                    account=account,
-                    date=date_cur,
-                    balance=balance
-                )
-                balance_entry.save()
-            except AccountBalance.DoesNotExist:
-                print('Not OK')
+    echo_rolled_balances(ledger.roll_forward_balances(date_cur, date_cur))
 
 
 @cli.command()
@@ -220,20 +220,113 @@ def update_account_balance_entries(year, month, day):
 @click.argument('hour', type=click.INT, default=datetime.now().hour)
 @click.argument('minute', type=click.INT, default=datetime.now().minute)
 @click.argument('second', type=click.INT, default=datetime.now().second)
+@archive_errors
+@writes
 def create_account_transaction(account_id, type, amount, comment, year, month, day, hour, minute, second):
-    init_db()
-    account = Account.get(Account.id == account_id)
     timestamp = datetime(year, month, day, hour, minute, second)
-    amount_decimal = Decimal(amount)
-    object_type = TransactionType[type]
-    transaction = AccountTransaction(
-        account=account,
-        timestamp=timestamp,
-        type=object_type.value,
-        amount=amount_decimal,
-        comment=comment
+    try:
+        ledger.add_transaction(account_id, timestamp, TransactionType[type], amount, comment)
+    except ValueError as error:
+        raise click.ClickException(str(error))
+
+
+@cli.command()
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'statement_format', type=click.Choice(['csv', 'ofx']))
+@click.option('--account-id', type=click.INT)
+@click.option('--encoding', default='utf-8')
+@click.option('--batch-size', type=click.INT, default=1000)
+@archive_errors
+def import_transactions(path, statement_format, account_id, encoding, batch_size):
+    import io
+    import time
+    from finctrl.importers import READERS, names_accounts
+
+    if statement_format is None:
+        statement_format = 'ofx' if path.lower().endswith('.ofx') else 'csv'
+    if account_id is not None:
+        try:
+            ledger.account(account_id)
+        except KeyError:
+            raise click.BadParameter('no account #{0}'.format(account_id), param_hint='--account-id')
+    time_start = time.time()
+    total_read = 0
+    total_inserted = 0
+    with io.open(path, encoding=encoding, newline='') as fp:
+        if account_id is None and not names_accounts(statement_format, fp):
+            raise click.BadParameter('required, the lines of {0} name no account'.format(path), param_hint='--account-id')
+        fp.seek(0)
+        rows = ledger.statement_rows(READERS[statement_format](fp), account_id)
+        try:
+            for read, inserted in ledger.import_transaction_rows(rows, batch_size):
+                total_read += read
+                total_inserted += inserted
+                click.echo('{0} rows read, {1} imported'.format(total_read, total_inserted), err=True)
+        except ValueError as error:
+            raise click.ClickException('{0} ({1} rows read, {2} imported)'.format(error, total_read, total_inserted))
+    elapsed = time.time() - time_start
+    click.echo('Imported {0} of {1} transactions ({2} duplicates) in {3:.2f}s, {4:.0f} rows/s'.format(
+        total_inserted,
+        total_read,
+        total_read - total_inserted,
+        elapsed,
+        total_read / elapsed if elapsed else 0
+    ))
+
+
+@cli.command()
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--encoding', default='utf-8')
+@writes
+def import_exchange_rates(path, encoding):
+    import io
+    from finctrl.importers import read_exchange_rates
+
+    with io.open(path, encoding=encoding, newline='') as fp:
+        try:
+            written = ledger.add_exchange_rates(read_exchange_rates(fp))
+        except (ledger.ExchangeRateError, ValueError) as error:
+            raise click.ClickException(str(error))
+    click.echo('Imported {0} exchange rates'.format(written))
+
+
+@cli.command()
+@click.argument('kind', type=click.Choice(['transactions', 'balances', 'accounts']))
+@click.option('--format', 'export_format', type=click.Choice(['csv', 'jsonl']), default='csv')
+@click.option('--output', default='-')
+@click.option('--account-id', type=click.INT, multiple=True)
+@click.option('--start-date', callback=parse_date_option)
+@click.option('--end-date', callback=parse_date_option)
+def export(kind, export_format, output, account_id, start_date, end_date):
+    import io
+
+    rows = ledger.export_rows(
+        kind,
+        account_ids=list(account_id),
+        date_start=start_date,
+        date_end=end_date
     )
-    transaction.save()
+    columns = ledger.EXPORT_COLUMNS[kind]
+    if output == '-':
+        fp = click.get_text_stream('stdout')
+    else:
+        fp = io.open(output, 'w', encoding='utf-8', newline='', buffering=1 << 16)
+    try:
+        if export_format == 'csv':
+            import csv
+            writer = csv.writer(fp)
+            writer.writerow(columns)
+            writer.writerows(rows)
+        else:
+            import json
+            for row in rows:
+                fp.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+                fp.write('\n')
+    finally:
+        if output == '-':
+            fp.flush()
+        else:
+            fp.close()
 
 
 @cli.command()
@@ -241,105 +334,79 @@ def create_account_transaction(account_id, type, amount, comment, year, month, d
 @click.argument('month', type=click.INT, default=date.today().month)
 @click.argument('day', type=click.INT, default=date.today().day)
 def list_account_transactions(year, month, day):
-    init_db()
-    balance_date = date(year, month, day)
-    account_transactions = AccountTransaction.select().where(
-        AccountTransaction.timestamp.year == balance_date.year
-    ).where(
-        AccountTransaction.timestamp.month == balance_date.month
-    ).where(
-        AccountTransaction.timestamp.day == balance_date.day
-    )
-    for entry in account_transactions:
-        click.echo('#{0} "{1}" {2} {3} {4} {5} "{6}"'.format(entry.id, entry.account.name, entry.timestamp, TransactionType(entry.type).name, entry.amount, entry.account.currency.sign, entry.comment))
+    date_start, date_end = ledger.day_range(date(year, month, day))
+    echo_transactions(ledger.transactions(date_start, date_end))
 
 
 @cli.command()
 @click.argument('year', type=click.INT, default=date.today().year)
 @click.argument('month', type=click.INT, default=date.today().month)
 def list_account_transactions_month(year, month):
-    init_db()
-    balance_date = date(year, month, 1)
-    account_transactions = AccountTransaction.select().where(
-        AccountTransaction.timestamp.year == balance_date.year
-    ).where(
-        AccountTransaction.timestamp.month == balance_date.month
-    )
-    for entry in account_transactions:
-        click.echo('#{0} "{1}" {2} {3} {4} {5} "{6}"'.format(entry.id, entry.account.name, entry.timestamp, TransactionType(entry.type).name, entry.amount, entry.account.currency.sign, entry.comment))
+    date_start, date_end = ledger.month_range(year, month)
+    echo_transactions(ledger.transactions(date_start, date_end))
 
 
 @cli.command()
-@click.argument('transaction_id', click.INT)
+@click.argument('transaction_id', type=click.INT)
+@archive_errors
+@writes
 def remove_account_transaction(transaction_id):
-    init_db()
-    transaction = AccountTransaction.get(AccountTransaction.id == transaction_id)
-    transaction.delete_instance()
+    ledger.remove_transaction(transaction_id)
 
 
 @cli.command()
-@click.argument('account_id', click.INT)
+@click.argument('account_id', type=click.INT)
+@archive_errors
+@writes
 def remove_account(account_id):
-    init_db()
-    account = Account.get(Account.id == account_id)
-    account.delete_instance()
+    ledger.remove_account(account_id)
 
 
 @cli.command()
-@click.argument('entry_id', click.INT)
+@click.argument('entry_id', type=click.INT)
+@archive_errors
+@writes
 def remove_account_balance_entry(entry_id):
-    init_db()
-    transaction = AccountBalance.get(AccountBalance.id == entry_id)
-    transaction.delete_instance()
+    ledger.remove_balance_entry(entry_id)
 
 
 @cli.command()
 @click.argument('year', type=click.INT, default=date.today().year)
 @click.argument('month', type=click.INT, default=date.today().month)
-def show_monthly_report(year, month):
-    init_db()
-    account_transactions = AccountTransaction.select().where(
-        AccountTransaction.timestamp.year == year
-    ).where(
-        AccountTransaction.timestamp.month == month
-    )
-
-    monthly_credit = {}
-    monthly_debit = {}
-
-    for entry in account_transactions:
-        if entry.type == TransactionType.DEBIT:
-            if entry.account.currency not in monthly_debit:
-                monthly_debit[entry.account.currency] = Decimal('0.00')
-            monthly_debit[entry.account.currency] += entry.amount
-        elif entry.type == TransactionType.CREDIT:
-            if entry.account.currency not in monthly_credit:
-                monthly_credit[entry.account.currency] = Decimal('0.00')
-            monthly_credit[entry.account.currency] += entry.amount
+@click.option('--currency', 'currency_code')
+def show_monthly_report(year, month, currency_code):
+    if currency_code:
+        try:
+            totals = ledger.consolidated_monthly_totals((year, month), (year, month), currency_code)
+        except ledger.ExchangeRateError as error:
+            raise click.ClickException(str(error))
+    else:
+        totals = ledger.monthly_totals((year, month), (year, month))
 
-    for currency, amount in monthly_credit.items():
-        click.echo('CREDIT: {0} {1}'.format(amount, currency.sign))
+    for total in totals:
+        if total.type == TransactionType.CREDIT:
+            click.echo('CREDIT: {0} {1}'.format(total.amount, total.currency.sign))
 
-    for currency, amount in monthly_debit.items():
-        click.echo('DEBIT: {0} {1}'.format(amount, currency.sign))
+    for total in totals:
+        if total.type == TransactionType.DEBIT:
+            click.echo('DEBIT: {0} {1}'.format(total.amount, total.currency.sign))
 
 
 @cli.command()
 @click.argument('year', type=click.INT, default=date.today().year)
 @click.argument('month', type=click.INT, default=date.today().month)
 @click.argument('day', type=click.INT, default=date.today().day)
-def show_balance_report(year, month, day):
-    init_db()
-    balance_date = date(year, month, day)
-    account_balance_entries = AccountBalance.select().where(AccountBalance.date == balance_date)
-    balance_map = {}
-    for entry in account_balance_entries:
-        if entry.account.currency not in balance_map:
-            balance_map[entry.account.currency] = Decimal('0.00')
-        balance_map[entry.account.currency] += entry.balance
-
-    for currency, balance in balance_map.items():
-        click.echo('{0} - {1} {2}'.format(currency.code, balance, currency.sign))
+@click.option('--currency', 'currency_code')
+def show_balance_report(year, month, day, currency_code):
+    if currency_code:
+        try:
+            totals = [ledger.consolidated_balance_on(date(year, month, day), currency_code)]
+        except ledger.ExchangeRateError as error:
+            raise click.ClickException(str(error))
+    else:
+        totals = ledger.balance_totals_on(date(year, month, day))
+    for total in totals:
+        click.echo('{0} - {1} {2}'.format(total.currency.code, total.balance, total.currency.sign))
 
 
 @cli.command()
@@ -349,126 +416,82 @@ def show_balance_report(year, month, day):
 @click.argument('end_month', type=click.INT)
 @click.argument('exclude_accounts', default='0')
 @click.argument('exclude_transactions', default='0')
+@click.option('--list-transactions', is_flag=True)
 def show_average_overview(start_year, start_month, end_year, end_month,
-                          exclude_accounts, exclude_transactions):
-    init_db()
-
-    start_day = 1
-    start_date = date(start_year, start_month, start_day)
-    _, end_day = monthrange(end_year, end_month)
-    end_date = date(end_year, end_month, end_day)
-    # click.echo(start_date)
-    # click.echo(end_date)
-
-    num_months = 0
-    ndx_date = start_date
-    while True:
-        num_months += 1
-        if ndx_date.year == end_year and ndx_date.month == end_month:
-            break
-        _, num_days = monthrange(ndx_date.year, ndx_date.month)
-        ndx_date = ndx_date + timedelta(days=num_days)
-    # click.echo(num_months)
+                          exclude_accounts, exclude_transactions, list_transactions):
+    num_months = (end_year - start_year) * 12 + end_month - start_month + 1
     exclude_accounts = [int(x) for x in exclude_accounts.split(',')]
-    # click.echo(exclude_accounts)
     exclude_transactions = [int(x) for x in exclude_transactions.split(',')]
 
-    account_transactions = AccountTransaction.select().where(
-        AccountTransaction.timestamp >= start_date
-    ).where(
-        AccountTransaction.timestamp <= end_date
-    ).where(
-        AccountTransaction.account_id.not_in(exclude_accounts)
-    ).where(
-        AccountTransaction.id.not_in(exclude_transactions)
+    if list_transactions:
+        date_start, _ = ledger.month_range(start_year, start_month)
+        _, date_end = ledger.month_range(end_year, end_month)
+        echo_transactions(ledger.transactions(
+            date_start,
+            date_end,
+            types=[TransactionType.DEBIT, TransactionType.CREDIT],
+            exclude_accounts=exclude_accounts,
+            exclude_ids=exclude_transactions
+        ))
+
+    totals = ledger.monthly_totals(
+        (start_year, start_month),
+        (end_year, end_month),
+        exclude_accounts=exclude_accounts,
+        exclude_ids=exclude_transactions
     )
 
-    total_credit = {}
-    total_debit = {}
+    # Averages are truncated to the minor unit of the currency.
+    for total in totals:
+        if total.type == TransactionType.CREDIT:
+            click.echo('CREDIT: {0} {1}'.format(total.amount, total.currency.sign))
+            click.echo('CREDIT AVG: {0} {1}'.format((total.amount / num_months).quantize(total.amount, ROUND_DOWN), total.currency.sign))
+
+    for total in totals:
+        if total.type == TransactionType.DEBIT:
+            click.echo('DEBIT: {0} {1}'.format(total.amount, total.currency.sign))
+            click.echo('DEBIT AVG: {0} {1}'.format((total.amount / num_months).quantize(total.amount, ROUND_DOWN), total.currency.sign))
+
 
-    for entry in account_transactions:
-        if entry.type == TransactionType.DEBIT:
-            if entry.account.currency not in total_debit:
-                total_debit[entry.account.currency] = Decimal('0.00')
-            total_debit[entry.account.currency] += entry.amount
-            click.echo('#{0} "{1}" {2} {3} {4} {5} "{6}"'.format(entry.id, entry.account.name, entry.timestamp, TransactionType(entry.type).name, entry.amount, entry.account.currency.sign, entry.comment))
-        elif entry.type == TransactionType.CREDIT:
-            if entry.account.currency not in total_credit:
-                total_credit[entry.account.currency] = Decimal('0.00')
-            total_credit[entry.account.currency] += entry.amount
-            click.echo('#{0} "{1}" {2} {3} {4} {5} "{6}"'.format(entry.id, entry.account.name, entry.timestamp, TransactionType(entry.type).name, entry.amount, entry.account.currency.sign, entry.comment))
+@cli.command()
+@writes
+def rebuild_aggregates():
+    click.echo('Rebuilt {0} monthly aggregates'.format(ledger.rebuild_aggregates()))
 
-    for currency, amount in total_credit.items():
-        click.echo('CREDIT: {0} {1}'.format(amount, currency.sign))
-        click.echo('CREDIT AVG: {0} {1}'.format(Decimal(amount / num_months).quantize(Decimal('.01'), rounding=ROUND_DOWN), currency.sign))
 
-    for currency, amount in total_debit.items():
-        click.echo('DEBIT: {0} {1}'.format(amount, currency.sign))
-        click.echo('DEBIT AVG: {0} {1}'.format(Decimal(amount / num_months).quantize(Decimal('.01'), rounding=ROUND_DOWN), currency.sign))
+@cli.command()
+@click.argument('year', type=click.INT)
+@archive_errors
+def archive_year(year):
+    archived = ledger.archive_year(year)
+    click.echo('Archived {0} transactions and {1} balance entries of {2} into {3}'.format(
+        archived.transactions, archived.balances, archived.year, archived.path
+    ))
 
 
 @cli.command()
-@click.argument('account_id', click.INT)
+@click.argument('account_id', type=click.INT)
 @click.argument('start_year', type=click.INT, default=date.today().year)
 @click.argument('start_month', type=click.INT, default=date.today().month)
 @click.argument('start_day', type=click.INT, default=date.today().day)
+@archive_errors
+@writes
 def remove_account_balance_entry_series(account_id, start_year, start_month, start_day):
-    init_db()
-    balance_date = date(start_year, start_month, start_day)
-    account_balance_entries = AccountBalance.select().where(
-        AccountBalance.account_id == account_id
-    ).where(
-        AccountBalance.date >= balance_date
-    )
-    for entry in account_balance_entries:
-        entry.delete_instance()
+    ledger.remove_balance_entries(account_id, date(start_year, start_month, start_day))
 
 
 @cli.command()
 @click.argument('year', type=click.INT, default=date.today().year)
 @click.argument('month', type=click.INT, default=date.today().month)
 @click.argument('day', type=click.INT, default=date.today().day)
+@archive_errors
+@writes
 def update_account_balance_entry_series(year, month, day):
-    init_db()
-    date_today = date.today()
-    date_cur = date(year, month, day)
-    while date_cur <= date_today:
-        date_day_before = date_cur - timedelta(days=1)
-        for account in Account.select():
-            try:
-                balance_cur = AccountBalance.select().where(AccountBalance.account == account).where(AccountBalance.date == date_cur).get()
-                click.echo('#{0} "{1}" {2} {3} {4}'.format(balance_cur.id, balance_cur.account.name, balance_cur.date, balance_cur.balance, balance_cur.account.currency.sign))
-            except AccountBalance.DoesNotExist:
-                try:
-                    balance_day_before = AccountBalance.select().where(AccountBalance.account == account).where(AccountBalance.date == date_day_before).get()
-                    transactions = AccountTransaction.select().where(
-                        AccountTransaction.account == account
-                    ).where(
-                        AccountTransaction.timestamp.year == date_day_before.year
-                    ).where(
-                        AccountTransaction.timestamp.month == date_day_before.month
-                    ).where(
-                        AccountTransaction.timestamp.day == date_day_before.day
-                    )
-                    balance = balance_day_before.balance
-                    for transaction in transactions:
-                        if transaction.type in (TransactionType.DEBIT, TransactionType.TRANSFER_OUT):
-                            balance = (balance - transaction.amount).quantize(Decimal('.01'))
-                        elif transaction.type in (TransactionType.CREDIT, TransactionType.TRANSFER_IN):
-                            balance = (balance + transaction.amount).quantize(Decimal('.01'))
-                    balance_entry = AccountBalance(
-                        account=account,
-                        date=date_cur,
-                        balance=balance
-                    )
-                    balance_entry.save()
-                except AccountBalance.DoesNotExist:
-                    print('Not OK')
-        date_cur = date_cur + timedelta(days=1)
+    echo_rolled_balances(ledger.roll_forward_balances(date(year, month, day), date.today()))
 
 
 @cli.command()
-@click.argument('account_id', click.INT)
+@click.argument('account_id', type=click.INT)
 @click.argument('start_year', type=click.INT)
 @click.argument('start_month', type=click.INT)
 @click.argument('start_day', type=click.INT)
@@ -476,57 +499,63 @@ def update_account_balance_entry_series(year, month, day):
 @click.argument('end_month', type=click.INT)
 @click.argument('end_day', type=click.INT)
 def make_account_report(account_id, start_year, start_month, start_day, end_year, end_month, end_day):
-    init_db()
-    date_start = date(start_year, start_month, start_day)
-    date_end = date(end_year, end_month, end_day)
-
-    start_balance_query = AccountBalance.select().where(
-        AccountBalance.account_id == account_id,
-        AccountBalance.date == date_start
-    )
+    try:
+        report = ledger.account_report(
+            account_id,
+            date(start_year, start_month, start_day),
+            date(end_year, end_month, end_day)
+        )
+    except ValueError as error:
+        raise click.ClickException(str(error))
+    print(report.date_start, report.opening)
+    print('credit', report.credit)
+    print('debit', report.debit)
+    print(report.date_end, report.closing)
 
-    if start_balance_query.count() == 1:
-        start_balance = start_balance_query.get().balance
-    else:
-        start_balance = Decimal('0.00')
-
-    end_balance_query = AccountBalance.select().where(
-        AccountBalance.account_id == account_id,
-        AccountBalance.date == date_end
-    )
 
-    if end_balance_query.count() == 1:
-        end_balance = end_balance_query.get().balance
-    else:
-        end_balance = Decimal('0.00')
-
-    balance = start_balance
-
-    account_transactions = AccountTransaction.select().where(
-        AccountTransaction.timestamp >= date_start
-    ).where(
-        AccountTransaction.timestamp < date_end
-    ).where(
-        AccountTransaction.account_id == account_id
-    )
-
-    credit = Decimal('0.00')
-    debit = Decimal('0.00')
-
-    for entry in account_transactions:
-        if entry.type == TransactionType.DEBIT or entry.type == TransactionType.TRANSFER_OUT:
-            debit += entry.amount
-        if entry.type == TransactionType.CREDIT or entry.type == TransactionType.TRANSFER_IN:
-            credit += entry.amount
-
-    print(date_start, start_balance)
-    print('credit', credit)
-    print('debit', debit)
-    print(date_end, end_balance)
+@cli.command()
+@click.argument('start_year', type=click.INT)
+@click.argument('start_month', type=click.INT)
+@click.argument('start_day', type=click.INT)
+@click.argument('end_year', type=click.INT)
+@click.argument('end_month', type=click.INT)
+@click.argument('end_day', type=click.INT)
+@click.option('--account-id', type=click.INT, multiple=True)
+@click.option('--workers', type=click.IntRange(min=1), default=1)
+def make_accounts_report(start_year, start_month, start_day, end_year, end_month, end_day, account_id, workers):
+    # Accounts whose closing balance is not the opening balance plus the
+    # flows are marked, and the command then exits with status 1.
+    try:
+        reports = ledger.accounts_report(
+            date(start_year, start_month, start_day),
+            date(end_year, end_month, end_day),
+            accounts=list(account_id) or None,
+            workers=workers
+        )
+    except ValueError as error:
+        raise click.ClickException(str(error))
+    mismatched = 0
+    for report in reports:
+        click.echo('#{0} "{1}" opening {2} credit {3} debit {4} transfer_in {5} transfer_out {6} closing {7} {8}{9}'.format(
+            report.account.id,
+            report.account.name,
+            report.opening,
+            report.credit,
+            report.debit,
+            report.transfer_in,
+            report.transfer_out,
+            report.closing,
+            report.account.currency.sign,
+            ' MISMATCH {0}'.format(report.discrepancy) if report.discrepancy else ''
+        ))
+        if report.discrepancy:
+            mismatched += 1
+    if mismatched:
+        raise click.ClickException('{0} of {1} accounts do not reconcile'.format(mismatched, len(reports)))
 
 
 @cli.command()
-@click.argument('account_id', click.INT)
+@click.argument('account_id', type=click.INT)
 @click.argument('start_year', type=click.INT)
 @click.argument('start_month', type=click.INT)
 @click.argument('start_day', type=click.INT)
@@ -534,20 +563,284 @@ def make_account_report(account_id, start_year, start_month, start_day, end_year
 @click.argument('end_month', type=click.INT)
 @click.argument('end_day', type=click.INT)
 def list_account_transactions_series(account_id, start_year, start_month, start_day, end_year, end_month, end_day):
-    init_db()
     date_start = date(start_year, start_month, start_day)
     date_end = date(end_year, end_month, end_day)
+    echo_transactions(ledger.transactions(date_start, date_end, accounts=[account_id]))
+
+
+@cli.command()
+@click.argument('query')
+@click.option('--account-id', type=click.INT, multiple=True)
+@click.option('--start-date', 'date_start', callback=parse_date_option)
+@click.option('--end-date', 'date_end', callback=parse_date_option)
+@click.option('--limit', type=click.IntRange(min=1), default=20)
+@click.option('--page', type=click.IntRange(min=1), default=1)
+def search_transactions(query, account_id, date_start, date_end, limit, page):
+    # Words match whole words, "quoted words" a phrase and word* a prefix.
+    # Results come best match first, unless there are too many matches to
+    # rank them all.
+    ranked = ledger.search_is_ranked(query, list(account_id), date_start, date_end)
+    if not ranked:
+        click.echo('More than {0} matches, listed most recently recorded first'.format(ledger.RANKED_SEARCH_LIMIT), err=True)
+    echo_transactions(ledger.search_transactions(
+        query,
+        accounts=list(account_id),
+        date_start=date_start,
+        date_end=date_end,
+        limit=limit,
+        offset=(page - 1) * limit,
+        ranked=ranked
+    ))
+
+
+@cli.command()
+@click.argument('start_year', type=click.INT)
+@click.argument('start_month', type=click.INT)
+@click.argument('start_day', type=click.INT)
+@click.argument('end_year', type=click.INT, default=date.today().year)
+@click.argument('end_month', type=click.INT, default=date.today().month)
+@click.argument('end_day', type=click.INT, default=date.today().day)
+@click.option('--account-id', type=click.INT, multiple=True)
+@click.option('--currency', 'currency_code')
+@click.option('--totals-only', is_flag=True)
+@click.option('--format', 'output_format', type=click.Choice(['csv', 'json']), default='csv')
+@click.option('--output', default='-')
+def timeseries(start_year, start_month, start_day, end_year, end_month, end_day, account_id, currency_code, totals_only, output_format, output):
+    import io
+
+    try:
+        series = ledger.balance_timeseries(
+            date(start_year, start_month, start_day),
+            date(end_year, end_month, end_day),
+            accounts=list(account_id) or None,
+            currency_code=currency_code
+        )
+    except (ledger.ExchangeRateError, ValueError) as error:
+        raise click.ClickException(str(error))
+
+    # (name, values, decimal places) for every output column after the date.
+    columns = []
+    if not totals_only:
+        for account, balances in zip(series.accounts, series.balances):
+            columns.append(('#{0} {1}'.format(account.id, account.name), balances, account.currency.exponent))
+    for row, currency in enumerate(series.currencies):
+        for name, values in (
+            ('total', series.totals),
+            ('avg30', series.average_30),
+            ('avg90', series.average_90),
+            ('mom', series.month_change)
+        ):
+            columns.append(('{0} {1}'.format(name, currency.code), values[row], currency.exponent))
+
+    if output == '-':
+        fp = click.get_text_stream('stdout')
+    else:
+        fp = io.open(output, 'w', encoding='utf-8', newline='', buffering=1 << 16)
+    try:
+        days = [str(day) for day in series.days]
+        if output_format == 'csv':
+            import csv
+            writer = csv.writer(fp)
+            writer.writerow(['date'] + [name for name, _, _ in columns])
+            writer.writerows(zip(days, *[
+                ['{0:.{1}f}'.format(value, places) for value in values.tolist()]
+                for _, values, places in columns
+            ]))
+        else:
+            import json
+            json.dump({
+                'days': days,
+                'columns': [
+                    {'name': name, 'values': [round(value, places) for value in values.tolist()]}
+                    for name, values, places in columns
+                ]
+            }, fp, ensure_ascii=False)
+            fp.write('\n')
+    finally:
+        if output == '-':
+            fp.flush()
+        else:
+            fp.close()
+
+
+@cli.command('snapshot')
+@click.option('--path', type=click.Path(file_okay=False))
+@click.option('--rebuild', is_flag=True)
+def write_snapshot(path, rebuild):
+    # Writes the transactions to a columnar snapshot next to the database,
+    # or appends the ones added since the last run.
+    from finctrl.snapshot import snapshot_path, update_snapshot
+
+    if path is None:
+        path = snapshot_path(ledger.db.database)
+    header, written = update_snapshot(path, rebuild)
+    click.echo('Snapshot of {0} transactions in {1}, {2} written'.format(header['rows'], path, written))
+
 
-    account_transactions = AccountTransaction.select().where(
-        AccountTransaction.timestamp >= date_start
-    ).where(
-        AccountTransaction.timestamp < date_end
-    ).where(
-        AccountTransaction.account_id == account_id
+@cli.command()
+@click.option('--host', default='127.0.0.1')
+@click.option('--port', type=click.INT, default=8080)
+@click.option('--socket', 'socket_path', type=click.Path(dir_okay=False))
+@click.option('--workers', type=click.INT, default=4)
+@click.option('--cache-size', type=click.INT, default=256)
+def serve(host, port, socket_path, workers, cache_size):
+    from finctrl.server import serve as run_server
+
+    run_server(
+        host=host,
+        port=port,
+        socket_path=socket_path,
+        workers=workers,
+        cache_size=cache_size,
+        ready=lambda address: click.echo('Serving on {0}'.format(address), err=True)
     )
 
-    for entry in account_transactions:
-        click.echo('#{0} "{1}" {2} {3} {4} {5} "{6}"'.format(entry.id, entry.account.name, entry.timestamp, TransactionType(entry.type).name, entry.amount, entry.account.currency.sign, entry.comment))
+
+def script_commands(lines, script_format=None):
+    # Yields (line number, argv) from either shell-like lines such as
+    #     create_account_transaction 1 DEBIT 12.34 "coffee" 2024 1 1 10 0 0
+    # or JSON objects such as
+    #     {"command": "import_transactions", "args": ["a.csv"], "account_id": 1}
+    # where every key other than command and args becomes an option. Blank
+    # lines and lines starting with # are skipped. A line that cannot be
+    # parsed yields a UsageError in place of argv, so that it fails its group
+    # like a failing command.
+    import json
+    import shlex
+
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            if script_format == 'json' or (script_format is None and line.startswith('{')):
+                argv = json_script_argv(json.loads(line))
+            else:
+                argv = shlex.split(line)
+            if not argv:
+                raise ValueError('no command')
+        except ValueError as error:
+            yield number, click.UsageError('cannot be parsed: {0}'.format(error))
+            continue
+        yield number, argv
+
+
+def json_script_argv(fields):
+    if not isinstance(fields, dict) or not isinstance(fields.get('command'), str):
+        raise ValueError('expected an object with a "command" string')
+    args = fields.pop('args', [])
+    if not isinstance(args, list):
+        raise ValueError('"args" must be a list')
+    argv = [fields.pop('command')] + [str(arg) for arg in args]
+    for name, value in sorted(fields.items()):
+        option = '--' + name.replace('_', '-')
+        if value is True:
+            argv.append(option)
+        elif isinstance(value, list):
+            for item in value:
+                argv.extend([option, str(item)])
+        elif value is not None and value is not False:
+            argv.extend([option, str(value)])
+    return argv
+
+
+def run_script_command(argv):
+    # Commands of a batch run inside the transaction of their group. Some
+    # cannot: archiving attaches and vacuums files, serve never returns and
+    # a snapshot is written outside the database, where a rollback would
+    # not take it back.
+    command = cli.commands.get(argv[0])
+    if command is None:
+        raise click.UsageError('No such command "{0}"'.format(argv[0]))
+    if command in (archive_year, batch, serve, write_snapshot):
+        raise click.UsageError('{0} cannot run in a batch'.format(argv[0]))
+    command.main(argv[1:], prog_name=argv[0], standalone_mode=False)
+
+
+@cli.command()
+@click.argument('path', default='-')
+@click.option('--format', 'script_format', type=click.Choice(['lines', 'json']))
+@click.option('--group-size', type=click.INT, default=1000)
+@click.option('--keep-going', is_flag=True)
+def batch(path, script_format, group_size, keep_going):
+    import io
+    import time
+
+    if path == '-':
+        fp = click.get_text_stream('stdin')
+    else:
+        fp = io.open(path, encoding='utf-8')
+
+    # Every group of commands runs in one transaction: nested db.atomic()
+    # blocks inside the commands become savepoints, and a failing command
+    # rolls back the whole group.
+    timings = defaultdict(list)
+    executed = 0
+    failed_groups = 0
+    time_start = time.time()
+    try:
+        for group in ledger.chunked(script_commands(fp, script_format), group_size):
+            group_timings = []
+            first, last = group[0][0], group[-1][0]
+            # The line running, or None while the transaction itself begins
+            # or commits.
+            failing = None
+            try:
+                with ledger.db.atomic():
+                    for number, argv in group:
+                        failing = number, argv
+                        if isinstance(argv, click.UsageError):
+                            raise argv
+                        command_start = time.time()
+                        run_script_command(argv)
+                        group_timings.append((argv[0], time.time() - command_start))
+                    failing = None
+            except Exception as error:
+                # Rows cached by the identity map may have been rolled back.
+                ledger.identity_map.clear()
+                failed_groups += 1
+                if failing is None:
+                    message = 'Lines {0}-{1} failed with {2}: {3}. Rolled back lines {0}-{1}'.format(
+                        first, last, type(error).__name__, error
+                    )
+                else:
+                    number, argv = failing
+                    message = 'Line {0}{1} failed with {2}: {3}. Rolled back lines {4}-{5}'.format(
+                        number,
+                        ' ({0})'.format(argv[0]) if isinstance(argv, list) else '',
+                        type(error).__name__,
+                        error,
+                        first,
+                        last
+                    )
+                if not keep_going:
+                    raise click.ClickException(message)
+                click.echo(message, err=True)
+                continue
+            for name, elapsed in group_timings:
+                timings[name].append(elapsed)
+            executed += len(group_timings)
+    finally:
+        if path != '-':
+            fp.close()
+
+    elapsed = time.time() - time_start
+    for name in sorted(timings):
+        command_timings = timings[name]
+        click.echo('{0}: {1} runs, avg {2:.2f} ms, max {3:.2f} ms'.format(
+            name,
+            len(command_timings),
+            sum(command_timings) * 1000 / len(command_timings),
+            max(command_timings) * 1000
+        ), err=True)
+    click.echo('Executed {0} commands in {1:.2f}s, {2:.0f} commands/s{3}'.format(
+        executed,
+        elapsed,
+        executed / elapsed if elapsed else 0,
+        ', {0} groups rolled back'.format(failed_groups) if failed_groups else ''
+    ), err=True)
+    if failed_groups:
+        click.get_current_context().exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,139 @@
+import csv
+import re
+from collections import namedtuple
+from datetime import datetime
+from decimal import Decimal
+
+# A single transaction read from a bank statement. type is the name of a
+# TransactionType or None, in which case the sign of amount decides it.
+# line_number is where it ends in the statement file.
+StatementLine = namedtuple('StatementLine', ['account', 'timestamp', 'type', 'amount', 'comment', 'reference', 'line_number'])
+
+TIMESTAMP_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d')
+
+
+def parse_timestamp(value):
+    for timestamp_format in TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), timestamp_format)
+        except ValueError:
+            pass
+    raise ValueError('Unrecognized timestamp "{0}"'.format(value))
+
+
+def parse_amount(value):
+    try:
+        return Decimal(value.strip())
+    except ArithmeticError:
+        raise ValueError('Unrecognized amount "{0}"'.format(value))
+
+
+def read_csv(fp):
+    # Expected columns: timestamp, amount and optionally account_id, type,
+    # comment and reference. Lines that cannot be read raise ValueError.
+    reader = csv.DictReader(fp)
+    for row in reader:
+        try:
+            timestamp = parse_timestamp(row.get('timestamp') or '')
+            amount = parse_amount(row.get('amount') or '')
+        except ValueError as error:
+            raise ValueError('Line {0}: {1}'.format(reader.line_num, error))
+        yield StatementLine(
+            account=row.get('account_id') or None,
+            timestamp=timestamp,
+            type=row.get('type') or None,
+            amount=amount,
+            comment=row.get('comment') or '',
+            reference=row.get('reference') or None,
+            line_number=reader.line_num
+        )
+
+
+OFX_TAG_RE = re.compile(r'<(/?)([A-Z0-9.]+)>([^<\r\n]*)')
+
+
+def parse_ofx_timestamp(value):
+    digits = value.strip()[:14]
+    if len(digits) == 8:
+        return datetime.strptime(digits, '%Y%m%d')
+    return datetime.strptime(digits, '%Y%m%d%H%M%S')
+
+
+def ofx_transaction_type(trntype, amount):
+    if trntype == 'XFER':
+        return 'TRANSFER_OUT' if amount < 0 else 'TRANSFER_IN'
+    return None
+
+
+def read_ofx(fp):
+    # Handles both SGML (OFX 1.x, leaf elements left unclosed) and XML
+    # (OFX 2.x) statements, as long as tags do not span several lines.
+    fields = None
+    for line_number, line in enumerate(fp, 1):
+        for closing, tag, value in OFX_TAG_RE.findall(line):
+            if tag == 'STMTTRN':
+                if not closing:
+                    fields = {}
+                elif fields is not None:
+                    try:
+                        amount = parse_amount(fields.get('TRNAMT', ''))
+                        timestamp = parse_ofx_timestamp(fields.get('DTPOSTED', ''))
+                    except ValueError as error:
+                        raise ValueError('Line {0}: {1}'.format(line_number, error))
+                    yield StatementLine(
+                        account=None,
+                        timestamp=timestamp,
+                        type=ofx_transaction_type(fields.get('TRNTYPE'), amount),
+                        amount=amount,
+                        comment=fields.get('MEMO') or fields.get('NAME') or '',
+                        reference=fields.get('FITID'),
+                        line_number=line_number
+                    )
+                    fields = None
+            elif fields is not None and not closing:
+                fields[tag] = value.strip()
+
+
+READERS = {
+    'csv': read_csv,
+    'ofx': read_ofx
+}
+
+
+def names_accounts(statement_format, fp):
+    # Whether the lines of a statement say which account they belong to:
+    # only CSV statements can, with an account_id column. Reads the header
+    # of fp, which the caller rewinds.
+    if statement_format != 'csv':
+        return False
+    return 'account_id' in next(csv.reader(fp), [])
+
+
+# A row of an exchange rate file: currency code, date and rate.
+RateLine = namedtuple('RateLine', ['currency', 'date', 'rate'])
+
+
+def parse_rate(value):
+    try:
+        rate = Decimal(value.strip())
+    except ArithmeticError:
+        rate = None
+    if rate is None or not rate.is_finite() or rate <= 0:
+        raise ValueError('Unrecognized rate "{0}"'.format(value))
+    return rate
+
+
+def read_exchange_rates(fp):
+    # Expected columns: date, currency and rate. Lines that cannot be read
+    # raise ValueError.
+    reader = csv.DictReader(fp)
+    for row in reader:
+        try:
+            currency = (row.get('currency') or '').strip()
+            if not currency:
+                raise ValueError('no currency')
+            rate_date = parse_timestamp(row.get('date') or '').date()
+            rate = parse_rate(row.get('rate') or '')
+        except ValueError as error:
+            raise ValueError('Line {0}: {1}'.format(reader.line_num, error))
+        yield RateLine(currency=currency, date=rate_date, rate=rate)
@@ -0,0 +1,2097 @@
+from peewee import (
+    SqliteDatabase,
+    Model,
+    CharField,
+    ForeignKeyField,
+    DateField,
+    DateTimeField,
+    IntegerField,
+    BigIntegerField,
+    DoubleField,
+    TextField,
+    OperationalError,
+    fn
+)
+from playhouse.shortcuts import case
+
+import os
+import operator
+import random
+import re
+import time
+from collections import OrderedDict, defaultdict, namedtuple
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from enum import IntEnum
+from functools import reduce
+
+# Applied to every connection, in this order; use_database() takes
+# overrides. busy_timeout comes first since switching to WAL may have to wait
+# for a lock. WAL lets readers go on while a write is in progress, and
+# synchronous=NORMAL is enough there to survive application crashes.
+CONNECTION_PRAGMAS = (
+    ('busy_timeout', 5000),
+    ('journal_mode', 'wal'),
+    ('synchronous', 'normal'),
+    ('cache_size', -16000),
+    ('mmap_size', 1 << 28)
+)
+
+
+class LedgerDatabase(SqliteDatabase):
+    # Statements are handed to tracer, when one is set, which runs them and
+    # records what they cost; see finctrl.profiling.
+    tracer = None
+    connection_pragmas = CONNECTION_PRAGMAS
+    # BEGIN IMMEDIATE waits up to busy_timeout for the write lock; a writer
+    # holding it longer gets this many more attempts, each after a backoff
+    # of about begin_backoff * 2 ** attempt seconds.
+    begin_retries = 4
+    begin_backoff = 0.1
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        if self.tracer is None:
+            return super(LedgerDatabase, self).execute_sql(sql, params, require_commit)
+        return self.tracer.execute(super(LedgerDatabase, self).execute_sql, sql, params, require_commit)
+
+    def _add_conn_hooks(self, conn):
+        super(LedgerDatabase, self)._add_conn_hooks(conn)
+        for name, value in self.connection_pragmas:
+            conn.execute('PRAGMA {0} = {1}'.format(name, value)).fetchall()
+
+    def begin(self, lock_type=None):
+        # Transactions take the write lock up front unless told otherwise: a
+        # deferred one that reads first fails with "database is locked" when
+        # another process wrote in between, with no wait and no way to retry
+        # the statement alone.
+        for attempt in range(self.begin_retries + 1):
+            try:
+                return super(LedgerDatabase, self).begin(lock_type or 'IMMEDIATE')
+            except OperationalError as error:
+                if attempt == self.begin_retries or 'locked' not in str(error):
+                    raise
+            time.sleep(self.begin_backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+# Bound to a file by use_database(), which every caller must run first.
+db = LedgerDatabase(None)
+
+
+class Currency(Model):
+    name = CharField()
+    code = CharField()
+    sign = CharField()
+    exponent = IntegerField(default=2)
+
+    class Meta:
+        database = db
+
+
+class Account(Model):
+    name = CharField()
+    currency = ForeignKeyField(Currency, related_name='accounts')
+    # Balance entries dated on or after this day may be stale; see
+    # refresh_balances().
+    balances_dirty_from = DateField(null=True)
+
+    class Meta:
+        database = db
+
+
+class AccountBalance(Model):
+    account = ForeignKeyField(Account, related_name='balance_entries')
+    date = DateField()
+    balance = BigIntegerField()
+
+    class Meta:
+        database = db
+        indexes = (
+            (('account', 'date'), True),
+        )
+
+
+class TransactionType(IntEnum):
+    DEBIT = 1
+    CREDIT = 2
+    TRANSFER_OUT = 3
+    TRANSFER_IN = 4
+
+
+class AccountTransaction(Model):
+    account = ForeignKeyField(Account, related_name='transactions')
+    timestamp = DateTimeField()
+    type = IntegerField()
+    amount = BigIntegerField()
+    comment = TextField()
+    natural_key = CharField(null=True)
+
+    class Meta:
+        database = db
+        indexes = (
+            (('account', 'timestamp'), False),
+            (('timestamp',), False),
+            (('natural_key',), True),
+        )
+
+
+class MonthlyAggregate(Model):
+    account = ForeignKeyField(Account, related_name='monthly_aggregates')
+    year = IntegerField()
+    month = IntegerField()
+    type = IntegerField()
+    total = BigIntegerField()
+    count = IntegerField()
+
+    class Meta:
+        database = db
+        indexes = (
+            (('account', 'year', 'month', 'type'), True),
+        )
+
+
+class ExchangeRate(Model):
+    # Units of a common base currency, whichever one the rates are quoted
+    # in, per major unit of currency; it applies from date until the next
+    # rate of the same currency.
+    currency = ForeignKeyField(Currency, related_name='exchange_rates')
+    date = DateField()
+    rate = DoubleField()
+
+    class Meta:
+        database = db
+        indexes = (
+            (('currency', 'date'), True),
+        )
+
+
+class ArchivedYear(Model):
+    # A closed year whose transactions and balance entries were moved out of
+    # the main file into path, relative to the directory of the main file.
+    year = IntegerField(unique=True)
+    path = CharField()
+    transactions = IntegerField()
+    balances = IntegerField()
+
+    class Meta:
+        database = db
+
+
+MODELS = [Currency, Account, AccountBalance, AccountTransaction, MonthlyAggregate, ExchangeRate, ArchivedYear]
+
+
+# Amounts and balances are stored as integers in the minor unit of the
+# account currency, e.g. cents for an exponent of 2. Values finer than that
+# raise ValueError rather than being rounded.
+def to_minor_units(value, exponent):
+    try:
+        units = Decimal(value).scaleb(exponent)
+    except ArithmeticError:
+        raise ValueError('Invalid amount "{0}"'.format(value))
+    if not units.is_finite() or units != units.to_integral_value():
+        raise ValueError('Invalid amount "{0}", the currency has {1} decimal places'.format(value, exponent))
+    return int(units)
+
+
+def from_minor_units(value, exponent):
+    return Decimal(value).scaleb(-exponent)
+
+
+def create_index(model, field_names, unique=False):
+    table = model._meta.db_table
+    columns = [model._meta.fields[name].db_column for name in field_names]
+    existing = set(index.name for index in db.get_indexes(table))
+    if db.compiler().index_name(table, columns) not in existing:
+        db.create_index(model, field_names, unique)
+
+
+class MigrationError(Exception):
+    pass
+
+
+def migrate_ledger_indexes():
+    # Balance entries become unique per account and day. Which of several
+    # entries on one day is right only the user can tell, so the upgrade
+    # stops until they are resolved.
+    duplicates = db.execute_sql(
+        'SELECT b.id, b.account_id, b.date, b.balance FROM accountbalance AS b '
+        'JOIN (SELECT account_id, date FROM accountbalance GROUP BY account_id, date HAVING COUNT(*) > 1) AS d '
+        'ON d.account_id = b.account_id AND d.date = b.date '
+        'ORDER BY b.account_id, b.date, b.id'
+    ).fetchall()
+    if duplicates:
+        raise MigrationError(
+            'Several balance entries of an account on one day; delete all but one of each '
+            'from the accountbalance table of {0} and run again:\n{1}'.format(
+                db.database,
+                '\n'.join('  #{0} account #{1} {2} {3}'.format(*row) for row in duplicates)
+            )
+        )
+    create_index(AccountTransaction, ('account', 'timestamp'))
+    create_index(AccountTransaction, ('timestamp',))
+    create_index(AccountBalance, ('account', 'date'), unique=True)
+
+
+def migrate_minor_units():
+    # Decimal columns held values with two decimal places. The declared column
+    # type is kept, integers are stored as such under its NUMERIC affinity.
+    db.execute_sql('ALTER TABLE currency ADD COLUMN exponent INTEGER NOT NULL DEFAULT 2')
+    db.execute_sql('UPDATE accounttransaction SET amount = CAST(ROUND(amount * 100) AS INTEGER)')
+    db.execute_sql('UPDATE accountbalance SET balance = CAST(ROUND(balance * 100) AS INTEGER)')
+
+
+def migrate_natural_keys():
+    db.execute_sql('ALTER TABLE accounttransaction ADD COLUMN natural_key VARCHAR(255)')
+    create_index(AccountTransaction, ('natural_key',), unique=True)
+
+
+def rebuild_monthly_aggregates():
+    # Archived years keep their aggregates in the main file; their
+    # transactions can no longer change, so only the rest is rebuilt.
+    MonthlyAggregate.delete().where(MonthlyAggregate.year.not_in(ArchivedYear.select(ArchivedYear.year))).execute()
+    # strftime() yields text such as '2017' or '03', which the INTEGER
+    # affinity of the year and month columns stores as integers.
+    query = AccountTransaction.select(
+        AccountTransaction.account,
+        fn.strftime('%Y', AccountTransaction.timestamp),
+        fn.strftime('%m', AccountTransaction.timestamp),
+        AccountTransaction.type,
+        fn.SUM(AccountTransaction.amount),
+        fn.COUNT(AccountTransaction.id)
+    ).join(Account).group_by(
+        AccountTransaction.account,
+        fn.strftime('%Y', AccountTransaction.timestamp),
+        fn.strftime('%m', AccountTransaction.timestamp),
+        AccountTransaction.type
+    )
+    MonthlyAggregate.insert_from([
+        MonthlyAggregate.account,
+        MonthlyAggregate.year,
+        MonthlyAggregate.month,
+        MonthlyAggregate.type,
+        MonthlyAggregate.total,
+        MonthlyAggregate.count
+    ], query).execute()
+
+
+def migrate_exchange_rates():
+    db.create_tables([ExchangeRate], safe=True)
+
+
+def migrate_balance_watermarks():
+    db.execute_sql('ALTER TABLE account ADD COLUMN balances_dirty_from DATE')
+    # remove_account() used to leave these rows behind.
+    for model in (AccountTransaction, AccountBalance, MonthlyAggregate):
+        model.delete().where(model.account.not_in(Account.select(Account.id))).execute()
+
+
+def migrate_archived_years():
+    db.create_tables([ArchivedYear], safe=True)
+
+
+# transactionsearch is an FTS5 index of the comments of accounttransaction,
+# which stays the only copy of the text. The prefix indexes make queries for
+# prefixes of two and three characters as cheap as whole words.
+def search_index_statements(schema='main'):
+    return [
+        'CREATE VIRTUAL TABLE "{0}".transactionsearch USING fts5('
+        'comment, content=accounttransaction, content_rowid=id, prefix=\'2 3\')'.format(schema),
+        'INSERT INTO "{0}".transactionsearch (transactionsearch) VALUES (\'rebuild\')'.format(schema)
+    ]
+
+
+# Every write path, bulk imports and set-based deletes included, goes
+# through these.
+SEARCH_TRIGGERS = [
+    'CREATE TRIGGER accounttransaction_search_insert AFTER INSERT ON accounttransaction BEGIN '
+    'INSERT INTO transactionsearch (rowid, comment) VALUES (new.id, new.comment); END',
+    'CREATE TRIGGER accounttransaction_search_delete AFTER DELETE ON accounttransaction BEGIN '
+    'INSERT INTO transactionsearch (transactionsearch, rowid, comment) VALUES (\'delete\', old.id, old.comment); END',
+    'CREATE TRIGGER accounttransaction_search_update AFTER UPDATE OF comment ON accounttransaction BEGIN '
+    'INSERT INTO transactionsearch (transactionsearch, rowid, comment) VALUES (\'delete\', old.id, old.comment); '
+    'INSERT INTO transactionsearch (rowid, comment) VALUES (new.id, new.comment); END'
+]
+
+
+def create_search_index():
+    for statement in search_index_statements() + SEARCH_TRIGGERS:
+        db.execute_sql(statement)
+
+
+def migrate_transaction_search():
+    import sqlite3
+
+    create_search_index()
+    # Archives are read-only once attached, so each is opened on its own.
+    directory = os.path.dirname(db.database)
+    for path, in ArchivedYear.select(ArchivedYear.path).tuples():
+        connection = sqlite3.connect(os.path.join(directory, path))
+        try:
+            with connection:
+                for statement in search_index_statements():
+                    connection.execute(statement)
+        finally:
+            connection.close()
+
+
+# Each step upgrades an existing database by one schema version, which is
+# tracked in PRAGMA user_version. New databases are created with the latest
+# schema and skip the steps entirely.
+MIGRATIONS = [
+    migrate_ledger_indexes,
+    migrate_minor_units,
+    migrate_natural_keys,
+    rebuild_monthly_aggregates,
+    migrate_exchange_rates,
+    migrate_balance_watermarks,
+    migrate_archived_years,
+    migrate_transaction_search,
+]
+
+
+def init_db():
+    # A database at the current version costs a single pragma read: no DDL,
+    # no introspection and no write transaction.
+    if db.pragma('user_version')[0] == len(MIGRATIONS):
+        return
+    with db.atomic():
+        if Currency.table_exists():
+            version = db.pragma('user_version')[0]
+            db.create_tables(MODELS, safe=True)
+            for migration in MIGRATIONS[version:]:
+                migration()
+        else:
+            db.create_tables(MODELS)
+            create_search_index()
+        db.pragma('user_version', len(MIGRATIONS))
+
+
+def use_database(path, pragmas=None):
+    # pragmas are (name, value) pairs that replace or add to
+    # CONNECTION_PRAGMAS.
+    if not db.is_closed():
+        db.close()
+    connection_pragmas = OrderedDict(CONNECTION_PRAGMAS)
+    connection_pragmas.update(pragmas or [])
+    db.connection_pragmas = list(connection_pragmas.items())
+    # URI filenames let archives be attached read-only; a plain path still
+    # opens as before.
+    db.init(os.path.abspath(path), uri=True)
+    identity_map.clear()
+    init_db()
+
+
+CurrencyInfo = namedtuple('CurrencyInfo', ['id', 'name', 'code', 'sign', 'exponent'])
+AccountInfo = namedtuple('AccountInfo', ['id', 'name', 'currency'])
+
+
+class IdentityMap(object):
+    # Per-process cache of Account, Currency and ArchivedYear rows as plain
+    # data. Every account shares the CurrencyInfo of the map, so looking up
+    # account.currency never hits the database. Functions that change these
+    # tables must call clear().
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._maps = None
+
+    def load(self):
+        # All maps are published together, so threads sharing the map never
+        # see one without the others.
+        currencies = {}
+        for row in Currency.select(Currency.id, Currency.name, Currency.code, Currency.sign, Currency.exponent).tuples():
+            currencies[row[0]] = CurrencyInfo(*row)
+        accounts = {}
+        for account_id, name, currency_id in Account.select(Account.id, Account.name, Account.currency).tuples():
+            accounts[account_id] = AccountInfo(account_id, name, currencies[currency_id])
+        directory = os.path.dirname(db.database)
+        archives = dict(
+            (year, os.path.join(directory, path))
+            for year, path in ArchivedYear.select(ArchivedYear.year, ArchivedYear.path).tuples()
+        )
+        self._maps = currencies, accounts, archives
+        return self._maps
+
+    def currency(self, currency_id):
+        currencies, _, _ = self._maps or self.load()
+        if currency_id not in currencies:
+            currencies, _, _ = self.load()
+        return currencies[currency_id]
+
+    def account(self, account_id):
+        _, accounts, _ = self._maps or self.load()
+        if account_id not in accounts:
+            _, accounts, _ = self.load()
+        return accounts[account_id]
+
+    def currencies(self):
+        currencies, _, _ = self._maps or self.load()
+        return [currencies[currency_id] for currency_id in sorted(currencies)]
+
+    def accounts(self):
+        _, accounts, _ = self._maps or self.load()
+        return [accounts[account_id] for account_id in sorted(accounts)]
+
+    def archives(self):
+        # {year: path of its archive}
+        _, _, archives = self._maps or self.load()
+        return archives
+
+
+identity_map = IdentityMap()
+
+
+def stream_tuples(query):
+    # Rows come straight off the cursor: nothing is cached and no field
+    # conversion runs, so dates and timestamps stay in their stored text form.
+    # QueryResultWrapper.iterator() would do the same, but in peewee 2.x it
+    # raises RuntimeError on Python 3.7+ (PEP 479).
+    sql, params = query.sql()
+    return db.execute_sql(sql, params, require_commit=False)
+
+
+class ArchiveError(Exception):
+    pass
+
+
+# SQLite allows ten attached databases per connection by default.
+MAX_ATTACHED_ARCHIVES = 8
+ARCHIVE_MODELS = {}
+
+
+def archive_schema(year):
+    return 'archive_{0}'.format(year)
+
+
+def archive_model(model, year):
+    # model bound to its table in the archive of year. The foreign key is
+    # declared again only to give Account a backref of its own.
+    key = (model, year)
+    if key not in ARCHIVE_MODELS:
+        meta = type('Meta', (object,), {'db_table': model._meta.db_table, 'schema': archive_schema(year)})
+        ARCHIVE_MODELS[key] = type('{0}{1}'.format(model.__name__, year), (model,), {
+            'Meta': meta,
+            'account': ForeignKeyField(Account, related_name='{0}_{1}'.format(model._meta.db_table, year)),
+            '__module__': __name__
+        })
+    return ARCHIVE_MODELS[key]
+
+
+def attach_archive(year, path, read_only=True):
+    # ATTACH is per connection and peewee keeps one connection per thread,
+    # so every thread attaches what it reads. The archives attached longest
+    # ago make room for new ones, which SQLite refuses while a transaction
+    # has read from them.
+    schema = archive_schema(year)
+    attached = [row[1] for row in db.execute_sql('PRAGMA database_list', require_commit=False).fetchall()]
+    if schema in attached:
+        return
+    archives = [name for name in attached if name.startswith('archive_')]
+    if len(archives) >= MAX_ATTACHED_ARCHIVES:
+        try:
+            db.execute_sql('DETACH DATABASE "{0}"'.format(archives[0]), require_commit=False)
+        except OperationalError:
+            raise ArchiveError('At most {0} archived years can be read in one transaction'.format(MAX_ATTACHED_ARCHIVES))
+    from urllib.request import pathname2url
+
+    db.execute_sql(
+        'ATTACH DATABASE ? AS "{0}"'.format(schema),
+        ('file:{0}{1}'.format(pathname2url(path), '?mode=ro' if read_only else ''),),
+        require_commit=False
+    )
+
+
+def partitions(model, date_start=None, date_end=None):
+    # Yields the tables of model that hold rows dated in [date_start,
+    # date_end), either bound being optional: the archive of every archived
+    # year the range overlaps, oldest first, then the main table unless every
+    # year of the range is archived. An archive is attached when it is
+    # reached, so callers must be done with one table before the next.
+    archives = identity_map.archives()
+    first_year = date_start.year if date_start is not None else None
+    # date_end is exclusive: the last year is that of the day, or the
+    # microsecond, before it.
+    if date_end is None:
+        last_year = None
+    elif isinstance(date_end, datetime):
+        last_year = (date_end - timedelta(microseconds=1)).year
+    else:
+        last_year = (date_end - timedelta(days=1)).year
+    years = [
+        year for year in sorted(archives)
+        if (first_year is None or year >= first_year) and (last_year is None or year <= last_year)
+    ]
+    for year in years:
+        attach_archive(year, archives[year])
+        yield archive_model(model, year)
+    if first_year is None or last_year is None or len(years) < last_year - first_year + 1:
+        yield model
+
+
+def partition_of(model, day):
+    return next(partitions(model, day, day + timedelta(days=1)))
+
+
+def check_writable(days):
+    # Archived years are read-only, and so is every year before one: a
+    # change there would move the balances stored in the archive.
+    archives = identity_map.archives()
+    if not archives:
+        return
+    newest = max(archives)
+    for day in days:
+        if day.year in archives:
+            raise ArchiveError('{0} is archived and read-only'.format(day.year))
+        if day.year < newest:
+            raise ArchiveError('{0} is read-only, {1} is archived'.format(day.year, newest))
+
+
+TransactionTotal = namedtuple('TransactionTotal', ['currency', 'type', 'amount', 'count'])
+BalanceTotal = namedtuple('BalanceTotal', ['currency', 'balance', 'count'])
+
+
+def transaction_total(currency_id, type, amount, count):
+    currency = identity_map.currency(currency_id)
+    return TransactionTotal(currency, TransactionType(type), from_minor_units(amount, currency.exponent), count)
+
+
+def sum_transactions(date_start, date_end, accounts=None, exclude_accounts=None, ids=None):
+    # Totals per currency and type of the transactions made in
+    # [date_start, date_end), over every partition the range overlaps.
+    totals = defaultdict(lambda: [0, 0])
+    for model in partitions(AccountTransaction, date_start, date_end):
+        query = model.select(
+            Account.currency,
+            model.type,
+            fn.SUM(model.amount),
+            fn.COUNT(model.id)
+        ).join(Account).where(
+            model.timestamp >= date_start,
+            model.timestamp < date_end
+        ).group_by(
+            Account.currency,
+            model.type
+        )
+        if accounts:
+            query = query.where(model.account.in_(accounts))
+        if exclude_accounts:
+            query = query.where(model.account.not_in(exclude_accounts))
+        if ids:
+            query = query.where(model.id.in_(ids))
+        for currency_id, type, amount, count in query.tuples():
+            total = totals[(currency_id, type)]
+            total[0] += amount
+            total[1] += count
+    return [
+        transaction_total(currency_id, type, amount, count)
+        for (currency_id, type), (amount, count) in sorted(totals.items())
+    ]
+
+
+def balances_at(day, account_ids=None):
+    # The balance at the start of a day is the nearest balance entry on or
+    # before it plus the transactions made since; an account without any
+    # entry starts from zero. Returns a dict keyed by account id.
+    if account_ids is None:
+        account_ids = [account.id for account in identity_map.accounts()]
+    if not account_ids:
+        return {}
+
+    refresh_balances(account_ids)
+    balances = dict((account_id, 0) for account_id in account_ids)
+    checkpoints = {}
+    # Years are archived oldest first, and archiving one leaves an entry for
+    # every account on the first day after it in the main file, so the file
+    # the day falls in holds everything needed.
+    balance_model = partition_of(AccountBalance, day)
+    transaction_model = partition_of(AccountTransaction, day)
+    # SQLite takes the bare balance column from the row holding MAX(date).
+    query = balance_model.select(
+        balance_model.account,
+        fn.MAX(balance_model.date),
+        balance_model.balance
+    ).where(
+        balance_model.date <= day
+    ).where(
+        balance_model.account.in_(account_ids)
+    ).group_by(balance_model.account)
+    for account_id, checkpoint_date, balance in stream_tuples(query):
+        checkpoints[account_id] = checkpoint_date
+        balances[account_id] = balance
+
+    # One OR-ed range per account keeps each lookup on the (account, timestamp)
+    # index; accounts are chunked to stay under SQLite's expression depth.
+    for batch in chunked(account_ids, 100):
+        ranges = []
+        for account_id in batch:
+            expression = transaction_model.account == account_id
+            if account_id in checkpoints:
+                expression &= transaction_model.timestamp >= checkpoints[account_id]
+            ranges.append(expression)
+        query = transaction_model.select(
+            transaction_model.account,
+            transaction_model.type,
+            fn.SUM(transaction_model.amount)
+        ).where(
+            transaction_model.timestamp < day
+        ).where(
+            reduce(operator.or_, ranges)
+        ).group_by(
+            transaction_model.account,
+            transaction_model.type
+        )
+        for account_id, type, amount in stream_tuples(query):
+            balances[account_id] = apply_transaction(balances[account_id], type, amount)
+    return balances
+
+
+def boundary_entries(account_ids, date_start, date_end):
+    # The last balance entry of every account on or before date_start and
+    # the last one after it up to date_end, as two dicts of (date, balance)
+    # keyed by account id. Grouping on date > date_start gets both from one
+    # query when both days are in the same file.
+    opening = {}
+    closing = {}
+    queried = []
+    for day in (date_start, date_end):
+        model = partition_of(AccountBalance, day)
+        if model in queried:
+            continue
+        queried.append(model)
+        query = model.select(
+            model.account,
+            fn.MAX(model.date),
+            model.balance
+        ).where(
+            model.date <= date_end
+        ).where(
+            model.account.in_(account_ids)
+        ).group_by(model.account, model.date > date_start)
+        for account_id, entry_date, balance in stream_tuples(query):
+            # MAX() leaves the date as stored text.
+            entry_date = model.date.python_value(entry_date)
+            entries = closing if entry_date > date_start else opening
+            if account_id not in entries or entries[account_id][0] < entry_date:
+                entries[account_id] = (entry_date, balance)
+    return opening, closing
+
+
+def period_flows(account_ids, date_start, date_end):
+    # Opening balance, credit, debit, transfers in, transfers out and closing
+    # balance of every account for [date_start, date_end), in minor units and
+    # keyed by account id. The balances are taken as balances_at() takes
+    # them, so the closing balance comes from the last balance entry in the
+    # period and need not be the opening balance plus the flows.
+    opening, closing = boundary_entries(account_ids, date_start, date_end)
+    # The whole months of the period are summed from the monthly aggregates
+    # and transactions are only read around them. Every transaction read
+    # lands in a bucket: 0 carries an opening entry forward to date_start,
+    # 1 and 2 are flows of the period outside the whole months, 2 and 3
+    # carry a closing entry forward to date_end.
+    months_start = date_start if date_start.day == 1 else month_range(date_start.year, date_start.month)[1]
+    months_end = date(date_end.year, date_end.month, 1)
+    if months_start >= months_end:
+        months_start = months_end = date_end
+    sums = defaultdict(int)
+    if months_start < months_end:
+        last_month = months_end - timedelta(days=1)
+        for batch in chunked(account_ids, 100):
+            query = MonthlyAggregate.select(
+                MonthlyAggregate.account,
+                MonthlyAggregate.type,
+                fn.SUM(MonthlyAggregate.total)
+            ).where(
+                MonthlyAggregate.account << batch,
+                month_between(months_start.year, months_start.month, last_month.year, last_month.month)
+            ).group_by(MonthlyAggregate.account, MonthlyAggregate.type)
+            for account_id, type, amount in query.tuples():
+                sums[(account_id, type, 1)] += amount
+
+    lower = min(entry_date for entry_date, _ in opening.values()) if len(opening) == len(account_ids) else None
+    for model in partitions(AccountTransaction, lower, date_end):
+        # Accounts are grouped by their entry dates, which balance entries
+        # written for every account at once make few, and chunked to stay
+        # under SQLite's variable limit.
+        for batch in chunked(account_ids, 100):
+            starts = defaultdict(list)
+            carried = defaultdict(list)
+            for account_id in batch:
+                starts[opening[account_id][0] if account_id in opening else None].append(account_id)
+                if account_id in closing:
+                    carried[closing[account_id][0]].append(account_id)
+            ranges = []
+            for entry_date, ids in starts.items():
+                expression = (model.account << ids) & (model.timestamp < months_start)
+                if entry_date is not None:
+                    expression &= model.timestamp >= entry_date
+                ranges.append(expression)
+            if months_end < date_end:
+                ranges.append((model.account << batch) & (model.timestamp >= months_end))
+            buckets = [
+                (model.timestamp < date_start, 0),
+                ((model.timestamp >= months_start) & (model.timestamp < months_end), 3)
+            ]
+            for entry_date, ids in carried.items():
+                expression = (model.account << ids) & (model.timestamp >= entry_date)
+                ranges.append(expression)
+                buckets.append((expression, 2))
+            bucket = case(None, buckets, 1)
+            query = model.select(
+                model.account,
+                model.type,
+                bucket,
+                fn.SUM(model.amount)
+            ).where(
+                model.timestamp < date_end
+            ).where(
+                reduce(operator.or_, ranges)
+            ).group_by(model.account, model.type, bucket)
+            for account_id, type, bucket_number, amount in stream_tuples(query):
+                sums[(account_id, type, bucket_number)] += amount
+
+    flows = {}
+    for account_id in account_ids:
+        opening_balance = opening[account_id][1] if account_id in opening else 0
+        for type in TransactionType:
+            opening_balance = apply_transaction(opening_balance, type, sums[(account_id, type, 0)])
+        credit, debit, transfer_in, transfer_out = [
+            sums[(account_id, type, 1)] + sums[(account_id, type, 2)]
+            for type in (TransactionType.CREDIT, TransactionType.DEBIT, TransactionType.TRANSFER_IN, TransactionType.TRANSFER_OUT)
+        ]
+        if account_id in closing:
+            closing_balance = closing[account_id][1]
+            for type in TransactionType:
+                closing_balance = apply_transaction(closing_balance, type, sums[(account_id, type, 2)] + sums[(account_id, type, 3)])
+        else:
+            closing_balance = opening_balance + credit - debit + transfer_in - transfer_out
+        flows[account_id] = (opening_balance, credit, debit, transfer_in, transfer_out, closing_balance)
+    return flows
+
+
+def period_flows_shard(path, pragmas, account_ids, date_start, date_end):
+    # period_flows() in a worker process of accounts_report().
+    use_database(path, pragmas)
+    try:
+        return period_flows(account_ids, date_start, date_end)
+    finally:
+        db.close()
+
+
+def sum_monthly_aggregates(*expressions):
+    query = MonthlyAggregate.select(
+        Account.currency,
+        MonthlyAggregate.type,
+        fn.SUM(MonthlyAggregate.total),
+        fn.SUM(MonthlyAggregate.count)
+    ).join(Account).group_by(
+        Account.currency,
+        MonthlyAggregate.type
+    ).order_by(
+        Account.currency,
+        MonthlyAggregate.type
+    )
+    for expression in expressions:
+        query = query.where(expression)
+    return [
+        transaction_total(currency_id, type, amount, count)
+        for currency_id, type, amount, count in query.tuples()
+    ]
+
+
+def month_between(start_year, start_month, end_year, end_month):
+    month_index = MonthlyAggregate.year * 12 + MonthlyAggregate.month
+    return month_index.between(start_year * 12 + start_month, end_year * 12 + end_month)
+
+
+def update_monthly_aggregates(transactions, sign=1):
+    # Applies (account, timestamp, type, amount) rows to MonthlyAggregate;
+    # sign=-1 takes removed transactions back out. Must run in the same
+    # transaction as the write it accounts for.
+    deltas = defaultdict(lambda: [0, 0])
+    for account_id, timestamp, type, amount in transactions:
+        delta = deltas[(account_id, timestamp.year, timestamp.month, type)]
+        delta[0] += sign * amount
+        delta[1] += sign
+    for (account_id, year, month, type), (total, count) in deltas.items():
+        updated = MonthlyAggregate.update(
+            total=MonthlyAggregate.total + total,
+            count=MonthlyAggregate.count + count
+        ).where(
+            MonthlyAggregate.account == account_id,
+            MonthlyAggregate.year == year,
+            MonthlyAggregate.month == month,
+            MonthlyAggregate.type == type
+        ).execute()
+        if not updated:
+            MonthlyAggregate.insert(
+                account=account_id,
+                year=year,
+                month=month,
+                type=type,
+                total=total,
+                count=count
+            ).execute()
+
+
+def mark_balances_dirty(transactions):
+    # Balance entries dated after the day of a transaction written or removed
+    # no longer add up. Lowers the watermark of every account of the
+    # (account, timestamp) rows given that has such entries. Must run in the
+    # same transaction as the write it accounts for.
+    earliest = {}
+    for account_id, timestamp in transactions:
+        day = timestamp.date() + timedelta(days=1)
+        if account_id not in earliest or day < earliest[account_id]:
+            earliest[account_id] = day
+    for account_id, day in earliest.items():
+        Account.update(
+            balances_dirty_from=fn.MIN(fn.COALESCE(Account.balances_dirty_from, day), day)
+        ).where(
+            Account.id == account_id,
+            Account.id.in_(AccountBalance.select(AccountBalance.account).where(
+                AccountBalance.account == account_id,
+                AccountBalance.date >= day
+            ))
+        ).execute()
+
+
+def day_range(day):
+    return day, day + timedelta(days=1)
+
+
+def month_range(year, month):
+    return date(year, month, 1), date(year + month // 12, month % 12 + 1, 1)
+
+
+SQLITE_MAX_VARIABLES = 999
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def bulk_insert(model, rows, on_conflict=None):
+    # Multi-row INSERTs are split so that no statement binds more variables
+    # than older SQLite builds allow. on_conflict is an SQLite conflict
+    # resolution such as 'IGNORE' or 'REPLACE'. Returns the number of
+    # inserted rows.
+    inserted = 0
+    if not rows:
+        return inserted
+    for batch in chunked(rows, SQLITE_MAX_VARIABLES // len(rows[0])):
+        query = model.insert_many(batch)
+        if on_conflict:
+            query = query.on_conflict(on_conflict)
+        sql, params = query.sql()
+        inserted += db.rows_affected(db.execute_sql(sql, params))
+    return inserted
+
+
+def apply_transaction(balance, type, amount):
+    if type in (TransactionType.DEBIT, TransactionType.TRANSFER_OUT):
+        return balance - amount
+    elif type in (TransactionType.CREDIT, TransactionType.TRANSFER_IN):
+        return balance + amount
+    return balance
+
+
+def seeded_watermark(account_id, dirty_from):
+    # Entries are recomputed from the last one before the watermark. An
+    # account without one keeps its earliest entry instead, an opening
+    # balance that cannot be derived from the transactions, and the
+    # watermark moves past it.
+    earlier = AccountBalance.select(AccountBalance.id).where(
+        AccountBalance.account == account_id,
+        AccountBalance.date < dirty_from
+    ).limit(1)
+    if list(earlier.tuples()):
+        return dirty_from
+    first = AccountBalance.select(fn.MIN(AccountBalance.date)).where(AccountBalance.account == account_id).scalar()
+    if first is None:
+        return dirty_from
+    return AccountBalance.date.python_value(first) + timedelta(days=1)
+
+
+def recomputed_balances(account_id, dirty_from):
+    # New rows for the balance entries of account dated on or after
+    # dirty_from: the last entry before it carried forward by the
+    # transactions made since. See seeded_watermark() for the account
+    # without one.
+    dates = [entry_date for entry_date, in AccountBalance.select(AccountBalance.date).where(
+        AccountBalance.account == account_id,
+        AccountBalance.date >= dirty_from
+    ).order_by(AccountBalance.date).tuples()]
+    if not dates:
+        return []
+    seed = list(AccountBalance.select(AccountBalance.date, AccountBalance.balance).where(
+        AccountBalance.account == account_id,
+        AccountBalance.date < dirty_from
+    ).order_by(AccountBalance.date.desc()).limit(1).tuples())
+    seed_date, balance = seed[0] if seed else (None, 0)
+
+    day = fn.substr(AccountTransaction.timestamp, 1, 10)
+    query = AccountTransaction.select(
+        day,
+        AccountTransaction.type,
+        fn.SUM(AccountTransaction.amount)
+    ).where(
+        AccountTransaction.account == account_id,
+        AccountTransaction.timestamp < dates[-1]
+    ).group_by(day, AccountTransaction.type).order_by(day)
+    if seed_date is not None:
+        query = query.where(AccountTransaction.timestamp >= seed_date)
+    sums = list(stream_tuples(query))
+
+    rows = []
+    position = 0
+    for entry_date in dates:
+        while position < len(sums) and sums[position][0] < entry_date.isoformat():
+            balance = apply_transaction(balance, sums[position][1], sums[position][2])
+            position += 1
+        rows.append({'account': account_id, 'date': entry_date, 'balance': balance})
+    return rows
+
+
+def refresh_balances(account_ids=None):
+    # Recomputes the balance entries left stale by transaction writes, for
+    # every account of account_ids (all when None) with a watermark: the
+    # entries from the watermark on are deleted and inserted again in one
+    # transaction. Returns the number of entries rewritten.
+    query = Account.select(Account.id, Account.balances_dirty_from).where(Account.balances_dirty_from.is_null(False))
+    if account_ids is not None:
+        query = query.where(Account.id.in_(account_ids))
+    dirty = list(query.tuples())
+    rewritten = 0
+    for account_id, dirty_from in dirty:
+        with db.atomic():
+            watermark = seeded_watermark(account_id, dirty_from)
+            rows = recomputed_balances(account_id, watermark)
+            AccountBalance.delete().where(
+                AccountBalance.account == account_id,
+                AccountBalance.date >= watermark
+            ).execute()
+            rewritten += bulk_insert(AccountBalance, rows)
+            # A write committed since the watermark was read has lowered it
+            # and leaves it in place.
+            Account.update(balances_dirty_from=None).where(
+                Account.id == account_id,
+                Account.balances_dirty_from == dirty_from
+            ).execute()
+    return rewritten
+
+
+RolledBalance = namedtuple('RolledBalance', ['date', 'account', 'entry_id', 'balance'])
+
+
+def roll_forward_balances(date_start, date_end):
+    # Each day's balance is the previous day's balance plus the transactions
+    # made on the previous day. Existing rows are kept as they are and act as
+    # seeds for the days that follow; a day with no seed is reported with
+    # balance set to None. Reported balances are Decimals.
+    # An entry holds the balance at the end of the day before it.
+    check_writable([date_start - timedelta(days=1)])
+    refresh_balances()
+    accounts = identity_map.accounts()
+    date_seed = date_start - timedelta(days=1)
+
+    balance_map = {}
+    balance_entries = AccountBalance.select(
+        AccountBalance.id,
+        AccountBalance.account,
+        AccountBalance.date,
+        AccountBalance.balance
+    ).where(
+        AccountBalance.date >= date_seed
+    ).where(
+        AccountBalance.date <= date_end
+    ).order_by(AccountBalance.id.desc()).tuples()
+    for entry_id, account_id, entry_date, balance in balance_entries:
+        balance_map[(account_id, entry_date)] = (entry_id, balance)
+
+    transaction_map = defaultdict(list)
+    transactions = AccountTransaction.select(
+        AccountTransaction.account,
+        AccountTransaction.timestamp,
+        AccountTransaction.type,
+        AccountTransaction.amount
+    ).where(
+        AccountTransaction.timestamp >= date_seed
+    ).where(
+        AccountTransaction.timestamp < date_end
+    ).order_by(AccountTransaction.id).tuples()
+    for account_id, timestamp, type, amount in transactions:
+        transaction_map[(account_id, timestamp.date())].append((type, amount))
+
+    result = []
+    new_entries = []
+    date_cur = date_start
+    while date_cur <= date_end:
+        date_day_before = date_cur - timedelta(days=1)
+        for account in accounts:
+            if (account.id, date_cur) in balance_map:
+                entry_id, balance = balance_map[(account.id, date_cur)]
+                result.append(RolledBalance(date_cur, account, entry_id, from_minor_units(balance, account.currency.exponent)))
+                continue
+            if (account.id, date_day_before) not in balance_map:
+                result.append(RolledBalance(date_cur, account, None, None))
+                continue
+            _, balance = balance_map[(account.id, date_day_before)]
+            for type, amount in transaction_map[(account.id, date_day_before)]:
+                balance = apply_transaction(balance, type, amount)
+            balance_map[(account.id, date_cur)] = (None, balance)
+            new_entries.append({
+                'account': account.id,
+                'date': date_cur,
+                'balance': balance
+            })
+            result.append(RolledBalance(date_cur, account, None, from_minor_units(balance, account.currency.exponent)))
+        date_cur = date_cur + timedelta(days=1)
+
+    with db.atomic():
+        bulk_insert(AccountBalance, new_entries)
+
+    return result
+
+
+def statement_rows(lines, account_id=None):
+    # Maps statement lines to AccountTransaction rows. The natural key is the
+    # bank reference when there is one, otherwise a hash of the row itself;
+    # identical lines are numbered, wherever they are in the statement, so
+    # that they stay distinct. Numbering them needs a count for every
+    # distinct line read so far; the counts are kept by a digest of the line,
+    # so that each costs the same however long its comment.
+    from hashlib import sha1
+
+    occurrences = {}
+    for line in lines:
+        if not line.account and account_id is None:
+            raise ValueError('Line {0}: no account'.format(line.line_number))
+        try:
+            account = identity_map.account(int(line.account) if line.account else account_id)
+        except (KeyError, ValueError):
+            raise ValueError('Line {0}: unknown account "{1}"'.format(line.line_number, line.account or account_id))
+        if line.type:
+            if line.type.upper() not in TransactionType.__members__:
+                raise ValueError('Line {0}: unknown transaction type "{1}"'.format(line.line_number, line.type))
+            type = TransactionType[line.type.upper()]
+        elif line.amount < 0:
+            type = TransactionType.DEBIT
+        else:
+            type = TransactionType.CREDIT
+        try:
+            amount = to_minor_units(abs(line.amount), account.currency.exponent)
+        except ValueError as error:
+            raise ValueError('Line {0}: {1}'.format(line.line_number, error))
+        if line.reference:
+            key = (account.id, line.reference)
+        else:
+            key = (account.id, line.timestamp, type.value, amount, line.comment)
+        counted = sha1(repr(key).encode('utf-8')).digest()
+        occurrence = occurrences.get(counted, 0)
+        occurrences[counted] = occurrence + 1
+        digest = sha1(repr(key + (occurrence,)).encode('utf-8')).hexdigest()
+        yield {
+            'account': account.id,
+            'timestamp': line.timestamp,
+            'type': type.value,
+            'amount': amount,
+            'comment': line.comment,
+            'natural_key': digest
+        }
+
+
+def import_transaction_rows(rows, batch_size):
+    # Yields (rows read, rows inserted) for every batch written.
+    for batch in chunked(rows, batch_size):
+        check_writable(row['timestamp'] for row in batch)
+        with db.atomic():
+            last_id = AccountTransaction.select(fn.MAX(AccountTransaction.id)).scalar() or 0
+            inserted = bulk_insert(AccountTransaction, batch, on_conflict='IGNORE')
+            written = list(AccountTransaction.select(
+                AccountTransaction.account,
+                AccountTransaction.timestamp,
+                AccountTransaction.type,
+                AccountTransaction.amount
+            ).where(
+                AccountTransaction.id > last_id
+            ).tuples())
+            update_monthly_aggregates(written)
+            mark_balances_dirty((account_id, timestamp) for account_id, timestamp, _, _ in written)
+        yield len(batch), inserted
+
+
+EXPORT_COLUMNS = {
+    'transactions': ('id', 'account_id', 'account', 'timestamp', 'type', 'amount', 'currency', 'comment'),
+    'balances': ('id', 'account_id', 'account', 'date', 'balance', 'currency'),
+    'accounts': ('id', 'name', 'currency')
+}
+
+
+def export_rows(kind, account_ids=None, date_start=None, date_end=None):
+    # Yields plain tuples in the order of EXPORT_COLUMNS[kind] without keeping
+    # anything in memory.
+    if kind == 'accounts':
+        query = Account.select(Account.id, Account.name, Currency.code).join(Currency)
+        if account_ids:
+            query = query.where(Account.id.in_(account_ids))
+        for row in stream_tuples(query.order_by(Account.id)):
+            yield row
+    elif kind == 'balances':
+        refresh_balances(account_ids or None)
+        for model in partitions(AccountBalance, date_start, date_end):
+            query = model.select(
+                model.id,
+                model.account,
+                Account.name,
+                model.date,
+                model.balance,
+                Currency.code,
+                Currency.exponent
+            ).join(Account).join(Currency)
+            if account_ids:
+                query = query.where(model.account.in_(account_ids))
+            if date_start is not None:
+                query = query.where(model.date >= date_start)
+            if date_end is not None:
+                query = query.where(model.date < date_end)
+            for entry_id, account_id, name, entry_date, balance, code, exponent in stream_tuples(query.order_by(model.id)):
+                yield entry_id, account_id, name, entry_date, str(from_minor_units(balance, exponent)), code
+    else:
+        for model in partitions(AccountTransaction, date_start, date_end):
+            query = model.select(
+                model.id,
+                model.account,
+                Account.name,
+                model.timestamp,
+                model.type,
+                model.amount,
+                Currency.code,
+                model.comment,
+                Currency.exponent
+            ).join(Account).join(Currency)
+            if account_ids:
+                query = query.where(model.account.in_(account_ids))
+            if date_start is not None:
+                query = query.where(model.timestamp >= date_start)
+            if date_end is not None:
+                query = query.where(model.timestamp < date_end)
+            for entry_id, account_id, name, timestamp, type, amount, code, comment, exponent in stream_tuples(query.order_by(model.id)):
+                yield entry_id, account_id, name, timestamp, TransactionType(type).name, str(from_minor_units(amount, exponent)), code, comment
+
+
+class ExchangeRateError(LookupError):
+    pass
+
+
+def import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError('This requires NumPy: pip install finctrl[numpy]')
+    return numpy
+
+
+def currency_by_code(code):
+    for currency in identity_map.currencies():
+        if currency.code == code:
+            return currency
+    raise ExchangeRateError('Unknown currency "{0}"'.format(code))
+
+
+def load_exchange_rates(currency_ids):
+    # Returns {currency id: (dates, rates)} where dates is a sorted
+    # datetime64[D] array and rates the float64 array that goes with it.
+    numpy = import_numpy()
+    columns = defaultdict(lambda: ([], []))
+    query = ExchangeRate.select(
+        ExchangeRate.currency,
+        ExchangeRate.date,
+        ExchangeRate.rate
+    ).where(
+        ExchangeRate.currency.in_(list(currency_ids))
+    ).order_by(ExchangeRate.currency, ExchangeRate.date)
+    for currency_id, rate_date, rate in stream_tuples(query):
+        dates, rates = columns[currency_id]
+        dates.append(rate_date)
+        rates.append(rate)
+    return dict(
+        (currency_id, (numpy.array(dates, dtype='datetime64[D]'), numpy.array(rates, dtype=numpy.float64)))
+        for currency_id, (dates, rates) in columns.items()
+    )
+
+
+def base_currency_id():
+    # The currency the rates are quoted in, which needs no rates of its own:
+    # the one currency of the ledger without any. None when there is no
+    # such currency or more than one.
+    rated = ExchangeRate.select(ExchangeRate.currency).distinct()
+    unrated = [currency_id for currency_id, in Currency.select(Currency.id).where(Currency.id.not_in(rated)).tuples()]
+    return unrated[0] if len(unrated) == 1 else None
+
+
+def rates_as_of(exchange_rates, currency_id, days):
+    # An as-of merge: searchsorted finds, for every day at once, the last
+    # rate dated on or before it. Only the base currency has no rates.
+    numpy = import_numpy()
+    if currency_id not in exchange_rates:
+        return numpy.ones(len(days))
+    dates, rates = exchange_rates[currency_id]
+    positions = numpy.searchsorted(dates, days, side='right') - 1
+    if len(positions) and positions.min() < 0:
+        raise ExchangeRateError('No {0} exchange rate on or before {1}'.format(
+            identity_map.currency(currency_id).code,
+            days[positions < 0].min()
+        ))
+    return rates[positions]
+
+
+def convert_minor_units(currency_ids, days, amounts, target_id):
+    # Converts amounts held in the minor units of their currencies into
+    # float minor units of the target currency, each at the rates in force
+    # on its day. The three arguments are sequences of the same length; the
+    # work is one array operation per source currency. The base currency,
+    # see base_currency_id(), converts at rate 1.
+    numpy = import_numpy()
+    currency_ids = numpy.asarray(currency_ids, dtype=numpy.int64)
+    days = numpy.asarray(days, dtype='datetime64[D]')
+    converted = numpy.asarray(amounts, dtype=numpy.float64).copy()
+    sources = set(numpy.unique(currency_ids).tolist()) - set([target_id])
+    if not sources:
+        return converted
+    target = identity_map.currency(target_id)
+    exchange_rates = load_exchange_rates(sources | set([target_id]))
+    unrated = sorted((sources | set([target_id])) - set(exchange_rates))
+    if unrated:
+        base_id = base_currency_id()
+        missing = [currency_id for currency_id in unrated if currency_id != base_id]
+        if missing:
+            raise ExchangeRateError('No exchange rates for {0}; only the base currency may have none'.format(
+                ', '.join(identity_map.currency(currency_id).code for currency_id in missing)
+            ))
+    for currency_id in sources:
+        mask = currency_ids == currency_id
+        currency_days = days[mask]
+        factor = rates_as_of(exchange_rates, currency_id, currency_days) / rates_as_of(exchange_rates, target_id, currency_days)
+        converted[mask] *= factor * 10.0 ** (target.exponent - identity_map.currency(currency_id).exponent)
+    return converted
+
+
+def day_numbers(julian_days, date_start):
+    # Maps SQLite julianday() values of midnights to day offsets from
+    # date_start.
+    numpy = import_numpy()
+    return numpy.rint(numpy.asarray(julian_days, dtype=numpy.float64) - (date_start.toordinal() + 1721424.5)).astype(numpy.int64)
+
+
+def balance_matrix(account_ids, date_start, num_days):
+    # Balances at the start of num_days days from date_start as an accounts x
+    # days int64 matrix in minor units. A balance entry resets its account on
+    # its day and every other day moves on by the transactions made the day
+    # before, so transactions are only read for the days that precede a day
+    # without an entry.
+    numpy = import_numpy()
+    balances = numpy.zeros((len(account_ids), num_days), dtype=numpy.int64)
+    if not account_ids:
+        return balances
+    date_end = date_start + timedelta(days=num_days - 1)
+    rows = numpy.full(max(account_ids) + 1, -1, dtype=numpy.int64)
+    rows[account_ids] = numpy.arange(len(account_ids))
+
+    opening = balances_at(date_start, account_ids)
+    balances[:, 0] = [opening[account_id] for account_id in account_ids]
+    checkpoints = numpy.zeros(balances.shape, dtype=bool)
+    checkpoints[:, 0] = True
+    for model in partitions(AccountBalance, date_start + timedelta(days=1), date_end + timedelta(days=1)):
+        query = model.select(
+            model.account,
+            fn.julianday(model.date),
+            model.balance
+        ).where(
+            model.date > date_start,
+            model.date <= date_end,
+            model.account.in_(account_ids)
+        )
+        entries = list(stream_tuples(query))
+        if entries:
+            entry_accounts, entry_days, entry_balances = [numpy.array(column) for column in zip(*entries)]
+            entry_rows, entry_columns = rows[entry_accounts], day_numbers(entry_days, date_start)
+            balances[entry_rows, entry_columns] = entry_balances
+            checkpoints[entry_rows, entry_columns] = True
+
+    # One range per account, from the first to the last day whose
+    # transactions are needed; daily entries leave little or nothing to read.
+    ranges = []
+    uncovered = ~checkpoints[:, 1:]
+    for row in numpy.flatnonzero(uncovered.any(axis=1)).tolist():
+        needed = numpy.flatnonzero(uncovered[row])
+        ranges.append((
+            account_ids[row],
+            date_start + timedelta(days=int(needed[0])),
+            date_start + timedelta(days=int(needed[-1]) + 1)
+        ))
+    deltas = numpy.zeros_like(balances)
+    if ranges:
+        models = partitions(AccountTransaction, min(start for _, start, _ in ranges), max(end for _, _, end in ranges))
+    else:
+        models = []
+    for model in models:
+        # Timestamps are stored as 'YYYY-MM-DD HH:MM:SS' text, so their first
+        # ten characters are the day; substr() is much cheaper than date().
+        day = fn.substr(model.timestamp, 1, 10)
+        signed_amount = case(None, (
+            (model.type << [TransactionType.DEBIT.value, TransactionType.TRANSFER_OUT.value], model.amount * -1),
+            (model.type << [TransactionType.CREDIT.value, TransactionType.TRANSFER_IN.value], model.amount)
+        ), 0)
+        for batch in chunked(ranges, 100):
+            batch_start = min(start for _, start, _ in batch)
+            batch_end = max(end for _, _, end in batch)
+            if 2 * sum((end - start).days for _, start, end in batch) >= len(batch) * (batch_end - batch_start).days:
+                # The ranges fill most of their bounding box, as with sparse
+                # entries: one scan of the timestamp index over it beats an
+                # index probe per range, and sums on days no range needs are
+                # harmless, since the forward fill below only adds up deltas
+                # after the last checkpoint. account_id + 0 keeps SQLite off
+                # the account index.
+                where = ((model.account + 0) << [account_id for account_id, _, _ in batch]) & (model.timestamp >= batch_start) & (model.timestamp < batch_end)
+            else:
+                where = reduce(operator.or_, [
+                    (model.account == account_id) & (model.timestamp >= start) & (model.timestamp < end)
+                    for account_id, start, end in batch
+                ])
+            query = model.select(
+                model.account,
+                fn.julianday(day),
+                fn.SUM(signed_amount)
+            ).where(where).group_by(day, model.account)
+            sums = list(stream_tuples(query))
+            if sums:
+                transaction_accounts, transaction_days, amounts = [numpy.array(column) for column in zip(*sums)]
+                deltas[rows[transaction_accounts], day_numbers(transaction_days, date_start) + 1] = amounts
+    # moved[:, day] is what the transactions made before day add up to.
+    moved = numpy.cumsum(deltas, axis=1)
+
+    # Forward fill: every day takes the balance of the last checkpoint on or
+    # before it plus what was moved since.
+    last = numpy.where(checkpoints, numpy.arange(num_days), 0)
+    numpy.maximum.accumulate(last, axis=1, out=last)
+    account_rows = numpy.arange(len(account_ids))[:, None]
+    return balances[account_rows, last] + moved - moved[account_rows, last]
+
+
+def trailing_average(values, window, start):
+    # Means of the window days ending on every day from start on; needs
+    # start >= window - 1.
+    numpy = import_numpy()
+    cumulative = numpy.zeros((values.shape[0], values.shape[1] + 1))
+    numpy.cumsum(values, axis=1, out=cumulative[:, 1:])
+    return (cumulative[:, start + 1:] - cumulative[:, start + 1 - window:values.shape[1] + 1 - window]) / window
+
+
+def month_earlier(days):
+    # The same day of the previous month, or its last day when it is shorter.
+    numpy = import_numpy()
+    months = days.astype('datetime64[M]')
+    previous_start = (months - 1).astype('datetime64[D]')
+    previous_length = months.astype('datetime64[D]') - previous_start
+    return previous_start + numpy.minimum(days - months.astype('datetime64[D]'), previous_length - 1)
+
+
+# Public API. Everything below returns plain data (namedtuples, dicts and
+# lists) and takes and returns amounts as Decimals in the major unit of the
+# account currency; the helpers above work in integer minor units.
+TransactionInfo = namedtuple('TransactionInfo', ['id', 'account', 'timestamp', 'type', 'amount', 'comment'])
+BalanceEntry = namedtuple('BalanceEntry', ['id', 'account', 'date', 'balance'])
+AccountReport = namedtuple('AccountReport', ['account', 'date_start', 'opening', 'credit', 'debit', 'date_end', 'closing'])
+PeriodReport = namedtuple('PeriodReport', ['account', 'opening', 'credit', 'debit', 'transfer_in', 'transfer_out', 'closing', 'discrepancy'])
+
+
+def currencies():
+    return identity_map.currencies()
+
+
+def create_currency(name, code, sign, exponent=2):
+    currency = Currency.create(name=name, code=code, sign=sign, exponent=exponent)
+    identity_map.clear()
+    return currency.id
+
+
+def set_currency_sign(currency_id, sign):
+    Currency.update(sign=sign).where(Currency.id == currency_id).execute()
+    identity_map.clear()
+
+
+def accounts():
+    return identity_map.accounts()
+
+
+def account(account_id):
+    return identity_map.account(account_id)
+
+
+def create_account(name, currency_code):
+    currency = Currency.get(Currency.code == currency_code)
+    account = Account.create(name=name, currency=currency)
+    identity_map.clear()
+    return account.id
+
+
+def rename_account(account_id, name):
+    Account.update(name=name).where(Account.id == account_id).execute()
+    identity_map.clear()
+
+
+def remove_account(account_id):
+    # Archives are read-only, so an account with rows in one cannot go: its
+    # id would be handed out again and the new account would inherit them.
+    account = Account.get(Account.id == account_id)
+    for model in (AccountTransaction, AccountBalance):
+        for partition in partitions(model):
+            if partition._meta.schema and partition.select().where(partition.account == account_id).exists():
+                raise ArchiveError('Account #{0} has rows archived in {1} and cannot be removed'.format(
+                    account_id, partition._meta.schema[len('archive_'):]
+                ))
+    with db.atomic():
+        for model in (AccountTransaction, AccountBalance, MonthlyAggregate):
+            model.delete().where(model.account == account_id).execute()
+        account.delete_instance()
+    identity_map.clear()
+
+
+def add_balance_entry(account_id, day, balance):
+    check_writable([day - timedelta(days=1)])
+    exponent = identity_map.account(account_id).currency.exponent
+    existing = AccountBalance.select(AccountBalance.id).where(
+        AccountBalance.account == account_id,
+        AccountBalance.date == day
+    ).scalar()
+    if existing is not None:
+        raise ValueError('Account #{0} already has balance entry #{1} on {2}'.format(account_id, existing, day))
+    return AccountBalance.insert(
+        account=account_id,
+        date=day,
+        balance=to_minor_units(balance, exponent)
+    ).execute()
+
+
+def remove_balance_entry(entry_id):
+    entry = AccountBalance.get(AccountBalance.id == entry_id)
+    check_writable([entry.date - timedelta(days=1)])
+    entry.delete_instance()
+
+
+def remove_balance_entries(account_id, date_start):
+    check_writable([date_start - timedelta(days=1)])
+    return AccountBalance.delete().where(
+        AccountBalance.account == account_id,
+        AccountBalance.date >= date_start
+    ).execute()
+
+
+def balance_entries_on(day):
+    refresh_balances()
+    model = partition_of(AccountBalance, day)
+    query = model.select(
+        model.id,
+        model.account,
+        model.date,
+        model.balance
+    ).join(Account).where(model.date == day).order_by(model.id)
+    entries = []
+    for entry_id, account_id, entry_date, balance in query.tuples():
+        account = identity_map.account(account_id)
+        entries.append(BalanceEntry(entry_id, account, entry_date, from_minor_units(balance, account.currency.exponent)))
+    return entries
+
+
+def balances_on(day, accounts=None):
+    # Balances at the start of day, keyed by account id.
+    return dict(
+        (account_id, from_minor_units(balance, identity_map.account(account_id).currency.exponent))
+        for account_id, balance in balances_at(day, accounts).items()
+    )
+
+
+def balance_totals_on(day):
+    totals = defaultdict(lambda: [0, 0])
+    for account_id, balance in balances_at(day).items():
+        total = totals[identity_map.account(account_id).currency.id]
+        total[0] += balance
+        total[1] += 1
+    result = []
+    for currency_id in sorted(totals):
+        currency = identity_map.currency(currency_id)
+        balance, count = totals[currency_id]
+        result.append(BalanceTotal(currency, from_minor_units(balance, currency.exponent), count))
+    return result
+
+
+def transaction_row(account_id, timestamp, type, amount, comment, natural_key=None):
+    if not isinstance(type, TransactionType):
+        type = TransactionType[type] if isinstance(type, str) else TransactionType(type)
+    return {
+        'account': account_id,
+        'timestamp': timestamp,
+        'type': type.value,
+        'amount': to_minor_units(amount, identity_map.account(account_id).currency.exponent),
+        'comment': comment,
+        'natural_key': natural_key
+    }
+
+
+def add_transaction(account_id, timestamp, type, amount, comment):
+    check_writable([timestamp])
+    row = transaction_row(account_id, timestamp, type, amount, comment)
+    with db.atomic():
+        transaction_id = AccountTransaction.insert(**row).execute()
+        update_monthly_aggregates([(account_id, timestamp, row['type'], row['amount'])])
+        mark_balances_dirty([(account_id, timestamp)])
+    return transaction_id
+
+
+def add_transactions(rows, batch_size=1000):
+    # rows are (account_id, timestamp, type, amount, comment[, natural_key])
+    # tuples; type is a TransactionType, its name or its value. Rows whose
+    # natural key is already stored are skipped. Returns the number inserted.
+    inserted = 0
+    for _, batch_inserted in import_transaction_rows((transaction_row(*row) for row in rows), batch_size):
+        inserted += batch_inserted
+    return inserted
+
+
+def remove_transaction(transaction_id):
+    transaction = AccountTransaction.get(AccountTransaction.id == transaction_id)
+    check_writable([transaction.timestamp])
+    with db.atomic():
+        transaction.delete_instance()
+        update_monthly_aggregates([(transaction.account_id, transaction.timestamp, transaction.type, transaction.amount)], sign=-1)
+        mark_balances_dirty([(transaction.account_id, transaction.timestamp)])
+
+
+def transactions(date_start, date_end, accounts=None, types=None, exclude_accounts=None, exclude_ids=None):
+    # Transactions made in [date_start, date_end), in timestamp order.
+    rows = []
+    number = 0
+    for number, model in enumerate(partitions(AccountTransaction, date_start, date_end)):
+        query = model.select(
+            model.id,
+            model.account,
+            model.timestamp,
+            model.type,
+            model.amount,
+            model.comment
+        ).join(Account).where(
+            model.timestamp >= date_start,
+            model.timestamp < date_end
+        ).order_by(model.timestamp, model.id)
+        if accounts:
+            query = query.where(model.account.in_(accounts))
+        if types:
+            query = query.where(model.type.in_([TransactionType(type).value for type in types]))
+        if exclude_accounts:
+            query = query.where(model.account.not_in(exclude_accounts))
+        if exclude_ids:
+            query = query.where(model.id.not_in(exclude_ids))
+        rows.extend(query.tuples())
+    if number:
+        # The main table may hold years on both sides of an archived one.
+        rows.sort(key=lambda row: (row[2], row[0]))
+    result = []
+    for entry_id, account_id, timestamp, type, amount, comment in rows:
+        account = identity_map.account(account_id)
+        result.append(TransactionInfo(entry_id, account, timestamp, TransactionType(type), from_minor_units(amount, account.currency.exponent), comment))
+    return result
+
+
+def search_terms(text):
+    # (phrase, prefix) pairs: words match as they are, "quoted words" as a
+    # phrase, and a trailing * makes a word or phrase a prefix; every term
+    # must match. Anything else, FTS5 operators and column filters included,
+    # is taken literally.
+    terms = []
+    for phrase, phrase_prefix, word in re.findall(r'"([^"]*)"?(\*?)|([^\s"]+)', text):
+        prefix = bool(phrase_prefix) if phrase else word.endswith('*')
+        phrase = ' '.join(phrase.split()) if phrase else word.rstrip('*')
+        if phrase:
+            terms.append((phrase, prefix))
+    return terms
+
+
+def search_expression(terms):
+    return ' '.join('"{0}"{1}'.format(phrase, '*' if prefix else '') for phrase, prefix in terms)
+
+
+def search_schemas(date_start=None, date_end=None):
+    # The schemas of the partitions searched for [date_start, date_end), each
+    # yielded while its archive is attached, so that callers query one
+    # before asking for the next.
+    for model in partitions(AccountTransaction, date_start, date_end):
+        yield model._meta.schema or 'main'
+
+
+def search_filters(accounts=None, date_start=None, date_end=None):
+    # SQL conditions on the transactions t, each preceded by AND, and their
+    # parameters.
+    filters = []
+    params = []
+    if accounts:
+        filters.append('t.account_id IN ({0})'.format(', '.join('?' * len(accounts))))
+        params.extend(accounts)
+    if date_start is not None:
+        filters.append('t.timestamp >= ?')
+        params.append(str(date_start))
+    if date_end is not None:
+        filters.append('t.timestamp < ?')
+        params.append(str(date_end))
+    return ''.join(' AND ' + condition for condition in filters), params
+
+
+def search_count(schema, expression, filters='', filter_params=()):
+    if not filters:
+        return db.execute_sql(
+            'SELECT COUNT(*) FROM "{0}".transactionsearch WHERE transactionsearch MATCH ?'.format(schema),
+            (expression,),
+            require_commit=False
+        ).fetchone()[0]
+    # CROSS JOIN keeps SQLite from running the match once for every
+    # transaction of the filtered accounts instead.
+    return db.execute_sql(
+        'SELECT COUNT(*) FROM "{0}".transactionsearch AS s '
+        'CROSS JOIN "{0}".accounttransaction AS t ON t.id = s.rowid '
+        'WHERE s.transactionsearch MATCH ?{1}'.format(schema, filters),
+        [expression] + list(filter_params),
+        require_commit=False
+    ).fetchone()[0]
+
+
+# Ranking has SQLite score every match. Searches matching more transactions
+# than this, after the account and date filters, list the most recently
+# recorded matches first instead.
+RANKED_SEARCH_LIMIT = 10000
+
+
+def search_is_ranked(text, accounts=None, date_start=None, date_end=None):
+    # The matches of the indexes alone are cheaper to count, and decide
+    # when they are few already.
+    expression = search_expression(search_terms(text))
+    if not expression:
+        return True
+    if sum(search_count(schema, expression) for schema in search_schemas(date_start, date_end)) <= RANKED_SEARCH_LIMIT:
+        return True
+    filters, filter_params = search_filters(accounts, date_start, date_end)
+    if not filters:
+        return False
+    return sum(
+        search_count(schema, expression, filters, filter_params)
+        for schema in search_schemas(date_start, date_end)
+    ) <= RANKED_SEARCH_LIMIT
+
+
+def search_transactions(text, accounts=None, date_start=None, date_end=None, limit=20, offset=0, ranked=None):
+    # Transactions whose comment matches text, see search_terms(), best
+    # match first by bm25 and most recently recorded first among equals,
+    # optionally only of accounts and made in [date_start, date_end).
+    # ranked is what search_is_ranked() returns, for callers that asked it
+    # already.
+    terms = search_terms(text)
+    if not terms:
+        return []
+    expression = search_expression(terms)
+    if ranked is None:
+        ranked = search_is_ranked(text, accounts, date_start, date_end)
+
+    filters, filter_params = search_filters(accounts, date_start, date_end)
+    rows = []
+    for schema in search_schemas(date_start, date_end):
+        # Every partition has its own index, which ranks its matches by its
+        # own statistics; a page of the merged results needs at most
+        # offset + limit rows of each.
+        cursor = db.execute_sql(
+            'SELECT t.id, t.account_id, t.timestamp, t.type, t.amount, t.comment, {0} '
+            'FROM "{1}".transactionsearch AS s '
+            'JOIN "{1}".accounttransaction AS t ON t.id = s.rowid '
+            'JOIN account AS a ON a.id = t.account_id '
+            'WHERE s.transactionsearch MATCH ?{2} '
+            'ORDER BY {3}s.rowid DESC LIMIT {4}'.format(
+                's.rank' if ranked else '0',
+                schema,
+                filters,
+                's.rank, ' if ranked else '',
+                offset + limit
+            ),
+            [expression] + filter_params,
+            require_commit=False
+        )
+        rows.extend(cursor.fetchall())
+    rows.sort(key=lambda row: (row[6], -row[0]))
+    result = []
+    for entry_id, account_id, timestamp, type, amount, comment, _ in rows[offset:offset + limit]:
+        account = identity_map.account(account_id)
+        result.append(TransactionInfo(
+            entry_id,
+            account,
+            AccountTransaction.timestamp.python_value(timestamp),
+            TransactionType(type),
+            from_minor_units(amount, account.currency.exponent),
+            comment
+        ))
+    return result
+
+
+def monthly_totals(start, end, exclude_accounts=None, exclude_ids=None):
+    # Totals per currency and type over the months start to end inclusive,
+    # both given as (year, month).
+    (start_year, start_month), (end_year, end_month) = start, end
+    aggregate_expressions = [month_between(start_year, start_month, end_year, end_month)]
+    if exclude_accounts:
+        aggregate_expressions.append(MonthlyAggregate.account.not_in(exclude_accounts))
+    totals = sum_monthly_aggregates(*aggregate_expressions)
+    if not exclude_ids:
+        return totals
+
+    # Excluded transactions are taken back out of the aggregates.
+    date_start, _ = month_range(start_year, start_month)
+    _, date_end = month_range(end_year, end_month)
+    excluded = dict(
+        ((total.currency.id, total.type), total)
+        for total in sum_transactions(date_start, date_end, exclude_accounts=exclude_accounts, ids=exclude_ids)
+    )
+    result = []
+    for total in totals:
+        if (total.currency.id, total.type) in excluded:
+            excluded_total = excluded[(total.currency.id, total.type)]
+            total = total._replace(amount=total.amount - excluded_total.amount, count=total.count - excluded_total.count)
+        result.append(total)
+    return result
+
+
+def rebuild_aggregates():
+    with db.atomic():
+        rebuild_monthly_aggregates()
+    return MonthlyAggregate.select().count()
+
+
+def archive_path(year):
+    root, ext = os.path.splitext(db.database)
+    return '{0}-{1}{2}'.format(root, year, ext)
+
+
+def archive_year(year):
+    # Moves the transactions and balance entries of a closed year out of the
+    # main file into an archive next to it. Monthly aggregates stay in the
+    # main file. Returns the ArchivedYear row.
+    if year >= date.today().year:
+        raise ArchiveError('{0} is not closed yet'.format(year))
+    archives = identity_map.archives()
+    if year in archives:
+        raise ArchiveError('{0} is already archived'.format(year))
+    # ATTACH, DETACH and VACUUM cannot run inside a transaction.
+    if db.transaction_depth():
+        raise ArchiveError('Years cannot be archived inside a transaction')
+    date_start, date_end = date(year, 1, 1), date(year + 1, 1, 1)
+    refresh_balances()
+
+    # Every account gets an entry on the first day of the next year, kept in
+    # the main file and written along with the removal of the year; see
+    # balances_at().
+    closing = balances_at(date_end)
+    existing = set(account_id for account_id, in AccountBalance.select(AccountBalance.account).where(
+        AccountBalance.date == date_end
+    ).tuples())
+
+    moved = [
+        (AccountTransaction, AccountTransaction.timestamp, AccountTransaction.amount),
+        (AccountBalance, AccountBalance.date, AccountBalance.balance)
+    ]
+    checks = []
+    for model, field, value in moved:
+        # The balances of an archived year are worked out from its archive
+        # alone, so nothing older may be left in the main file.
+        first = model.select(fn.MIN(field)).scalar()
+        if first is not None and int(str(first)[:4]) < year:
+            raise ArchiveError('{0} is not archived yet; archive years oldest first'.format(str(first)[:4]))
+        in_year = (field >= date_start) & (field < date_end)
+        # SQLite hands out max(id) + 1, so rows left behind must keep the
+        # highest id or new rows would take the ids of archived ones.
+        kept, archived = [
+            model.select(fn.MAX(model.id)).where(expression).scalar()
+            for expression in (~in_year, in_year)
+        ]
+        newest_archived = archived is not None and (kept is None or kept < archived)
+        if model is AccountBalance:
+            # Written again, the entries of the next year become the newest;
+            # balance entry ids change on every recompute anyway.
+            renew = newest_archived
+        elif newest_archived:
+            raise ArchiveError('{0} holds the newest {1} rows, whose ids new rows would reuse; archive years oldest first'.format(
+                year, model._meta.db_table
+            ))
+        checks.append(model.select(fn.COUNT(model.id), fn.SUM(model.id), fn.SUM(value)).where(in_year).tuples()[0])
+
+    path = archive_path(year)
+    if os.path.exists(path):
+        os.unlink(path)
+    schema = archive_schema(year)
+    attach_archive(year, path, read_only=False)
+    try:
+        with db.atomic():
+            for (model, field, value), check in zip(moved, checks):
+                target = archive_model(model, year)
+                db.create_table(target)
+                table = model._meta.db_table
+                for columns, unique in model._meta.indexes:
+                    columns = [model._meta.fields[name].db_column for name in columns]
+                    # peewee would qualify the table name, which SQLite
+                    # refuses; the index names the schema instead.
+                    db.execute_sql('CREATE {0}INDEX "{1}"."{2}" ON "{3}" ({4})'.format(
+                        'UNIQUE ' if unique else '',
+                        schema,
+                        db.compiler().index_name(table, columns),
+                        table,
+                        ', '.join('"{0}"'.format(column) for column in columns)
+                    ))
+                fields = model._meta.sorted_fields
+                target.insert_from(
+                    [target._meta.fields[source.name] for source in fields],
+                    model.select(*fields).where(field >= date_start, field < date_end).order_by(model.id)
+                ).execute()
+                copied = target.select(fn.COUNT(target.id), fn.SUM(target.id), fn.SUM(getattr(target, value.name))).tuples()[0]
+                if copied != check:
+                    raise ArchiveError('{0} rows of {1} did not match after copying'.format(table, year))
+            for statement in search_index_statements(schema):
+                db.execute_sql(statement)
+        result = db.execute_sql('PRAGMA "{0}".quick_check'.format(schema), require_commit=False).fetchone()[0]
+        if result != 'ok':
+            raise ArchiveError('The archive of {0} failed its integrity check: {1}'.format(year, result))
+    except Exception:
+        db.execute_sql('DETACH DATABASE "{0}"'.format(schema), require_commit=False)
+        os.unlink(path)
+        raise
+    db.execute_sql('DETACH DATABASE "{0}"'.format(schema), require_commit=False)
+
+    with db.atomic():
+        if renew:
+            AccountBalance.delete().where(AccountBalance.date == date_end).execute()
+        bulk_insert(AccountBalance, [
+            {'account': account_id, 'date': date_end, 'balance': balance}
+            for account_id, balance in sorted(closing.items())
+            if renew or account_id not in existing
+        ])
+        for model, field, _ in moved:
+            model.delete().where(field >= date_start, field < date_end).execute()
+        archived = ArchivedYear.create(
+            year=year,
+            path=os.path.basename(path),
+            transactions=checks[0][0],
+            balances=checks[1][0]
+        )
+    identity_map.clear()
+    # Gives the space of the moved rows back.
+    db.execute_sql('VACUUM', require_commit=False)
+    return archived
+
+
+def account_report(account_id, date_start, date_end):
+    report = accounts_report(date_start, date_end, [account_id])[0]
+    return AccountReport(
+        report.account,
+        date_start,
+        report.opening,
+        report.credit + report.transfer_in,
+        report.debit + report.transfer_out,
+        date_end,
+        report.closing
+    )
+
+
+def accounts_report(date_start, date_end, accounts=None, workers=1):
+    # Opening and closing balances and the flows in between of every account
+    # (or of the accounts listed) for [date_start, date_end). discrepancy is
+    # what the closing balance differs by from the opening balance plus the
+    # flows: not zero when a balance entry in the period disagrees with the
+    # transactions. With workers > 1 the accounts are split between that
+    # many processes.
+    if date_end < date_start:
+        raise ValueError('The period ends on {0}, before it starts on {1}'.format(date_end, date_start))
+    if accounts is None:
+        accounts = identity_map.accounts()
+    else:
+        accounts = [identity_map.account(account_id) for account_id in accounts]
+    account_ids = [account.id for account in accounts]
+    if not account_ids:
+        return []
+    # Stale balance entries are rewritten here, so that the workers only read.
+    # Inside a transaction they would not see them, nor any other write not
+    # committed yet, so the accounts are then all read here.
+    refresh_balances(account_ids)
+    if db.transaction_depth():
+        workers = 1
+    shards = [account_ids[shard::workers] for shard in range(min(workers, len(account_ids)))]
+    if len(shards) > 1:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # Spawned rather than forked: a forked child would inherit the open
+        # SQLite connection.
+        flows = {}
+        with ProcessPoolExecutor(len(shards), mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [
+                executor.submit(period_flows_shard, db.database, db.connection_pragmas, shard, date_start, date_end)
+                for shard in shards
+            ]
+            for future in futures:
+                flows.update(future.result())
+    else:
+        flows = period_flows(account_ids, date_start, date_end)
+
+    reports = []
+    for account in accounts:
+        opening, credit, debit, transfer_in, transfer_out, closing = flows[account.id]
+        exponent = account.currency.exponent
+        reports.append(PeriodReport(
+            account,
+            from_minor_units(opening, exponent),
+            from_minor_units(credit, exponent),
+            from_minor_units(debit, exponent),
+            from_minor_units(transfer_in, exponent),
+            from_minor_units(transfer_out, exponent),
+            from_minor_units(closing, exponent),
+            from_minor_units(closing - (opening + credit - debit + transfer_in - transfer_out), exponent)
+        ))
+    return reports
+
+
+def add_exchange_rates(rows):
+    # rows are (currency code, date, rate) tuples; a rate already stored for
+    # the same currency and date is replaced. Returns the number written.
+    codes = dict((currency.code, currency.id) for currency in identity_map.currencies())
+    written = 0
+    with db.atomic():
+        for batch in chunked(rows, 1000):
+            entries = []
+            for code, rate_date, rate in batch:
+                if code not in codes:
+                    raise ExchangeRateError('Unknown currency "{0}"'.format(code))
+                entries.append({'currency': codes[code], 'date': rate_date, 'rate': float(rate)})
+            written += bulk_insert(ExchangeRate, entries, on_conflict='REPLACE')
+    return written
+
+
+def consolidated_balance_on(day, currency_code):
+    # Net worth at the start of day in a single currency.
+    target = currency_by_code(currency_code)
+    balances = balances_at(day)
+    account_ids = sorted(balances)
+    converted = convert_minor_units(
+        [identity_map.account(account_id).currency.id for account_id in account_ids],
+        [day] * len(account_ids),
+        [balances[account_id] for account_id in account_ids],
+        target.id
+    )
+    return BalanceTotal(target, from_minor_units(int(round(converted.sum())), target.exponent), len(account_ids))
+
+
+def consolidated_monthly_totals(start, end, currency_code, exclude_accounts=None):
+    # monthly_totals() in a single currency. Transactions are summed per
+    # currency, day and type in SQL, and every daily sum is converted at the
+    # rate of its day.
+    numpy = import_numpy()
+    target = currency_by_code(currency_code)
+    (start_year, start_month), (end_year, end_month) = start, end
+    date_start, _ = month_range(start_year, start_month)
+    _, date_end = month_range(end_year, end_month)
+    rows = []
+    for model in partitions(AccountTransaction, date_start, date_end):
+        day = fn.date(model.timestamp)
+        query = model.select(
+            Account.currency,
+            day,
+            model.type,
+            fn.SUM(model.amount),
+            fn.COUNT(model.id)
+        ).join(Account).where(
+            model.timestamp >= date_start,
+            model.timestamp < date_end
+        ).group_by(Account.currency, day, model.type)
+        if exclude_accounts:
+            query = query.where(model.account.not_in(exclude_accounts))
+        rows.extend(stream_tuples(query))
+    if not rows:
+        return []
+    currency_ids, days, types, amounts, counts = [numpy.array(column) for column in zip(*rows)]
+    converted = convert_minor_units(currency_ids, days, amounts, target.id)
+    totals = []
+    for type in sorted(set(types.tolist())):
+        mask = types == type
+        totals.append(TransactionTotal(
+            target,
+            TransactionType(type),
+            from_minor_units(int(round(converted[mask].sum())), target.exponent),
+            int(counts[mask].sum())
+        ))
+    return totals
+
+
+BalanceTimeseries = namedtuple('BalanceTimeseries', ['days', 'accounts', 'balances', 'currencies', 'totals', 'average_30', 'average_90', 'month_change'])
+
+# Days loaded before the start of a time series, so that its first days get
+# full rolling windows and a month-over-month change as well.
+TIMESERIES_HISTORY = 89
+
+
+def balance_timeseries(date_start, date_end, accounts=None, currency_code=None):
+    # Balances at the start of every day from date_start to date_end
+    # inclusive, as NumPy arrays of floats in major units: days is a
+    # datetime64[D] array, balances an accounts x days matrix and totals one
+    # row per currency, or a single row in currency_code, with its 30 and
+    # 90-day trailing averages and its change since a month earlier.
+    numpy = import_numpy()
+    if date_end < date_start:
+        raise ValueError('The period ends on {0}, before it starts on {1}'.format(date_end, date_start))
+    if accounts is None:
+        accounts = identity_map.accounts()
+    else:
+        accounts = [identity_map.account(account_id) for account_id in accounts]
+    first_day = date_start - timedelta(days=TIMESERIES_HISTORY)
+    days = numpy.arange(numpy.datetime64(first_day, 'D'), numpy.datetime64(date_end, 'D') + 1)
+    matrix = balance_matrix([account.id for account in accounts], first_day, len(days))
+
+    account_currencies = numpy.array([account.currency.id for account in accounts], dtype=numpy.int64)
+    currency_ids = sorted(set(account_currencies.tolist()))
+    currency_totals = numpy.zeros((len(currency_ids), len(days)), dtype=numpy.int64)
+    for row, currency_id in enumerate(currency_ids):
+        currency_totals[row] = matrix[account_currencies == currency_id].sum(axis=0)
+    if currency_code is None:
+        currencies = [identity_map.currency(currency_id) for currency_id in currency_ids]
+        totals = currency_totals / numpy.array([10.0 ** currency.exponent for currency in currencies])[:, None]
+    else:
+        # Days on which a currency holds nothing need no rate.
+        target = currency_by_code(currency_code)
+        currencies = [target]
+        rows, columns = numpy.nonzero(currency_totals)
+        converted = numpy.zeros(currency_totals.shape)
+        converted[rows, columns] = convert_minor_units(
+            numpy.array(currency_ids, dtype=numpy.int64)[rows],
+            days[columns],
+            currency_totals[rows, columns],
+            target.id
+        )
+        totals = converted.sum(axis=0)[None, :] / 10.0 ** target.exponent
+
+    previous = (month_earlier(days[TIMESERIES_HISTORY:]) - days[0]).astype(numpy.int64)
+    return BalanceTimeseries(
+        days[TIMESERIES_HISTORY:],
+        accounts,
+        matrix[:, TIMESERIES_HISTORY:] / numpy.array([10.0 ** account.currency.exponent for account in accounts]).reshape(-1, 1),
+        currencies,
+        totals[:, TIMESERIES_HISTORY:],
+        trailing_average(totals, 30, TIMESERIES_HISTORY),
+        trailing_average(totals, 90, TIMESERIES_HISTORY),
+        totals[:, TIMESERIES_HISTORY:] - totals[:, previous]
+    )
@@ -0,0 +1,232 @@
+import io
+import json
+import sys
+import time
+from collections import OrderedDict
+
+# Only these get an EXPLAIN QUERY PLAN; pragmas and transaction control have
+# no plan to show.
+PLANNED_STATEMENTS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+
+class Statement(object):
+    __slots__ = ('sql', 'params', 'elapsed', 'rows')
+
+    def __init__(self, sql, params):
+        self.sql = sql
+        self.params = params
+        self.elapsed = 0
+        self.rows = 0
+
+
+class TracedCursor(object):
+    # SQLite does most of the work of a query while its rows are stepped
+    # through, so fetching is timed and counted against the statement too.
+    def __init__(self, cursor, statement):
+        self._cursor = cursor
+        self._statement = statement
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    next = __next__
+
+    def fetchone(self):
+        time_start = time.perf_counter()
+        row = self._cursor.fetchone()
+        self._statement.elapsed += time.perf_counter() - time_start
+        if row is not None:
+            self._statement.rows += 1
+        return row
+
+    def fetchmany(self, *args):
+        time_start = time.perf_counter()
+        rows = self._cursor.fetchmany(*args)
+        self._statement.elapsed += time.perf_counter() - time_start
+        self._statement.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        time_start = time.perf_counter()
+        rows = self._cursor.fetchall()
+        self._statement.elapsed += time.perf_counter() - time_start
+        self._statement.rows += len(rows)
+        return rows
+
+
+class TimedStream(object):
+    # Wraps sys.stdout to measure the time spent writing command output.
+    def __init__(self, stream, profiler):
+        self._stream = stream
+        self._profiler = profiler
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def write(self, data):
+        time_start = time.perf_counter()
+        try:
+            return self._stream.write(data)
+        finally:
+            self._profiler.output_elapsed += time.perf_counter() - time_start
+
+    def flush(self):
+        time_start = time.perf_counter()
+        try:
+            return self._stream.flush()
+        finally:
+            self._profiler.output_elapsed += time.perf_counter() - time_start
+
+
+class Profiler(object):
+    # Records wall time per phase, every statement run through database with
+    # the rows fetched from it, and the time spent writing to stdout. With
+    # cprofile_path set, the run is also profiled by cProfile and the stats
+    # are dumped there.
+    def __init__(self, database, command, cprofile_path=None, top=5):
+        self.database = database
+        self.command = command
+        self.cprofile_path = cprofile_path
+        self.top = top
+        self.statements = []
+        self.phases = OrderedDict()
+        self.output_elapsed = 0
+        self._phase = None
+        self._phase_start = None
+        self._stdout = None
+        self._cprofile = None
+
+    def execute(self, execute_sql, sql, params, require_commit):
+        statement = Statement(sql, params)
+        self.statements.append(statement)
+        time_start = time.perf_counter()
+        try:
+            cursor = execute_sql(sql, params, require_commit)
+        finally:
+            statement.elapsed += time.perf_counter() - time_start
+        return TracedCursor(cursor, statement)
+
+    def start(self, phase):
+        self.database.tracer = self
+        self._stdout = sys.stdout
+        sys.stdout = TimedStream(sys.stdout, self)
+        if self.cprofile_path:
+            import cProfile
+
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        self.mark(phase)
+
+    def mark(self, phase):
+        # Ends the running phase, if any, and starts the next one.
+        now = time.perf_counter()
+        if self._phase is not None:
+            self.phases[self._phase] = self.phases.get(self._phase, 0) + now - self._phase_start
+        self._phase = phase
+        self._phase_start = now
+
+    def stop(self):
+        self.mark(None)
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(self.cprofile_path)
+        sys.stdout = self._stdout
+        self.database.tracer = None
+
+    def plan(self, statement):
+        if not statement.sql.lstrip().upper().startswith(PLANNED_STATEMENTS):
+            return []
+        try:
+            cursor = self.database.execute_sql('EXPLAIN QUERY PLAN ' + statement.sql, statement.params, require_commit=False)
+            return [row[-1] for row in cursor.fetchall()]
+        except Exception as error:
+            return ['unavailable: {0}'.format(error)]
+
+    def summary(self):
+        # Statements are grouped by their SQL text, so a query issued once per
+        # row (N+1) shows up as a single entry with a large call count.
+        groups = OrderedDict()
+        for statement in self.statements:
+            group = groups.get(statement.sql)
+            if group is None:
+                group = groups[statement.sql] = {
+                    'sql': statement.sql,
+                    'calls': 0,
+                    'elapsed': 0,
+                    'max': 0,
+                    'rows': 0,
+                    'slowest': statement
+                }
+            group['calls'] += 1
+            group['elapsed'] += statement.elapsed
+            group['rows'] += statement.rows
+            if statement.elapsed >= group['max']:
+                group['max'] = statement.elapsed
+                group['slowest'] = statement
+        slowest = sorted(groups.values(), key=lambda group: group['elapsed'], reverse=True)[:self.top]
+        for group in slowest:
+            group['plan'] = self.plan(group.pop('slowest'))
+
+        total = sum(self.phases.values())
+        sql_elapsed = sum(statement.elapsed for statement in self.statements)
+        return OrderedDict([
+            ('command', self.command),
+            ('phases', self.phases),
+            ('total', total),
+            ('sql', OrderedDict([
+                ('statements', len(self.statements)),
+                ('distinct', len(groups)),
+                ('elapsed', sql_elapsed),
+                ('rows', sum(statement.rows for statement in self.statements))
+            ])),
+            ('output', self.output_elapsed),
+            ('other', total - sql_elapsed - self.output_elapsed),
+            ('slowest', slowest),
+            ('cprofile', self.cprofile_path)
+        ])
+
+    def report(self, report_format='text', path=None):
+        self.stop()
+        summary = self.summary()
+        if report_format == 'json':
+            text = json.dumps(summary, indent=2) + '\n'
+        else:
+            text = format_summary(summary)
+        if path is None:
+            sys.stderr.write(text)
+        else:
+            with io.open(path, 'w', encoding='utf-8') as fp:
+                fp.write(text)
+
+
+def format_summary(summary):
+    lines = ['finctrl profile: {0}'.format(summary['command'])]
+    for phase, elapsed in summary['phases'].items():
+        lines.append('  {0:<10} {1:10.2f} ms'.format(phase, elapsed * 1000))
+    lines.append('  {0:<10} {1:10.2f} ms'.format('total', summary['total'] * 1000))
+    sql = summary['sql']
+    lines.append('  sql {0:.2f} ms in {1} statements ({2} distinct), {3} rows fetched'.format(
+        sql['elapsed'] * 1000, sql['statements'], sql['distinct'], sql['rows']
+    ))
+    lines.append('  output {0:.2f} ms, other {1:.2f} ms'.format(summary['output'] * 1000, summary['other'] * 1000))
+    if summary['slowest']:
+        lines.append('  slowest statements:')
+    for number, group in enumerate(summary['slowest'], 1):
+        lines.append('  {0}. {1:.2f} ms in {2} calls (max {3:.2f} ms), {4} rows'.format(
+            number, group['elapsed'] * 1000, group['calls'], group['max'] * 1000, group['rows']
+        ))
+        lines.append('     {0}'.format(group['sql']))
+        for detail in group['plan']:
+            lines.append('     plan: {0}'.format(detail))
+    if summary['cprofile']:
+        lines.append('  cProfile stats written to {0}'.format(summary['cprofile']))
+    return '\n'.join(lines) + '\n'
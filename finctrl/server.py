@@ -0,0 +1,285 @@
+import asyncio
+import json
+import os
+import signal
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from decimal import Decimal
+from enum import Enum
+from urllib.parse import parse_qs, urlsplit
+
+from finctrl import ledger
+
+HTTP_STATUSES = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    500: 'Internal Server Error'
+}
+
+
+class QueryError(Exception):
+    pass
+
+
+def plain(value):
+    # Namedtuples become objects, Decimals strings (no precision is lost)
+    # and dates ISO 8601 strings.
+    if hasattr(value, '_asdict'):
+        return OrderedDict((key, plain(item)) for key, item in value._asdict().items())
+    if isinstance(value, Enum):
+        return value.name
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return OrderedDict((str(key), plain(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [plain(item) for item in value]
+    return value
+
+
+def param(params, name, parse=str, default=None):
+    if name not in params:
+        if default is None:
+            raise QueryError('Missing parameter "{0}"'.format(name))
+        return default
+    try:
+        return parse(params[name][-1])
+    except ValueError:
+        raise QueryError('Invalid value for "{0}"'.format(name))
+
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def parse_month(value):
+    parsed = datetime.strptime(value, '%Y-%m')
+    return parsed.year, parsed.month
+
+
+def int_list(params, name):
+    try:
+        return [int(value) for value in params.get(name, [])]
+    except ValueError:
+        raise QueryError('Invalid value for "{0}"'.format(name))
+
+
+def query_accounts(params):
+    return ledger.accounts()
+
+
+def query_currencies(params):
+    return ledger.currencies()
+
+
+def query_transactions(params):
+    return ledger.transactions(
+        param(params, 'start', parse_date),
+        param(params, 'end', parse_date),
+        accounts=int_list(params, 'account')
+    )
+
+
+def query_balances(params):
+    return ledger.balances_on(
+        param(params, 'date', parse_date, date.today()),
+        int_list(params, 'account') or None
+    )
+
+
+def query_balance_report(params):
+    return ledger.balance_totals_on(param(params, 'date', parse_date, date.today()))
+
+
+def query_monthly_report(params):
+    start = param(params, 'start', parse_month)
+    return ledger.monthly_totals(
+        start,
+        param(params, 'end', parse_month, start),
+        exclude_accounts=int_list(params, 'exclude_account'),
+        exclude_ids=int_list(params, 'exclude_transaction')
+    )
+
+
+def period(params):
+    start = param(params, 'start', parse_date)
+    end = param(params, 'end', parse_date)
+    if end < start:
+        raise QueryError('"end" is before "start"')
+    return start, end
+
+
+def query_account_report(params):
+    start, end = period(params)
+    return ledger.account_report(param(params, 'account', int), start, end)
+
+
+def query_accounts_report(params):
+    start, end = period(params)
+    return ledger.accounts_report(start, end, accounts=int_list(params, 'account') or None)
+
+
+def query_search(params):
+    limit = param(params, 'limit', int, 20)
+    offset = param(params, 'offset', int, 0)
+    if limit < 1 or offset < 0:
+        raise QueryError('Invalid value for "{0}"'.format('limit' if limit < 1 else 'offset'))
+    return ledger.search_transactions(
+        param(params, 'q'),
+        accounts=int_list(params, 'account'),
+        date_start=param(params, 'start', parse_date) if 'start' in params else None,
+        date_end=param(params, 'end', parse_date) if 'end' in params else None,
+        limit=limit,
+        offset=offset
+    )
+
+
+QUERIES = {
+    '/accounts': query_accounts,
+    '/currencies': query_currencies,
+    '/transactions': query_transactions,
+    '/balances': query_balances,
+    '/balance-report': query_balance_report,
+    '/monthly-report': query_monthly_report,
+    '/account-report': query_account_report,
+    '/accounts-report': query_accounts_report,
+    '/search': query_search
+}
+
+
+class ResponseCache(object):
+    # LRU cache of encoded response bodies. It is emptied whenever SQLite's
+    # data_version moves, i.e. once any connection, in this process or
+    # another one, has committed a write, and when the day changes, as
+    # queries without a date answer for today.
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.data_version = None
+        self.today = None
+
+    def validate(self):
+        data_version = ledger.db.pragma('data_version')[0]
+        if data_version != self.data_version:
+            self.entries.clear()
+            ledger.identity_map.clear()
+            self.data_version = data_version
+        today = date.today()
+        if today != self.today:
+            self.entries.clear()
+            self.today = today
+
+    def get(self, key):
+        body = self.entries.get(key)
+        if body is not None:
+            self.entries.move_to_end(key)
+        return body
+
+    def put(self, key, body):
+        self.entries[key] = body
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+def run_query(query, params):
+    try:
+        return 200, json.dumps(plain(query(params)), ensure_ascii=False).encode('utf-8')
+    except QueryError as error:
+        return 400, json.dumps({'error': str(error)}).encode('utf-8')
+    except KeyError:
+        return 404, json.dumps({'error': 'Not found'}).encode('utf-8')
+
+
+class Server(object):
+    def __init__(self, workers, cache_size):
+        # peewee keeps one connection per thread, so every worker reads
+        # through its own SQLite connection.
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.cache = ResponseCache(cache_size)
+
+    async def respond(self, method, target):
+        if method != 'GET':
+            return 405, json.dumps({'error': 'Only GET is supported'}).encode('utf-8')
+        url = urlsplit(target)
+        query = QUERIES.get(url.path)
+        if query is None:
+            return 404, json.dumps({'error': 'Unknown path'}).encode('utf-8')
+        params = parse_qs(url.query)
+        key = (url.path, tuple(sorted((name, tuple(values)) for name, values in params.items())))
+        self.cache.validate()
+        body = self.cache.get(key)
+        if body is not None:
+            return 200, body
+        loop = asyncio.get_event_loop()
+        status, body = await loop.run_in_executor(self.executor, run_query, query, params)
+        if status == 200:
+            self.cache.put(key, body)
+        return status, body
+
+    async def handle(self, reader, writer):
+        # Minimal HTTP/1.1 with keep-alive: requests without a body only.
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                lines = head.decode('latin-1').split('\r\n')
+                try:
+                    method, target, version = lines[0].split(' ')
+                except ValueError:
+                    break
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    status, body = await self.respond(method, target)
+                except Exception as error:
+                    status, body = 500, json.dumps({'error': str(error)}).encode('utf-8')
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                writer.write('HTTP/1.1 {0} {1}\r\nContent-Type: application/json\r\nContent-Length: {2}\r\nConnection: {3}\r\n\r\n'.format(
+                    status,
+                    HTTP_STATUSES[status],
+                    len(body),
+                    'keep-alive' if keep_alive else 'close'
+                ).encode('latin-1') + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+
+
+def serve(host='127.0.0.1', port=8080, socket_path=None, workers=4, cache_size=256, ready=None):
+    # Runs until interrupted or terminated. ready, if given, is called with the listening
+    # address once the server accepts connections.
+    server = Server(workers, cache_size)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if socket_path:
+        listener = loop.run_until_complete(asyncio.start_unix_server(server.handle, path=socket_path))
+        address = socket_path
+    else:
+        listener = loop.run_until_complete(asyncio.start_server(server.handle, host, port))
+        address = '{0}:{1}'.format(*listener.sockets[0].getsockname()[:2])
+    if ready is not None:
+        ready(address)
+    if os.name == 'posix':
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        loop.run_until_complete(listener.wait_closed())
+        server.executor.shutdown()
+        loop.close()
+        if socket_path:
+            os.unlink(socket_path)
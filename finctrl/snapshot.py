@@ -0,0 +1,214 @@
+import io
+import json
+import os
+from itertools import islice
+
+from finctrl import ledger
+from finctrl.ledger import Account, AccountTransaction, fn
+
+# A snapshot is a directory holding the transactions of a ledger column by
+# column, one raw little-endian array per file, so that each column can be
+# memory-mapped as it is. Comments are concatenated UTF-8 in comments.heap,
+# row i spanning comment_end[i - 1] to comment_end[i]. snapshot.json is
+# written last and names the rows that are complete; anything appended past
+# them by an interrupted update is cut off by the next one.
+SNAPSHOT_VERSION = 2
+SNAPSHOT_COLUMNS = (
+    ('id', '<i8'),
+    ('timestamp', '<i8'),
+    ('account', '<i4'),
+    ('type', 'i1'),
+    ('amount', '<i8'),
+    ('comment_end', '<i8')
+)
+HEAP_FILE = 'comments.heap'
+HEADER_FILE = 'snapshot.json'
+SNAPSHOT_BATCH_SIZE = 100000
+
+
+def snapshot_path(database):
+    root, _ = os.path.splitext(database)
+    return root + '.snapshot'
+
+
+def read_header(path):
+    try:
+        with io.open(os.path.join(path, HEADER_FILE), encoding='utf-8') as fp:
+            header = json.load(fp)
+    except (IOError, ValueError):
+        return None
+    if header.get('version') != SNAPSHOT_VERSION:
+        return None
+    return header
+
+
+def write_header(path, header):
+    temporary = os.path.join(path, HEADER_FILE + '.tmp')
+    with io.open(temporary, 'w', encoding='utf-8') as fp:
+        json.dump(header, fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(temporary, os.path.join(path, HEADER_FILE))
+
+
+def partition_query(model, *fields):
+    # Archives keep the rows of accounts removed since, which the join
+    # leaves out; the main table has none.
+    query = model.select(*fields)
+    if model is not AccountTransaction:
+        query = query.join(Account)
+    return query
+
+
+def row_query(model):
+    # (id, epoch seconds, account, type, amount, comment) of the transactions
+    # of a partition. strftime() yields text, which adding 0 turns into an
+    # integer.
+    return partition_query(
+        model,
+        model.id,
+        fn.strftime('%s', model.timestamp) + 0,
+        model.account,
+        model.type,
+        model.amount,
+        model.comment
+    )
+
+
+def snapshot_rows(last_id):
+    # The rows of the transactions with ids above last_id, in every partition.
+    for model in ledger.partitions(AccountTransaction):
+        query = row_query(model).where(model.id > last_id).order_by(model.id)
+        for row in ledger.stream_tuples(query):
+            yield row
+
+
+def append_rows(path, rows, heap_bytes):
+    numpy = ledger.import_numpy()
+    ids, timestamps, accounts, types, amounts, comments = zip(*rows)
+    encoded = [(comment or '').encode('utf-8') for comment in comments]
+    lengths = numpy.fromiter((len(comment) for comment in encoded), dtype=numpy.int64, count=len(encoded))
+    columns = {
+        'id': ids,
+        'timestamp': timestamps,
+        'account': accounts,
+        'type': types,
+        'amount': amounts,
+        'comment_end': numpy.cumsum(lengths) + heap_bytes
+    }
+    for name, dtype in SNAPSHOT_COLUMNS:
+        with io.open(os.path.join(path, name), 'ab') as fp:
+            numpy.asarray(columns[name], dtype=dtype).tofile(fp)
+    with io.open(os.path.join(path, HEAP_FILE), 'ab') as fp:
+        fp.write(b''.join(encoded))
+    return heap_bytes + int(lengths.sum()), max(ids)
+
+
+def truncate(path, header):
+    # Cuts every file back to the rows the header names.
+    numpy = ledger.import_numpy()
+    for name, dtype in SNAPSHOT_COLUMNS:
+        with io.open(os.path.join(path, name), 'ab') as fp:
+            fp.truncate(header['rows'] * numpy.dtype(dtype).itemsize)
+    with io.open(os.path.join(path, HEAP_FILE), 'ab') as fp:
+        fp.truncate(header['heap_bytes'])
+
+
+def snapshot_is_current(header):
+    # Whether the snapshot only lacks rows added since. SQLite gives a new
+    # row max(id) + 1, so the ids of the newest rows are handed out again
+    # once they are removed, but never an id below one still in use.
+    # Removed or archived transactions change the count of rows up to the
+    # last id; a reused id, if the count is made up again, changes the row
+    # at the last id.
+    count = 0
+    last_rows = []
+    for model in ledger.partitions(AccountTransaction):
+        count += partition_query(model, fn.COUNT(model.id)).where(model.id <= header['last_id']).scalar()
+        last_rows.extend(list(row) for row in row_query(model).where(model.id == header['last_id']).tuples())
+    if count != header['rows']:
+        return False
+    return not count or last_rows == [header['last_row']]
+
+
+def update_snapshot(path, rebuild=False):
+    # Appends the transactions added since the snapshot at path was taken,
+    # or writes it from scratch when there is none, it is out of date or
+    # rebuild is set. Returns the header and the number of rows written.
+    header = None if rebuild else read_header(path)
+    if header is not None and not snapshot_is_current(header):
+        header = None
+    if header is None:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        header = {'version': SNAPSHOT_VERSION, 'rows': 0, 'last_id': 0, 'last_row': None, 'heap_bytes': 0}
+    truncate(path, header)
+
+    written = 0
+    rows = snapshot_rows(header['last_id'])
+    while True:
+        batch = list(islice(rows, SNAPSHOT_BATCH_SIZE))
+        if not batch:
+            break
+        header['heap_bytes'], last_id = append_rows(path, batch, header['heap_bytes'])
+        if last_id > header['last_id']:
+            header['last_id'] = last_id
+            header['last_row'] = list(max(batch))
+        header['rows'] += len(batch)
+        written += len(batch)
+    write_header(path, header)
+    return header, written
+
+
+class Snapshot(object):
+    # The columns of a snapshot as read-only memory maps, e.g.
+    # snapshot.amount[snapshot.account == 3].sum(). Timestamps are seconds
+    # since the epoch of the stored local times, amounts are in minor units.
+    def __init__(self, path):
+        numpy = ledger.import_numpy()
+        header = read_header(path)
+        if header is None:
+            raise IOError('No snapshot at {0}, run the snapshot command first'.format(path))
+        self.path = path
+        self.rows = header['rows']
+        self.last_id = header['last_id']
+        for name, dtype in SNAPSHOT_COLUMNS:
+            setattr(self, name, self._map(numpy, name, dtype, self.rows))
+        self.heap = self._map(numpy, HEAP_FILE, 'u1', header['heap_bytes'])
+
+    def _map(self, numpy, name, dtype, count):
+        # A memory map cannot be empty.
+        if not count:
+            return numpy.zeros(0, dtype=dtype)
+        return numpy.memmap(os.path.join(self.path, name), dtype=dtype, mode='r', shape=(count,))
+
+    def __len__(self):
+        return self.rows
+
+    def comment(self, row):
+        start = self.comment_end[row - 1] if row else 0
+        return bytes(self.heap[start:self.comment_end[row]]).decode('utf-8')
+
+
+def monthly_sums(snapshot, accounts=None):
+    # Amounts summed per month and transaction type: returns the months as
+    # datetime64[M] and a months x types matrix in minor units, column
+    # type - 1 holding TransactionType(type).
+    numpy = ledger.import_numpy()
+    timestamps, types, amounts = snapshot.timestamp, snapshot.type, snapshot.amount
+    if accounts is not None:
+        selected = numpy.isin(snapshot.account, accounts)
+        timestamps, types, amounts = timestamps[selected], types[selected], amounts[selected]
+    if not len(timestamps):
+        return numpy.zeros(0, dtype='datetime64[M]'), numpy.zeros((0, 4), dtype=numpy.int64)
+    # Calendar arithmetic on every row is slow; it is done once per day of
+    # the range instead and looked up.
+    days = timestamps // 86400
+    first_day = days.min()
+    day_months = numpy.arange(first_day, days.max() + 1).astype('datetime64[D]').astype('datetime64[M]').astype(numpy.int64)
+    first_month = day_months[0]
+    num_months = int(day_months[-1] - first_month) + 1
+    cells = (day_months[days - first_day] - first_month) * 4 + types - 1
+    # bincount() sums in float64, exact while a sum stays below 2 ** 53.
+    sums = numpy.bincount(cells, weights=amounts, minlength=num_months * 4)
+    return numpy.arange(first_month, first_month + num_months).astype('datetime64[M]'), sums.reshape(num_months, 4).astype(numpy.int64)
@@ -26,6 +26,9 @@ setup(
         'Cython>=0.26',
         'click==6.7'
     ],
+    extras_require={
+        'numpy': ['numpy>=1.13']
+    },
     entry_points={
         'console_scripts': [
             'finctrl = finctrl:cli',
@@ -0,0 +1,29 @@
+import pytest
+from click.testing import CliRunner
+
+from finctrl import cli, ledger
+
+
+@pytest.fixture
+def database(tmpdir):
+    path = str(tmpdir.join('finance.db'))
+    ledger.use_database(path)
+    yield path
+    ledger.db.close()
+
+
+@pytest.fixture
+def invoke(database):
+    # Runs a command against the ledger of the test. The output of the
+    # result holds both what the command writes to stdout and to stderr.
+    def invoke(*argv):
+        return CliRunner().invoke(cli, ['--database', database] + list(argv))
+    return invoke
+
+
+@pytest.fixture
+def cash(invoke):
+    # Account #1 in rubles.
+    invoke('create_currency', 'Ruble', 'RUB', 'R')
+    invoke('create_account', 'Cash', 'RUB')
+    return 1
@@ -0,0 +1,120 @@
+import os
+from datetime import date, datetime
+
+import pytest
+
+from finctrl import ledger
+from finctrl.ledger import TransactionType
+
+
+@pytest.fixture
+def accounts(database):
+    ledger.create_currency('Euro', 'EUR', 'EUR')
+    return ledger.create_account('Cash', 'EUR'), ledger.create_account('Old', 'EUR')
+
+
+def test_account_with_archived_rows_cannot_be_removed(accounts):
+    cash, old = accounts
+    ledger.add_transaction(old, datetime(2020, 5, 1), TransactionType.DEBIT, 10, 'old rent')
+    ledger.add_transaction(cash, datetime(2021, 5, 1), TransactionType.DEBIT, 5, 'coffee')
+    ledger.archive_year(2020)
+
+    with pytest.raises(ledger.ArchiveError):
+        ledger.remove_account(old)
+    assert [account.id for account in ledger.accounts()] == [cash, old]
+    new = ledger.create_account('New', 'EUR')
+    assert new not in (cash, old)
+    found = ledger.search_transactions('rent')
+    assert [(transaction.account.name, transaction.comment) for transaction in found] == [('Old', 'old rent')]
+    assert ledger.balances_on(date(2021, 1, 1), [old])[old] == -10
+
+
+def test_account_without_archived_rows_can_be_removed(accounts):
+    cash, old = accounts
+    ledger.add_transaction(cash, datetime(2020, 5, 1), TransactionType.DEBIT, 10, 'rent')
+    ledger.add_transaction(old, datetime(2021, 5, 1), TransactionType.DEBIT, 5, 'coffee')
+    ledger.archive_year(2020)
+
+    ledger.remove_account(old)
+    assert [account.id for account in ledger.accounts()] == [cash]
+
+
+def test_archive_year_moves_rows_and_keeps_answers(accounts):
+    cash, old = accounts
+    for year in (2020, 2021, 2022):
+        ledger.add_transaction(cash, datetime(year, 3, 1), TransactionType.CREDIT, 100, 'salary {0}'.format(year))
+        ledger.add_transaction(cash, datetime(year, 3, 2), TransactionType.DEBIT, 30, 'rent {0}'.format(year))
+    ledger.add_balance_entry(cash, date(2020, 1, 1), 10)
+    days = [date(2020, 6, 1), date(2021, 1, 1), date(2021, 6, 1), date(2023, 1, 1)]
+    balances = [ledger.balances_on(day, [cash])[cash] for day in days]
+    listed = ledger.transactions(date(2020, 1, 1), date(2023, 1, 1))
+    monthly = ledger.monthly_totals((2020, 1), (2021, 12))
+
+    archived = ledger.archive_year(2020)
+    assert (archived.year, archived.transactions, archived.balances) == (2020, 2, 1)
+    assert os.path.exists(ledger.archive_path(2020))
+    assert ledger.AccountTransaction.select().where(ledger.AccountTransaction.timestamp < date(2021, 1, 1)).count() == 0
+    ledger.archive_year(2021)
+
+    assert [ledger.balances_on(day, [cash])[cash] for day in days] == balances
+    assert ledger.transactions(date(2020, 1, 1), date(2023, 1, 1)) == listed
+    assert ledger.monthly_totals((2020, 1), (2021, 12)) == monthly
+    assert [transaction.comment for transaction in ledger.search_transactions('salary')] == ['salary 2022', 'salary 2021', 'salary 2020']
+
+
+def test_archived_years_are_read_only(accounts):
+    cash, _ = accounts
+    ledger.add_transaction(cash, datetime(2020, 3, 1), TransactionType.CREDIT, 100, 'salary')
+    ledger.add_transaction(cash, datetime(2022, 3, 1), TransactionType.CREDIT, 100, 'salary')
+    ledger.archive_year(2020)
+    with pytest.raises(ledger.ArchiveError):
+        ledger.add_transaction(cash, datetime(2020, 5, 1), TransactionType.DEBIT, 1, 'late')
+    with pytest.raises(ledger.ArchiveError):
+        ledger.add_balance_entry(cash, date(2020, 5, 1), 1)
+    with pytest.raises(ledger.ArchiveError):
+        ledger.archive_year(2020)
+    with pytest.raises(ledger.ArchiveError):
+        ledger.archive_year(date.today().year)
+    ledger.add_transaction(cash, datetime(2021, 5, 1), TransactionType.DEBIT, 1, 'late')
+
+
+def test_years_are_archived_oldest_first(accounts):
+    cash, _ = accounts
+    for year in (2020, 2021, 2022):
+        ledger.add_transaction(cash, datetime(year, 3, 1), TransactionType.CREDIT, 100, 'salary')
+    with pytest.raises(ledger.ArchiveError) as error:
+        ledger.archive_year(2021)
+    assert '2020 is not archived yet' in str(error.value)
+    assert not os.path.exists(ledger.archive_path(2021))
+
+
+def test_partitions(accounts):
+    cash, _ = accounts
+    for year in (2020, 2021, 2022):
+        ledger.add_transaction(cash, datetime(year, 3, 1), TransactionType.CREDIT, 100, 'salary')
+    ledger.archive_year(2020)
+    ledger.archive_year(2021)
+
+    def schemas(date_start, date_end):
+        return [model._meta.schema for model in ledger.partitions(ledger.AccountTransaction, date_start, date_end)]
+
+    assert schemas(None, None) == ['archive_2020', 'archive_2021', None]
+    assert schemas(date(2020, 5, 1), date(2021, 1, 1)) == ['archive_2020']
+    assert schemas(date(2020, 5, 1), date(2021, 1, 2)) == ['archive_2020', 'archive_2021']
+    assert schemas(date(2021, 12, 31), date(2022, 1, 2)) == ['archive_2021', None]
+    assert schemas(date(2022, 1, 1), None) == [None]
+    assert ledger.partition_of(ledger.AccountBalance, date(2021, 7, 1))._meta.schema == 'archive_2021'
+
+
+def test_first_year_of_a_ledger_archives(invoke):
+    # A ledger seeded in the middle of a year has no entries on its first
+    # day. archive_year() used to add them first, with the newest ids, and
+    # then refuse the year for holding the newest rows.
+    invoke('create_currency', 'Ruble', 'RUB', 'R')
+    invoke('create_account', 'Cash', 'RUB')
+    invoke('create_account_balance_entry', '1', '2024', '3', '10', '100.50')
+    invoke('create_account_transaction', '1', 'DEBIT', '5.15', 'lunch', '2024', '3', '12', '12', '0', '0')
+    invoke('create_account_transaction', '1', 'CREDIT', '20.00', 'refund', '2025', '2', '1', '12', '0', '0')
+    balances = [invoke('balance_at', '1', '2024', str(month), '15').output for month in (3, 12)]
+    assert invoke('archive_year', '2024').output.split(' into ')[0] == 'Archived 1 transactions and 1 balance entries of 2024'
+    assert [invoke('balance_at', '1', '2024', str(month), '15').output for month in (3, 12)] == balances
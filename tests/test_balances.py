@@ -0,0 +1,80 @@
+from datetime import date, datetime
+from decimal import Decimal
+
+from finctrl import ledger
+from finctrl.ledger import TransactionType
+
+
+def test_roll_forward_fills_days_from_the_last_entry(cash):
+    ledger.add_balance_entry(cash, date(2024, 1, 1), Decimal('100.00'))
+    ledger.add_transaction(cash, datetime(2024, 1, 1, 12), TransactionType.DEBIT, Decimal('30.00'), 'lunch')
+    ledger.add_transaction(cash, datetime(2024, 1, 2, 9), TransactionType.CREDIT, Decimal('5.50'), 'refund')
+    ledger.add_transaction(cash, datetime(2024, 1, 2, 18), TransactionType.TRANSFER_OUT, Decimal('10.00'), 'savings')
+    rolled = ledger.roll_forward_balances(date(2024, 1, 2), date(2024, 1, 4))
+    assert [(entry.date, entry.entry_id, entry.balance) for entry in rolled] == [
+        (date(2024, 1, 2), None, Decimal('70.00')),
+        (date(2024, 1, 3), None, Decimal('65.50')),
+        (date(2024, 1, 4), None, Decimal('65.50')),
+    ]
+    assert [(entry.date, entry.balance) for entry in ledger.balance_entries_on(date(2024, 1, 3))] == [
+        (date(2024, 1, 3), Decimal('65.50'))
+    ]
+
+
+def test_roll_forward_keeps_existing_entries_as_seeds(cash):
+    ledger.add_balance_entry(cash, date(2024, 1, 1), Decimal('100.00'))
+    entry_id = ledger.add_balance_entry(cash, date(2024, 1, 3), Decimal('50.00'))
+    ledger.add_transaction(cash, datetime(2024, 1, 3, 12), TransactionType.DEBIT, Decimal('1.00'), 'coffee')
+    rolled = ledger.roll_forward_balances(date(2024, 1, 2), date(2024, 1, 4))
+    assert [(entry.date, entry.entry_id, entry.balance) for entry in rolled] == [
+        (date(2024, 1, 2), None, Decimal('100.00')),
+        (date(2024, 1, 3), entry_id, Decimal('50.00')),
+        (date(2024, 1, 4), None, Decimal('49.00')),
+    ]
+
+
+def test_roll_forward_reports_days_without_a_seed(cash):
+    rolled = ledger.roll_forward_balances(date(2024, 1, 2), date(2024, 1, 3))
+    assert [(entry.date, entry.balance) for entry in rolled] == [(date(2024, 1, 2), None), (date(2024, 1, 3), None)]
+    assert ledger.balance_entries_on(date(2024, 1, 2)) == []
+
+
+def test_backdated_write_keeps_opening_balance(invoke, cash):
+    # A transaction dated before the first balance entry of an account used
+    # to recompute that entry, and every later one, from zero.
+    invoke('create_account_balance_entry', '1', '2024', '1', '10', '100.50')
+    invoke('create_account_transaction', '1', 'DEBIT', '5.15', 'lunch', '2024', '1', '12', '12', '0', '0')
+    invoke('create_account_balance_entry', '1', '2024', '1', '15', '95.35')
+    invoke('create_account_transaction', '1', 'DEBIT', '3.00', 'old fee', '2024', '1', '5', '12', '0', '0')
+    assert invoke('list_account_balance_entries', '2024', '1', '10').output == '#1 "Cash" 2024-01-10 100.50 R\n'
+    assert invoke('list_account_balance_entries', '2024', '1', '15').output == '#2 "Cash" 2024-01-15 95.35 R\n'
+    invoke('remove_account_transaction', '2')
+    assert invoke('list_account_balance_entries', '2024', '1', '10').output == '#1 "Cash" 2024-01-10 100.50 R\n'
+
+
+def test_amounts_finer_than_the_currency_are_refused(invoke, cash):
+    # 1.234 was stored as 1.23 without a word.
+    result = invoke('create_account_transaction', '1', 'DEBIT', '1.234', 'lunch', '2024', '1', '12', '12', '0', '0')
+    assert result.exit_code == 1
+    assert 'Invalid amount "1.234", the currency has 2 decimal places' in result.output
+    result = invoke('create_account_balance_entry', '1', '2024', '1', '10', '100.505')
+    assert result.exit_code == 1
+    assert 'Invalid amount "100.505", the currency has 2 decimal places' in result.output
+    invoke('create_account_transaction', '1', 'DEBIT', '1.230', 'lunch', '2024', '1', '12', '12', '0', '0')
+    assert invoke('list_account_transactions', '2024', '1', '12').output == '#1 "Cash" 2024-01-12 12:00:00 DEBIT 1.23 R "lunch"\n'
+
+
+def test_second_balance_entry_on_a_day_is_refused(invoke, cash):
+    # The unique index on (account, date) failed such an entry with an
+    # IntegrityError traceback.
+    invoke('create_account_balance_entry', '1', '2024', '1', '10', '100.50')
+    result = invoke('create_account_balance_entry', '1', '2024', '1', '10', '90.00')
+    assert result.exit_code == 1
+    assert 'Account #1 already has balance entry #1 on 2024-01-10' in result.output
+
+
+def test_balance_at_unknown_account(invoke, cash):
+    # Used to end in a KeyError traceback.
+    result = invoke('balance_at', '99', '2024', '1', '10')
+    assert result.exit_code == 1
+    assert 'Unknown account #99' in result.output
@@ -0,0 +1,62 @@
+import os
+import sqlite3
+
+import pytest
+from click.testing import CliRunner
+
+from finctrl import cli, ledger
+
+
+def run_batch(database, script, *options, **kwargs):
+    pragmas = ['--pragma={0}'.format(pragma) for pragma in kwargs.get('pragmas', [])]
+    return CliRunner().invoke(cli, ['--database', database] + pragmas + ['batch'] + list(options), input=script)
+
+
+def test_malformed_json_line_is_reported_with_its_number(database):
+    result = run_batch(database, '{"command": "create_currency", "args": ["Euro", "EUR", "EUR"]}\n{"command": \n')
+    assert result.exit_code == 1
+    assert 'Line 2 failed with UsageError: cannot be parsed' in result.output
+    assert ledger.currencies() == []
+
+
+def test_json_line_without_command_is_reported(database):
+    result = run_batch(database, '{"args": ["Euro", "EUR", "EUR"]}\n')
+    assert result.exit_code == 1
+    assert 'Line 1 failed with UsageError: cannot be parsed' in result.output
+
+
+def test_malformed_shell_line_is_skipped_with_keep_going(database):
+    script = 'create_currency Euro EUR "EUR\n\ncreate_currency Dollar USD USD\n'
+    result = run_batch(database, script, '--group-size', '1', '--keep-going')
+    assert result.exit_code == 1
+    assert 'Line 1 failed with UsageError: cannot be parsed: No closing quotation' in result.output
+    assert [currency.code for currency in ledger.currencies()] == ['USD']
+
+
+def test_group_that_cannot_begin_is_reported_with_its_lines(database, monkeypatch):
+    monkeypatch.setattr(ledger.db, 'begin_retries', 0)
+    locker = sqlite3.connect(database, isolation_level=None)
+    locker.execute('BEGIN IMMEDIATE')
+    try:
+        script = 'create_currency Euro EUR EUR\ncreate_currency Dollar USD USD\n'
+        result = run_batch(database, script, '--group-size', '1', '--keep-going', pragmas=['busy_timeout=0'])
+    finally:
+        locker.execute('ROLLBACK')
+        locker.close()
+    assert result.exit_code == 1
+    assert 'Lines 1-1 failed with OperationalError: database is locked' in result.output
+    assert 'Lines 2-2 failed with OperationalError: database is locked' in result.output
+
+
+@pytest.mark.parametrize('command', ['archive_year 2021', 'serve', 'snapshot', 'batch'])
+def test_commands_that_cannot_run_in_a_transaction_are_refused(invoke, cash, tmpdir, command):
+    # archive_year in a batch failed on its attached archive, and left the
+    # archive file behind; serve would never have returned.
+    invoke('create_account_transaction', '1', 'DEBIT', '5.15', 'lunch', '2021', '3', '12', '12', '0', '0')
+    path = tmpdir.join('script.batch')
+    path.write('create_account Card RUB\n{0}\n'.format(command))
+    result = invoke('batch', str(path))
+    assert result.exit_code == 1
+    assert '{0} cannot run in a batch'.format(command.split()[0]) in result.output
+    assert invoke('list_accounts').output == '#1 "Cash" RUB\n'
+    assert sorted(name for name in os.listdir(str(tmpdir)) if name.endswith('.db')) == ['finance.db']
@@ -0,0 +1,72 @@
+from datetime import date
+from decimal import Decimal
+
+import pytest
+
+from finctrl import ledger
+
+
+@pytest.fixture
+def currencies(database):
+    for name, code in (('Euro', 'EUR'), ('Dollar', 'USD'), ('Pound', 'GBP')):
+        ledger.create_currency(name, code, code)
+    ledger.add_exchange_rates([('USD', date(2020, 1, 1), '0.5'), ('GBP', date(2020, 1, 1), '2')])
+    return dict((currency.code, currency.id) for currency in ledger.currencies())
+
+
+def test_convert_into_base_currency_without_rates(currencies):
+    converted = ledger.convert_minor_units(
+        [currencies['USD'], currencies['EUR']],
+        [date(2020, 6, 1)] * 2,
+        [1000, 300],
+        currencies['EUR']
+    )
+    assert converted.tolist() == [500.0, 300.0]
+
+
+def test_convert_from_base_currency_without_rates(currencies):
+    converted = ledger.convert_minor_units([currencies['EUR']], [date(2020, 6, 1)], [500], currencies['USD'])
+    assert converted.tolist() == [1000.0]
+
+
+def test_convert_between_currencies_other_than_the_base(currencies):
+    converted = ledger.convert_minor_units([currencies['GBP']], [date(2020, 6, 1)], [1000], currencies['USD'])
+    assert converted.tolist() == [4000.0]
+
+
+def test_convert_refuses_currency_without_rates_that_is_not_the_base(database):
+    # EUR is the base; GBP has no rates yet, so neither can be told to be it.
+    for name, code in (('Euro', 'EUR'), ('Dollar', 'USD'), ('Pound', 'GBP')):
+        ledger.create_currency(name, code, code)
+    ledger.add_exchange_rates([('USD', date(2020, 1, 1), '0.5')])
+    pounds = ledger.create_account('Savings', 'GBP')
+    ledger.add_balance_entry(pounds, date(2020, 6, 1), Decimal('10.00'))
+    with pytest.raises(ledger.ExchangeRateError) as error:
+        ledger.consolidated_balance_on(date(2020, 6, 2), 'USD')
+    assert 'No exchange rates for GBP' in str(error.value)
+    with pytest.raises(ledger.ExchangeRateError) as error:
+        ledger.convert_minor_units([ledger.currency_by_code('USD').id], [date(2020, 6, 1)], [100], ledger.currency_by_code('EUR').id)
+    assert 'No exchange rates for EUR' in str(error.value)
+
+
+def test_consolidated_balance_in_base_currency(currencies):
+    euros = ledger.create_account('Cash', 'EUR')
+    dollars = ledger.create_account('Card', 'USD')
+    ledger.add_balance_entry(euros, date(2020, 6, 1), Decimal('3.00'))
+    ledger.add_balance_entry(dollars, date(2020, 6, 1), Decimal('10.00'))
+    total = ledger.consolidated_balance_on(date(2020, 6, 2), 'EUR')
+    assert total.balance == Decimal('8.00')
+
+
+@pytest.mark.parametrize('content, message', [
+    ('date,currency,rate\n2020-01-01,USD,0.5\n2020-01-02,USD,abc\n', 'Line 3: Unrecognized rate "abc"'),
+    ('date,currency,rate\n2020/01/01,USD,0.5\n', 'Line 2: Unrecognized timestamp "2020/01/01"'),
+    ('date,rate\n2020-01-01,0.5\n', 'Line 2: no currency'),
+])
+def test_import_exchange_rates_reports_unreadable_lines(invoke, currencies, tmpdir, content, message):
+    path = tmpdir.join('rates.csv')
+    path.write(content)
+    result = invoke('import_exchange_rates', str(path))
+    assert result.exit_code == 1
+    assert message in result.output
+    assert ledger.load_exchange_rates([currencies['USD']])[currencies['USD']][1].tolist() == [0.5]
@@ -0,0 +1,25 @@
+from datetime import datetime
+
+import pytest
+
+from finctrl import ledger
+from finctrl.ledger import TransactionType
+
+
+@pytest.mark.parametrize('value', ['2024/01/01', 'yesterday'])
+def test_export_refuses_malformed_dates(invoke, value):
+    result = invoke('export', 'transactions', '--start-date', value)
+    assert result.exit_code == 2
+    assert 'Invalid value for "--start-date": expected YYYY-MM-DD, got "{0}"'.format(value) in result.output
+
+
+def test_export_transactions_in_range(invoke):
+    ledger.create_currency('Euro', 'EUR', 'EUR')
+    account_id = ledger.create_account('Cash', 'EUR')
+    for day in (1, 2, 3):
+        ledger.add_transaction(account_id, datetime(2024, 1, day), TransactionType.DEBIT, day, 'day {0}'.format(day))
+    result = invoke('export', 'transactions', '--start-date', '2024-01-02', '--end-date', '2024-01-03')
+    assert result.exit_code == 0
+    lines = result.output.splitlines()
+    assert len(lines) == 2
+    assert 'day 2' in lines[1]
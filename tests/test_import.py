@@ -0,0 +1,82 @@
+import pytest
+
+from finctrl import ledger
+
+OFX = '''OFXHEADER:100
+<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS><BANKTRANLIST>
+<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20240105120000<TRNAMT>-3.50<FITID>A1<NAME>coffee</STMTTRN>
+<STMTTRN><TRNTYPE>XFER<DTPOSTED>20240106<TRNAMT>-50.00<FITID>A2<MEMO>savings</STMTTRN>
+<STMTTRN><TRNTYPE>CREDIT<DTPOSTED>20240107<TRNAMT>100.00<FITID>A3<NAME>salary</STMTTRN>
+</BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>
+'''
+
+
+@pytest.fixture
+def statement(tmpdir):
+    def statement(content, name='statement.csv'):
+        path = tmpdir.join(name)
+        path.write(content)
+        return str(path)
+    return statement
+
+
+def imported(result):
+    return result.output.splitlines()[-1].split(' in ')[0]
+
+
+@pytest.mark.parametrize('content', [
+    # Identical lines were only told apart when they were next to each
+    # other, so the second coffee was taken for a duplicate of the first.
+    'timestamp,amount,comment\n2024-01-05,-3.50,coffee\n2024-01-05,-12.00,lunch\n2024-01-05,-3.50,coffee\n',
+    # The counts of identical lines started over whenever the date of the
+    # lines changed, so a statement out of date order lost it as well.
+    'timestamp,amount,comment\n2024-01-05,-3.50,coffee\n2024-01-04,-12.00,lunch\n2024-01-05,-3.50,coffee\n',
+])
+def test_repeated_statement_lines_are_kept(invoke, cash, statement, content):
+    path = statement(content)
+    assert imported(invoke('import_transactions', path, '--account-id', '1')) == 'Imported 3 of 3 transactions (0 duplicates)'
+    assert imported(invoke('import_transactions', path, '--account-id', '1')) == 'Imported 0 of 3 transactions (3 duplicates)'
+
+
+def test_overlapping_statements_import_only_new_lines(invoke, cash, statement):
+    first = statement('timestamp,amount,comment\n2024-01-05,-3.50,coffee\n2024-01-06,-12.00,lunch\n', 'first.csv')
+    second = statement('timestamp,amount,comment\n2024-01-06,-12.00,lunch\n2024-01-07,-3.50,coffee\n', 'second.csv')
+    invoke('import_transactions', first, '--account-id', '1')
+    assert imported(invoke('import_transactions', second, '--account-id', '1')) == 'Imported 1 of 2 transactions (1 duplicates)'
+    assert len(invoke('list_account_transactions_month', '2024', '1').output.splitlines()) == 3
+
+
+def test_references_identify_lines(invoke, cash, statement):
+    # Lines with a bank reference are the same transaction whatever else
+    # changed, and different ones whatever else is the same.
+    invoke('import_transactions', statement(
+        'timestamp,amount,comment,reference\n2024-01-05,-3.50,coffee,R1\n2024-01-05,-3.50,coffee,R2\n'
+    ), '--account-id', '1')
+    result = invoke('import_transactions', statement(
+        'timestamp,amount,comment,reference\n2024-01-05,-3.50,coffee at the station,R1\n'
+    ), '--account-id', '1')
+    assert imported(result) == 'Imported 0 of 1 transactions (1 duplicates)'
+    assert [transaction.comment for transaction in ledger.search_transactions('coffee')] == ['coffee', 'coffee']
+
+
+def test_ofx_statement(invoke, cash, statement):
+    path = statement(OFX, 'statement.ofx')
+    assert imported(invoke('import_transactions', path, '--account-id', '1')) == 'Imported 3 of 3 transactions (0 duplicates)'
+    assert imported(invoke('import_transactions', path, '--account-id', '1')) == 'Imported 0 of 3 transactions (3 duplicates)'
+    assert invoke('list_account_transactions_month', '2024', '1').output.splitlines() == [
+        '#1 "Cash" 2024-01-05 12:00:00 DEBIT 3.50 R "coffee"',
+        '#2 "Cash" 2024-01-06 00:00:00 TRANSFER_OUT 50.00 R "savings"',
+        '#3 "Cash" 2024-01-07 00:00:00 CREDIT 100.00 R "salary"'
+    ]
+
+
+@pytest.mark.parametrize('content, message', [
+    ('timestamp,amount,account_id,comment\n2024-01-05,-3.50,1,ok\n2024-01-05,-3.50,99,x\n', 'Line 3: unknown account "99"'),
+    ('timestamp,amount,account_id,type,comment\n2024-01-05,-3.50,1,FOO,x\n', 'Line 2: unknown transaction type "FOO"'),
+    ('timestamp,amount,account_id,comment\n2024-01-05,3.5x,1,x\n', 'Line 2: Unrecognized amount "3.5x"'),
+])
+def test_bad_statement_lines_are_reported(invoke, cash, statement, content, message):
+    # Unknown accounts and types and malformed amounts ended in a traceback.
+    result = invoke('import_transactions', statement(content))
+    assert result.exit_code == 1
+    assert 'Error: {0} ('.format(message) in result.output
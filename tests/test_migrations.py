@@ -0,0 +1,93 @@
+import sqlite3
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytest
+from click.testing import CliRunner
+
+from finctrl import cli, ledger
+from finctrl.ledger import TransactionType
+
+# The tables as the first version of finctrl created them.
+FIRST_SCHEMA = [
+    'CREATE TABLE currency (id INTEGER NOT NULL PRIMARY KEY, name VARCHAR(255) NOT NULL, '
+    'code VARCHAR(255) NOT NULL, sign VARCHAR(255) NOT NULL)',
+    'CREATE TABLE account (id INTEGER NOT NULL PRIMARY KEY, name VARCHAR(255) NOT NULL, '
+    'currency_id INTEGER NOT NULL REFERENCES currency (id))',
+    'CREATE TABLE accountbalance (id INTEGER NOT NULL PRIMARY KEY, account_id INTEGER NOT NULL REFERENCES account (id), '
+    'date DATE NOT NULL, balance DECIMAL(10, 2) NOT NULL)',
+    'CREATE TABLE accounttransaction (id INTEGER NOT NULL PRIMARY KEY, account_id INTEGER NOT NULL REFERENCES account (id), '
+    'timestamp DATETIME NOT NULL, type INTEGER NOT NULL, amount DECIMAL(10, 2) NOT NULL, comment TEXT NOT NULL)'
+]
+
+
+@pytest.fixture
+def first_version(tmpdir):
+    # A ledger as the first version of finctrl left it, and a connection to
+    # it that bypasses finctrl.
+    path = str(tmpdir.join('finance.db'))
+    connection = sqlite3.connect(path)
+    with connection:
+        for statement in FIRST_SCHEMA:
+            connection.execute(statement)
+        connection.execute("INSERT INTO currency VALUES (1, 'Ruble', 'RUB', 'R')")
+        connection.execute("INSERT INTO account VALUES (1, 'Cash', 1)")
+    yield path, connection
+    connection.close()
+    ledger.db.close()
+
+
+def test_upgrade_from_the_first_version(first_version):
+    path, connection = first_version
+    with connection:
+        connection.execute("INSERT INTO accountbalance VALUES (1, 1, '2024-01-10', 100.5)")
+        connection.executemany('INSERT INTO accounttransaction VALUES (?, 1, ?, ?, ?, ?)', [
+            (1, '2024-01-10 12:00:00', TransactionType.DEBIT.value, 5.15, 'lunch'),
+            (2, '2024-02-01 09:00:00', TransactionType.CREDIT.value, 20, 'salary')
+        ])
+    ledger.use_database(path)
+
+    assert ledger.db.pragma('user_version')[0] == len(ledger.MIGRATIONS)
+    # Amounts become integer minor units.
+    assert connection.execute('SELECT amount, typeof(amount) FROM accounttransaction WHERE id = 1').fetchone() == (515, 'integer')
+    assert connection.execute('SELECT balance FROM accountbalance').fetchone() == (10050,)
+    assert ledger.currencies()[0].exponent == 2
+    assert ledger.balances_on(date(2024, 2, 2), [1])[1] == Decimal('115.35')
+    # Indexes, aggregates and the search index are built for existing rows.
+    indexes = set(index.name for index in ledger.db.get_indexes('accountbalance'))
+    assert 'accountbalance_account_id_date' in indexes
+    assert [(total.type, total.amount) for total in ledger.monthly_totals((2024, 1), (2024, 2))] == [
+        (TransactionType.DEBIT, Decimal('5.15')),
+        (TransactionType.CREDIT, Decimal('20.00'))
+    ]
+    assert [transaction.id for transaction in ledger.search_transactions('salary')] == [2]
+    ledger.add_transaction(1, datetime(2024, 2, 3), TransactionType.DEBIT, '1.00', 'coffee')
+
+
+def test_current_version_is_not_migrated_again(database, monkeypatch):
+    # Opening a ledger at the current version costs one pragma read.
+    ledger.create_currency('Euro', 'EUR', 'EUR')
+    ledger.db.close()
+    statements = []
+    execute_sql = ledger.db.execute_sql
+    monkeypatch.setattr(ledger.db, 'execute_sql', lambda sql, *args, **kwargs: statements.append(sql) or execute_sql(sql, *args, **kwargs))
+    ledger.use_database(database)
+    assert statements == ['PRAGMA user_version']
+
+
+def test_upgrade_keeps_duplicate_balance_entries(first_version):
+    # The upgrade to unique balance entries deleted all but the first entry
+    # of an account on a day.
+    path, connection = first_version
+    with connection:
+        connection.executemany('INSERT INTO accountbalance VALUES (?, 1, ?, ?)', [
+            (1, '2024-01-10', 100.5), (2, '2024-01-11', 90), (3, '2024-01-10', 99)
+        ])
+    result = CliRunner().invoke(cli, ['--database', path, 'list_accounts'])
+    assert result.exit_code == 1
+    assert result.output.splitlines()[-2:] == ['  #1 account #1 2024-01-10 100.5', '  #3 account #1 2024-01-10 99']
+    assert connection.execute('SELECT COUNT(*) FROM accountbalance').fetchone()[0] == 3
+    with connection:
+        connection.execute('DELETE FROM accountbalance WHERE id = 3')
+    result = CliRunner().invoke(cli, ['--database', path, 'balance_at', '1', '2024', '1', '10'])
+    assert result.output == '#1 "Cash" 2024-01-10 100.50 R\n'
@@ -0,0 +1,36 @@
+import os
+
+import pytest
+from click.testing import CliRunner
+
+from finctrl import cli
+
+
+def run_traced(database, trace, report):
+    return CliRunner().invoke(
+        cli,
+        ['--database', database, '--profile-output', report, 'list_currencies'],
+        env={'FINCTRL_TRACE': trace}
+    )
+
+
+@pytest.mark.parametrize('trace', ['', '0', 'false', 'FALSE'])
+def test_trace_off(database, tmpdir, trace):
+    report = str(tmpdir.join('report.txt'))
+    result = run_traced(database, trace, report)
+    assert result.exit_code == 0
+    assert not os.path.exists(report)
+
+
+@pytest.mark.parametrize('trace', ['1', 'json'])
+def test_trace_on(database, tmpdir, trace):
+    report = str(tmpdir.join('report.txt'))
+    result = run_traced(database, trace, report)
+    assert result.exit_code == 0
+    assert os.path.getsize(report) > 0
+
+
+def test_unknown_trace_value_is_refused(database, tmpdir):
+    result = run_traced(database, 'yes', str(tmpdir.join('report.txt')))
+    assert result.exit_code == 2
+    assert 'FINCTRL_TRACE must be one of' in result.output
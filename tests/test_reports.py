@@ -0,0 +1,13 @@
+import pytest
+
+
+@pytest.mark.parametrize('argv', [
+    ['make_accounts_report'],
+    ['make_account_report', '1'],
+])
+def test_reversed_report_period_is_refused(invoke, cash, argv):
+    # A period ending before it started was reported on, with a wrong
+    # opening balance.
+    result = invoke(*(argv + ['2024', '1', '5', '2024', '1', '1']))
+    assert result.exit_code == 1
+    assert 'The period ends on 2024-01-01, before it starts on 2024-01-05' in result.output
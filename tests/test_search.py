@@ -0,0 +1,77 @@
+from datetime import datetime
+
+import pytest
+
+from finctrl import ledger
+from finctrl.ledger import TransactionType
+
+
+def test_search_over_more_archives_than_can_be_attached(database):
+    ledger.create_currency('Euro', 'EUR', 'EUR')
+    account_id = ledger.create_account('Cash', 'EUR')
+    years = list(range(2010, 2011 + ledger.MAX_ATTACHED_ARCHIVES + 1))
+    ledger.add_transactions([
+        (account_id, datetime(year, 6, 1), TransactionType.DEBIT, 1, 'coffee in {0}'.format(year))
+        for year in years + [years[-1] + 1]
+    ])
+    for year in years:
+        ledger.archive_year(year)
+
+    assert ledger.search_is_ranked('coffee')
+    found = ledger.search_transactions('coffee', limit=100)
+    assert [transaction.timestamp.year for transaction in found] == list(reversed(years + [years[-1] + 1]))
+    unranked = ledger.search_transactions('coffee', limit=100, ranked=False)
+    assert len(unranked) == len(years) + 1
+
+
+@pytest.mark.parametrize('option', ['--start-date', '--end-date'])
+def test_search_refuses_malformed_dates(invoke, option):
+    result = invoke('search_transactions', 'rent', option, 'yesterday')
+    assert result.exit_code == 2
+    assert 'Invalid value for "{0}": expected YYYY-MM-DD, got "yesterday"'.format(option) in result.output
+
+
+def test_search_within_dates(invoke):
+    ledger.create_currency('Euro', 'EUR', 'EUR')
+    account_id = ledger.create_account('Cash', 'EUR')
+    for month in (1, 2, 3):
+        ledger.add_transaction(account_id, datetime(2024, month, 1), TransactionType.DEBIT, 1, 'rent {0}'.format(month))
+    result = invoke('search_transactions', 'rent', '--start-date', '2024-02-01', '--end-date', '2024-03-01')
+    assert result.exit_code == 0
+    assert '"rent 2"' in result.output
+    assert 'rent 1' not in result.output and 'rent 3' not in result.output
+
+
+def results_per_year(output):
+    # The lines of every year, in the order they were listed.
+    years = {}
+    for line in output.splitlines():
+        years.setdefault(line.split()[2][:4], []).append(line)
+    return years
+
+
+def test_search_order_survives_archiving(invoke, cash):
+    # Every partition has its own search index, which ranks by its own
+    # statistics, so archiving a year may interleave the years differently;
+    # it must still find the same transactions in the same order per year.
+    comments = ['rent', 'rent for the flat', 'garage rent', 'rent rent', 'coffee', 'rent of the old flat by the river']
+    for year in (2023, 2024):
+        for day, comment in enumerate(comments * (2 if year == 2023 else 1), 1):
+            invoke('create_account_transaction', '1', 'DEBIT', '10.00', comment, str(year), '3', str(day), '12', '0', '0')
+    invoke('create_account_transaction', '1', 'DEBIT', '1.00', 'rent', '2025', '1', '5', '12', '0', '0')
+    searches = [['rent', '--limit', '100'], ['fla*'], ['rent flat']]
+    results = [results_per_year(invoke('search_transactions', *argv).output) for argv in searches]
+    assert invoke('archive_year', '2023').output.split(' into ')[0] == 'Archived 12 transactions and 0 balance entries of 2023'
+    assert [results_per_year(invoke('search_transactions', *argv).output) for argv in searches] == results
+
+
+def test_filtered_search_is_ranked(invoke, cash, monkeypatch):
+    # Whether to rank was decided by the matches before the account and
+    # date filters, so a search of one month for a common word never was.
+    for day in range(1, 6):
+        invoke('create_account_transaction', '1', 'DEBIT', '10.00', 'rent', '2024', '1', str(day), '12', '0', '0')
+    invoke('create_account_transaction', '1', 'DEBIT', '10.00', 'rent rent', '2024', '3', '1', '12', '0', '0')
+    invoke('create_account_transaction', '1', 'DEBIT', '10.00', 'garage rent', '2024', '3', '2', '12', '0', '0')
+    monkeypatch.setattr(ledger, 'RANKED_SEARCH_LIMIT', 3)
+    results = invoke('search_transactions', 'rent', '--start-date', '2024-03-01').output
+    assert [line.split('"')[-2] for line in results.splitlines()] == ['rent rent', 'garage rent']
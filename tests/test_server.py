@@ -0,0 +1,32 @@
+import json
+from datetime import date
+
+from finctrl import ledger, server
+
+
+def test_cache_follows_the_day(invoke, cash, database, monkeypatch):
+    # /balances answers for today without a date parameter, and the cached
+    # answer of one day was served on the next.
+    invoke('create_account_balance_entry', '1', '2024', '1', '10', '100.00')
+    invoke('create_account_transaction', '1', 'DEBIT', '30.00', 'lunch', '2024', '1', '10', '12', '0', '0')
+
+    class Clock(date):
+        day = date(2024, 1, 10)
+
+        @classmethod
+        def today(cls):
+            return cls.day
+
+    monkeypatch.setattr(server, 'date', Clock)
+    ledger.use_database(database)
+    cache = server.ResponseCache(16)
+    balances = []
+    for day in (date(2024, 1, 10), date(2024, 1, 11)):
+        Clock.day = day
+        cache.validate()
+        body = cache.get('/balances')
+        if body is None:
+            body = server.run_query(server.query_balances, {})[1]
+            cache.put('/balances', body)
+        balances.append(json.loads(body.decode('utf-8'))['1'])
+    assert balances == ['100.00', '70.00']
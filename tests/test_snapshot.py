@@ -0,0 +1,16 @@
+from finctrl.snapshot import Snapshot, snapshot_path
+
+
+def test_snapshot_notices_reused_ids(invoke, cash, database):
+    # SQLite hands the id of a removed newest transaction to the next one.
+    # The snapshot used to take the row count up to its last id as proof
+    # that nothing had changed, and kept the removed row.
+    invoke('create_account_transaction', '1', 'DEBIT', '5.15', 'lunch', '2024', '1', '12', '12', '0', '0')
+    invoke('create_account_transaction', '1', 'DEBIT', '7.00', 'taxi', '2024', '1', '13', '12', '0', '0')
+    invoke('snapshot')
+    invoke('remove_account_transaction', '2')
+    invoke('create_account_transaction', '1', 'CREDIT', '40.00', 'refund', '2024', '1', '14', '12', '0', '0')
+    assert invoke('snapshot').output.split(' in ')[0] == 'Snapshot of 2 transactions'
+    assert invoke('snapshot').output.split(', ')[-1] == '0 written\n'
+    snapshot = Snapshot(snapshot_path(database))
+    assert [snapshot.comment(row) for row in range(len(snapshot))] == ['lunch', 'refund']
@@ -0,0 +1,13 @@
+from datetime import date
+
+import pytest
+
+from finctrl import ledger
+
+
+def test_timeseries_refuses_period_that_ends_before_it_starts(invoke):
+    with pytest.raises(ValueError):
+        ledger.balance_timeseries(date(2024, 1, 5), date(2024, 1, 1))
+    result = invoke('timeseries', '2024', '1', '5', '2024', '1', '1')
+    assert result.exit_code == 1
+    assert 'The period ends on 2024-01-01, before it starts on 2024-01-05' in result.output